@@ -0,0 +1,430 @@
+"""
+Benchmarks for the render, settings load and send paths
+
+Usage:
+    python benchmarks/run_benchmarks.py                      # run all, write results JSON
+    python benchmarks/run_benchmarks.py -k render            # only names containing "render"
+    python benchmarks/run_benchmarks.py --compare old.json   # flag regressions against a previous run
+
+Results are written to benchmarks/results/<version>-<timestamp>.json unless
+--output is given. Send benchmarks run against the local stubs in stubs.py.
+
+This is a standalone runner rather than pytest-benchmark: it records peak
+allocation (tracemalloc) and send throughput next to the timings, keeps
+results as version-tagged JSON files compared with --compare across
+releases, and needs nothing beyond requirements.txt (aiosmtpd only for the
+SMTP cases), so it also runs where the test dependencies are not installed.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import statistics
+import contextlib
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for sub in ('script', 'type', 'email', 'auth'):
+    sys.path.append(os.path.join(ROOT, 'src', sub))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_DATA = {
+    "senderemail": "bench@outlook.com",
+    "receiveremail": "recipient@example.com",
+    "receiver": {"name": "Recipient"},
+    "subject": "Benchmark",
+    "body": "This is a benchmark message. " * 20,
+    "mode": {"gender": "neutral", "formal": "formal"}
+}
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Register a benchmark; the function returns a result dict"""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def time_call(func, repeat=5, number=None):
+    """timeit-style measurement: per-call seconds over `repeat` rounds"""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    rounds = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'calls_per_round': number,
+        'rounds': repeat,
+        'mean': statistics.mean(rounds),
+        'min': min(rounds),
+        'stdev': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+        'ops_per_sec': 1.0 / min(rounds),
+    }
+
+
+def time_throughput(func, count):
+    """Run func(count) once and report messages per second"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(count)
+    elapsed = time.perf_counter() - start
+    return {
+        'messages': count,
+        'seconds': elapsed,
+        'mean': elapsed / count,
+        'ops_per_sec': count / elapsed,
+    }
+
+
+# --- Render -----------------------------------------------------------------
+
+@benchmark('render.template_cold')
+def bench_template_cold():
+    """New renderer and settings store per call, no bytecode cache (first render of a process)"""
+    from substitute import TemplateRenderer
+    from settings_store import SettingsStore
+
+    def run():
+        TemplateRenderer(use_bytecode_cache=False, store=SettingsStore()).render('jp', SAMPLE_DATA)
+    return time_call(run, number=20)
+
+
+@benchmark('render.template_warm')
+def bench_template_warm():
+    from substitute import template_from_dict
+    template_from_dict('jp', SAMPLE_DATA)
+    return time_call(lambda: template_from_dict('jp', SAMPLE_DATA))
+
+
+@benchmark('render.skeleton_warm')
+def bench_skeleton_warm():
+    """SkeletonRenderer: slot filling into a cached pre-rendered skeleton"""
+    from skeleton import SkeletonRenderer
+
+    renderer = SkeletonRenderer()
+    renderer.render('jp', SAMPLE_DATA)
+    return time_call(lambda: renderer.render('jp', SAMPLE_DATA))
+
+
+@benchmark('render.template_file')
+def bench_template_file():
+    """template() including the data.json read"""
+    import tempfile
+    from substitute import template
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as f:
+        json.dump(SAMPLE_DATA, f)
+    try:
+        template('jp', f.name)
+        return time_call(lambda: template('jp', f.name))
+    finally:
+        os.remove(f.name)
+
+
+# --- Settings ---------------------------------------------------------------
+
+@benchmark('settings.load_language_cold')
+def bench_load_language_cold():
+    """Header/Footer/Person.load_language with a fresh settings store each call"""
+    import settings_store
+    from Header import Header
+    from Footer import Footer
+    from Person import Person
+
+    shared = settings_store.get_store()
+
+    def run():
+        settings_store.set_store(settings_store.SettingsStore())
+        Header(imageURL="", greeting="").load_language('jp')
+        Footer(closing="").load_language('jp')
+        Person(name="").load_language('jp')
+    try:
+        return time_call(run, number=50)
+    finally:
+        settings_store.set_store(shared)
+
+
+@benchmark('settings.load_language_warm')
+def bench_load_language_warm():
+    from Header import Header
+    from Footer import Footer
+    from Person import Person
+
+    def run():
+        Header(imageURL="", greeting="").load_language('jp')
+        Footer(closing="").load_language('jp')
+        Person(name="").load_language('jp')
+    run()
+    return time_call(run)
+
+
+@benchmark('settings.to_template_vars')
+def bench_to_template_vars():
+    from EMailComponent import EMailComponent
+
+    component = EMailComponent.create_with_defaults('jp', body=SAMPLE_DATA['body'],
+                                                    receiver_name='Recipient').load_language('jp')
+    return time_call(component.to_template_vars)
+
+
+# --- MIME -------------------------------------------------------------------
+
+def _mime_case():
+    from substitute import template_from_dict
+
+    html_body = template_from_dict('jp', SAMPLE_DATA)
+    return ('bench@gmail.com', SAMPLE_DATA['receiveremail'], SAMPLE_DATA['receiver']['name'],
+            SAMPLE_DATA['subject'], html_body)
+
+
+def _peak_allocation(func):
+    """Peak bytes allocated by one call (tracemalloc)"""
+    import tracemalloc
+
+    func()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _stdlib_build_raw(sender_email, recipient_email, recipient_name, subject, html_body):
+    """The EmailMessage path GmailAuth.build_raw used before MimeBuilder"""
+    import base64
+    from email.message import EmailMessage
+
+    message = EmailMessage()
+    message['To'] = f'{recipient_name} <{recipient_email}>'
+    message['From'] = sender_email
+    message['Subject'] = subject
+    message.set_content(html_body, subtype='html')
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+
+
+@benchmark('mime.stdlib_build_raw')
+def bench_mime_stdlib():
+    case = _mime_case()
+    result = time_call(lambda: _stdlib_build_raw(*case))
+    result['peak_bytes'] = _peak_allocation(lambda: _stdlib_build_raw(*case))
+    return result
+
+
+@benchmark('mime.fast_build_raw')
+def bench_mime_fast():
+    """MimeBuilder: cached sender header, one reusable buffer per thread"""
+    from mime_stream import MimeBuilder
+
+    builder = MimeBuilder()
+    case = _mime_case()
+    result = time_call(lambda: builder.build_raw(*case))
+    result['peak_bytes'] = _peak_allocation(lambda: builder.build_raw(*case))
+    return result
+
+
+# --- Send -------------------------------------------------------------------
+
+def _outlook_stub(stub, account='bench@outlook.com'):
+    from token_manager import get_token_manager
+    from outlook_azure import OutlookGraphAuth
+
+    # Pre-seeded in-memory token: no login, no token cache on disk
+    manager = get_token_manager(f"outlook:{account}", lambda token: None, cache=None, background=False)
+    manager.set_token({'access_token': 'bench', 'refresh_token': None, 'expires_at': time.time() + 3600})
+    outlook = OutlookGraphAuth(account=account)
+    outlook.graph_api_url = stub.url
+    return outlook
+
+
+def _render_and_send(service, count):
+    from substitute import template_from_dict
+
+    for index in range(count):
+        html = template_from_dict('jp', SAMPLE_DATA)
+        service.send_email(SAMPLE_DATA['senderemail'], f"r{index}@example.com", 'Recipient',
+                           SAMPLE_DATA['subject'], html)
+
+
+@benchmark('send.outlook_sequential')
+def bench_outlook_sequential():
+    from stubs import StubServer
+
+    with StubServer() as stub:
+        outlook = _outlook_stub(stub)
+        result = time_throughput(lambda count: _render_and_send(outlook, count), 300)
+        outlook.close()
+    return result
+
+
+@benchmark('send.outlook_scheduler')
+def bench_outlook_scheduler():
+    """SendScheduler with 4 workers and the rate limit lifted"""
+    from stubs import StubServer
+    from scheduler import SendScheduler
+    from send_email import OUTLOOK
+    from substitute import template_from_dict
+    from Message import Message
+
+    with StubServer() as stub:
+        outlook = _outlook_stub(stub)
+        limits = {OUTLOOK: {'rate': 1e9, 'burst': 1e9, 'concurrency': 4}}
+
+        def run(count):
+            with SendScheduler(workers=4, limits=limits, auth_func=lambda sender: outlook) as scheduler:
+                items = (
+                    (index, Message.from_dict({**SAMPLE_DATA, 'receiveremail': f"r{index}@example.com"}),
+                     template_from_dict('jp', SAMPLE_DATA))
+                    for index in range(count)
+                )
+                for _ in scheduler.imap(items):
+                    pass
+        result = time_throughput(run, 300)
+        outlook.close()
+    return result
+
+
+@benchmark('send.outlook_batch')
+def bench_outlook_batch():
+    from stubs import StubServer
+    from substitute import template_from_dict
+
+    with StubServer() as stub:
+        outlook = _outlook_stub(stub)
+
+        def run(count):
+            html = template_from_dict('jp', SAMPLE_DATA)
+            outlook.send_batch([
+                {'recipient_email': f"r{index}@example.com", 'recipient_name': 'Recipient',
+                 'subject': SAMPLE_DATA['subject'], 'html_body': html}
+                for index in range(count)
+            ])
+        result = time_throughput(run, 1000)
+        outlook.close()
+    return result
+
+
+@benchmark('send.gmail_sequential')
+def bench_gmail_sequential():
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+    from google_oauth2 import GmailAuth, load_discovery_document
+    from stubs import StubServer
+
+    with StubServer() as stub:
+        http = httplib2.Http()
+        gmail = GmailAuth(account='bench@gmail.com', http=http)
+        gmail.service = build_from_document(load_discovery_document(), http=http,
+                                            client_options={'api_endpoint': stub.url + '/'})
+        return time_throughput(lambda count: _render_and_send(gmail, count), 300)
+
+
+def _smtp_sends(reuse, count):
+    from stubs import SMTPStubServer
+    from smtp_provider import SMTPService
+
+    with SMTPStubServer() as stub:
+        smtp = SMTPService(account='bench@example.org', host='127.0.0.1', port=stub.port,
+                           password='bench', starttls=False)
+        if not reuse:
+            # Every send opens (and logs in) a new connection
+            smtp.pool.max_idle = -1
+        result = time_throughput(lambda count: _render_and_send(smtp, count), count)
+        smtp.close()
+        result['connections'] = stub.connections
+    return result
+
+
+@benchmark('send.smtp_pooled')
+def bench_smtp_pooled():
+    """SMTPService against a local aiosmtpd server, reusing one logged-in connection"""
+    return _smtp_sends(True, 300)
+
+
+@benchmark('send.smtp_per_message')
+def bench_smtp_per_message():
+    """Same, with a new connection and login per message"""
+    return _smtp_sends(False, 300)
+
+
+def run(pattern=None):
+    results = {}
+    for name, func in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        try:
+            results[name] = func()
+        except ImportError as e:
+            print(f"{name:32s} skipped ({e})")
+            continue
+        result = results[name]
+        print(f"{name:32s} {result['mean'] * 1e6:12.1f} us/op {result['ops_per_sec']:12.1f} ops/s")
+    return results
+
+
+def project_version():
+    with open(os.path.join(ROOT, 'pyproject.toml'), 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('version'):
+                return line.split('=', 1)[1].strip().strip('"')
+    return 'unknown'
+
+
+def compare(results, previous_path, threshold=0.10):
+    """Print the change against a previous results file; returns the regressed names"""
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)['results']
+    regressions = []
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        change = result['ops_per_sec'] / previous[name]['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:32s} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run mail_template benchmarks")
+    parser.add_argument('-k', dest='pattern', help="Only run benchmarks whose name contains this")
+    parser.add_argument('-o', '--output', help="Results JSON path")
+    parser.add_argument('--compare', help="Previous results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern)
+    version = project_version()
+    report = {
+        'version': version,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"{version}-{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
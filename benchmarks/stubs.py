@@ -0,0 +1,190 @@
+"""
+Local stand-ins for Microsoft Graph, the Gmail API and an SMTP server
+
+The servers accept every send and answer like the real service, so the
+send path can be measured without network access or real accounts.
+SMTPStubServer needs the aiosmtpd package.
+"""
+
+import json
+import base64
+import socket
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so pooled clients reuse connections as they would in production
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            return self._read_chunked()
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.bytes_received += length
+        return self.rfile.read(length)
+
+    def _read_chunked(self):
+        """Read (and count) a chunked request body; only the size is kept"""
+        total = 0
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                break
+            total += len(self.rfile.read(size))
+            self.rfile.readline()
+        self.server.bytes_received += total
+        return b''
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.requests += 1
+        path = self.path.split('?')[0]
+
+        if path.endswith('/me/sendMail'):
+            self._reply(202)
+        elif path.endswith('/$batch'):
+            items = json.loads(body).get('requests', [])
+            responses = []
+            for item in items:
+                status, headers = self.server.item_status(item) if self.server.item_status else (202, {})
+                if status is not None:
+                    responses.append({'id': item['id'], 'status': status, 'headers': headers})
+            self._reply(200, json.dumps({'responses': responses}).encode())
+        elif path.endswith('/messages/send') and 'uploadType=resumable' in self.path:
+            # Start of a resumable media upload: hand out the session URL
+            self.send_response(200)
+            self.send_header('Location', f"http://127.0.0.1:{self.server.server_port}/upload-session")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif path.endswith('/messages/send'):
+            self._reply(200, json.dumps({'id': str(self.server.requests)}).encode())
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        self._read_body()
+        self.server.requests += 1
+        content_range = self.headers.get('Content-Range', '')
+        # "bytes first-last/total": the upload is complete once last + 1 == total
+        span, _, total = content_range.partition(' ')[2].partition('/')
+        last = span.partition('-')[2]
+        if total != '*' and last and int(last) + 1 == int(total):
+            self._reply(200, json.dumps({'id': str(self.server.requests)}).encode())
+        else:
+            self.send_response(308)
+            self.send_header('Range', f"bytes=0-{last}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        """Suppress HTTP server logs"""
+        pass
+
+
+class StubServer:
+    """
+    Threaded HTTP server on 127.0.0.1 with request/byte counters
+
+    Args:
+        item_status: callable(batch request item) -> (status, headers) for each
+            item of a Graph $batch call (default: every item gets 202); a None
+            status leaves the item out of the response
+    """
+
+    def __init__(self, item_status=None):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.daemon_threads = True
+        self.server.requests = 0
+        self.server.bytes_received = 0
+        self.server.item_status = item_status
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SMTPStubServer:
+    """
+    aiosmtpd server on 127.0.0.1 that accepts any login (without TLS) and
+    counts messages, bytes and connections
+
+    `on_data(envelope)` may return the reply to DATA instead of '250 OK', or
+    None to drop the connection without replying. XOAUTH2 initial responses
+    are decoded into `xoauth2`.
+    """
+
+    def __init__(self, on_data=None):
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+
+        stub = self
+        self.messages = 0
+        self.bytes_received = 0
+        self.connections = 0
+        self.xoauth2 = []
+
+        class Handler:
+            async def handle_EHLO(self, server, session, envelope, hostname, responses):
+                # Sent once per connection (no STARTTLS here)
+                stub.connections += 1
+                session.host_name = hostname
+                return responses
+
+            async def handle_DATA(self, server, session, envelope):
+                stub.messages += 1
+                stub.bytes_received += len(envelope.original_content or b'')
+                reply = '250 OK' if on_data is None else on_data(envelope)
+                if reply is None:
+                    server.transport.close()
+                return reply
+
+            async def auth_XOAUTH2(self, server, args):
+                stub.xoauth2.append(base64.b64decode(args[1]).decode())
+                return AuthResult(success=True)
+
+        # aiosmtpd logs a deprecation warning on every successful login
+        logging.getLogger('mail.log').setLevel(logging.ERROR)
+        # Controller checks its port by connecting to it, so port 0 cannot be used
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self.controller = Controller(
+            Handler(), hostname='127.0.0.1', port=port,
+            authenticator=lambda server, session, envelope, mechanism, auth_data: AuthResult(success=True),
+            auth_require_tls=False
+        )
+
+    @property
+    def port(self):
+        return self.controller.port
+
+    def __enter__(self):
+        self.controller.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller.stop()
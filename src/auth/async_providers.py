@@ -0,0 +1,300 @@
+"""
+asyncio send clients for Outlook (Microsoft Graph) and Gmail, built on httpx
+
+Same send_email(sender_email, recipient_email, recipient_name, subject, html_body)
+contract as OutlookGraphAuth / GmailAuth, plus send_many() to keep many sends
+in flight from one thread. Tokens come from the same TokenManager entries as
+the synchronous clients, so a login done by either is reused by both.
+
+httpx is imported on first use; HTTP/2 is used when ASYNC_HTTP2=1 and the
+`h2` package is installed.
+"""
+
+import os
+import sys
+import asyncio
+import weakref
+from abc import ABC, abstractmethod
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+
+from token_manager import get_token_manager
+from metrics import get_metrics, error_class
+
+OUTLOOK = 'outlook'
+GMAIL = 'gmail'
+
+GMAIL_API_URL = os.getenv('GMAIL_API_URL', 'https://gmail.googleapis.com/gmail/v1')
+
+# Connections (and in-flight requests) per provider, shared by all accounts
+MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '100'))
+
+# In-flight sends per account; Graph allows 4 concurrent requests per mailbox
+DEFAULT_CONCURRENCY = {OUTLOOK: 4, GMAIL: 10}
+
+# event loop -> {provider: (httpx.AsyncClient, asyncio.Semaphore)}
+_shared = weakref.WeakKeyDictionary()
+
+
+def _http2_enabled():
+    if os.getenv('ASYNC_HTTP2', '') in ('', '0'):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("ASYNC_HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+        return False
+    return True
+
+
+def get_async_client(provider):
+    """
+    Return the pooled AsyncClient and connection semaphore of `provider`
+    for the running event loop (created on first use)
+    """
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    clients = _shared.setdefault(loop, {})
+    entry = clients.get(provider)
+    if entry is None or entry[0].is_closed:
+        limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+        client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0), http2=_http2_enabled())
+        entry = clients[provider] = (client, asyncio.Semaphore(MAX_CONNECTIONS))
+    return entry
+
+
+async def aclose_clients():
+    """Close the pooled clients of the running event loop"""
+    clients = _shared.pop(asyncio.get_running_loop(), {})
+    for client, _ in clients.values():
+        await client.aclose()
+
+
+def _retry_after(response):
+    """Seconds from a Retry-After header (0 if absent or not a number)"""
+    try:
+        return max(0, int(response.headers.get('Retry-After', 0)))
+    except ValueError:
+        return 0
+
+
+def _is_retryable(status):
+    """429 and 5xx; None (no response) is not, the request may have reached the provider"""
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _not_sent(error):
+    """True if httpx failed before the request was written (connecting or waiting for the pool)"""
+    import httpx
+
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+async def _run_sync(func, *args):
+    """Run a blocking call (token refresh, interactive login) in the default executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class _AsyncProvider(ABC):
+    """
+    Shared send/retry logic; subclasses build the request for one message
+
+    A client may be used from several event loops (e.g. successive
+    asyncio.run() calls): the per-account semaphore and the shared pool are
+    kept per loop. An explicitly passed `client` is bound to the loop it is
+    first used on, and using it from another loop raises RuntimeError.
+
+    Args:
+        account: sender address (token cache key)
+        concurrency: in-flight sends for this account
+        client: httpx.AsyncClient to use instead of the shared pool
+    """
+    provider = None
+    success_status = 200
+
+    def __init__(self, account=None, concurrency=None, client=None):
+        self.account = account or 'default'
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY[self.provider]
+        self.token_manager = get_token_manager(f"{self.provider}:{self.account}", self._refresh_token_data)
+        self._client = client
+        self._client_loop = None
+        # event loop -> asyncio.Semaphore(concurrency)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    @abstractmethod
+    def _refresh_token_data(token):
+        """TokenManager refresh callback; a staticmethod so the shared manager holds no instance"""
+
+    @abstractmethod
+    def _access_token(self, token):
+        """Bearer token from a TokenManager entry"""
+
+    @abstractmethod
+    def build_request(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """Return (url, json body) for one message"""
+
+    def _loop_resources(self):
+        """Return (client, connection semaphore, account semaphore) for the running loop"""
+        loop = asyncio.get_running_loop()
+        client, connections = get_async_client(self.provider)
+        if self._client is not None:
+            if self._client_loop is None:
+                self._client_loop = weakref.ref(loop)
+            elif self._client_loop() is not loop:
+                raise RuntimeError(f"The client passed to {type(self).__name__} belongs to another event loop")
+            client = self._client
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return client, connections, semaphore
+
+    async def _get_token(self):
+        token = self.token_manager.token
+        if self.token_manager.is_valid(token):
+            return token
+        # Refreshing uses the blocking token endpoint; keep it off the event loop
+        return await _run_sync(self.token_manager.get_token)
+
+    async def _send(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """
+        Send one message; returns (status, retry_after seconds)
+
+        status is None if the request may have reached the provider without a
+        response coming back; a connection that could not be opened counts as 503.
+        """
+        client, connections, semaphore = self._loop_resources()
+
+        token = await self._get_token()
+        if token is None:
+            print("Failed to get valid authorization headers")
+            return 401, 0
+        headers = {'Authorization': f'Bearer {self._access_token(token)}'}
+        url, body = self.build_request(sender_email, recipient_email, recipient_name, subject, html_body)
+
+        metrics = get_metrics()
+        async with semaphore, connections:
+            try:
+                with metrics.span('http_send', provider=self.provider):
+                    response = await client.post(url, headers=headers, json=body)
+            except Exception as e:
+                metrics.inc('messages_failed_total', provider=self.provider, error=error_class(error=e))
+                if _not_sent(e):
+                    # Nothing was sent: as safe to retry as a 503
+                    print(f"Could not connect to send email to {recipient_email}: {e}")
+                    return 503, 0
+                print(f"Unexpected error sending email: {e}")
+                return None, 0
+
+        if response.status_code == self.success_status:
+            metrics.inc('messages_sent_total', provider=self.provider)
+            metrics.inc('bytes_sent_total', len(response.request.content), provider=self.provider)
+            return response.status_code, 0
+        metrics.inc('messages_failed_total', provider=self.provider, error=error_class(response.status_code))
+        print(f"Failed to send email to {recipient_email}. Status: {response.status_code}")
+        return response.status_code, _retry_after(response)
+
+    async def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """Send one message; returns True on success"""
+        status, _ = await self._send(sender_email, recipient_email, recipient_name, subject, html_body)
+        return status == self.success_status
+
+    async def send_many(self, messages, max_retries=3):
+        """
+        Send many messages concurrently (bounded by the account and pool semaphores)
+
+        Args:
+            messages: dicts with the send_email() keyword arguments
+            max_retries: retries for 429/5xx and failed connects, honouring Retry-After
+
+        Returns:
+            (failed, uncertain): the messages that were not sent, for re-queueing,
+            and those whose request got no response (they may have been
+            delivered, so they are not resent)
+        """
+        async def send_one(message):
+            for attempt in range(max_retries + 1):
+                status, retry_after = await self._send(**message)
+                if status == self.success_status:
+                    return True
+                if status is None:
+                    return None
+                if not _is_retryable(status) or attempt == max_retries:
+                    return False
+                get_metrics().inc('retries_total', stage='async', error=error_class(status))
+                with get_metrics().span('retry_wait', provider=self.provider):
+                    await asyncio.sleep(retry_after or 2 ** attempt)
+            return False
+
+        results = await asyncio.gather(*(send_one(message) for message in messages))
+        failed = [message for message, sent in zip(messages, results) if sent is False]
+        uncertain = [message for message, sent in zip(messages, results) if sent is None]
+        print(f"Async send finished: {len(messages) - len(failed) - len(uncertain)} sent, "
+              f"{len(failed)} failed, {len(uncertain)} uncertain")
+        return failed, uncertain
+
+
+class AsyncOutlookClient(_AsyncProvider):
+    """Microsoft Graph /me/sendMail over a pooled httpx.AsyncClient"""
+    provider = OUTLOOK
+    success_status = 202
+
+    def __init__(self, account=None, concurrency=None, client=None):
+        super().__init__(account, concurrency, client)
+        self.graph_api_url = os.getenv('GRAPH_API_URL', "https://graph.microsoft.com/v1.0")
+
+    @staticmethod
+    def _refresh_token_data(token):
+        from outlook_azure import refresh_outlook_token
+
+        return refresh_outlook_token(token)
+
+    def _access_token(self, token):
+        return token['access_token']
+
+    def build_request(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        from outlook_azure import OutlookGraphAuth
+
+        return (f"{self.graph_api_url}/me/sendMail",
+                OutlookGraphAuth.build_message(recipient_email, recipient_name, subject, html_body))
+
+    async def authenticate(self):
+        """Run the interactive login (in a worker thread) if no usable token is cached"""
+        from outlook_azure import outlook_authenticate
+
+        outlook = await _run_sync(outlook_authenticate, None, self.account)
+        if outlook is None:
+            return False
+        outlook.close()
+        return True
+
+
+class AsyncGmailClient(_AsyncProvider):
+    """Gmail users.messages.send over a pooled httpx.AsyncClient"""
+    provider = GMAIL
+
+    def __init__(self, account=None, concurrency=None, client=None):
+        super().__init__(account, concurrency, client)
+        self.gmail_api_url = GMAIL_API_URL
+
+    @staticmethod
+    def _refresh_token_data(token):
+        from google_oauth2 import refresh_gmail_token
+
+        return refresh_gmail_token(token)
+
+    def _access_token(self, token):
+        return token['credentials']['token']
+
+    def build_request(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        from google_oauth2 import GmailAuth
+
+        raw_message = GmailAuth.build_raw(sender_email, recipient_email, recipient_name, subject, html_body)
+        return f"{self.gmail_api_url}/users/me/messages/send", {'raw': raw_message}
+
+    async def authenticate(self):
+        """Run the interactive login (in a worker thread) if no usable token is cached"""
+        from google_oauth2 import gmail_authenticate_service
+
+        return await _run_sync(gmail_authenticate_service, self.account) is not None
@@ -1,26 +1,115 @@
 import os
-import base64
+import sys
+import time
+import json
 import pickle
+import calendar
+import threading
+import weakref
+from functools import lru_cache
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from email.message import EmailMessage
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'email'))
+
+from token_manager import get_token_manager, TokenRevoked
+from metrics import get_metrics, error_class
+from mime_stream import mime_message, spool, get_mime_builder
 
 # 1. Define OAuth2 Scopes (Gmail full access)
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/gmail.send',
           'https://www.googleapis.com/auth/gmail.modify']
 
+# Scope of the separate token used for SMTP XOAUTH2 (the API scopes are not accepted there)
+SMTP_SCOPES = ['https://mail.google.com/']
+
 JSON_PATH = "client_secret.json"
 
+# Credentials written by older versions; read once and migrated to the token cache
+LEGACY_TOKEN_PATH = 'token.pickle'
+
+# Optional path to a gmail v1 discovery document; defaults to the copy bundled
+# with google-api-python-client, so building the client never hits the network
+DISCOVERY_DOC_PATH = os.getenv('GMAIL_DISCOVERY_DOC', '')
+
+# Gmail accepts up to 100 calls per batch but recommends 50 or fewer
+GMAIL_BATCH_LIMIT = 50
+
+# Resumable upload chunk size for streamed messages (a multiple of 256 KiB)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=1)
+def load_discovery_document():
+    """
+    Load and parse the gmail v1 discovery document once per process
+    
+    Returns:
+        dict or None if no static document is available
+    """
+    if DISCOVERY_DOC_PATH:
+        with open(DISCOVERY_DOC_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        return None
+    doc = get_static_doc('gmail', 'v1')
+    return json.loads(doc) if doc else None
+
+
+# Built clients, keyed by the credentials object they were built for
+_services = weakref.WeakKeyDictionary()
+_services_lock = threading.Lock()
+
+
+def build_gmail_service(creds=None, http=None):
+    """
+    Build the Gmail client from the static discovery document
+    
+    Clients built for credentials are cached per credentials object. Pass
+    `http` (e.g. googleapiclient.http.HttpMockSequence) instead of credentials
+    to run against a mock transport.
+    """
+    doc = load_discovery_document()
+    if http is not None:
+        if doc is None:
+            return build('gmail', 'v1', http=http)
+        return build_from_document(doc, http=http)
+    
+    with _services_lock:
+        service = _services.get(creds)
+        if service is None:
+            if doc is None:
+                service = build('gmail', 'v1', credentials=creds)
+            else:
+                service = build_from_document(doc, credentials=creds)
+            _services[creds] = service
+        return service
+
 
 class GmailAuth:
     """
     Gmail authentication service wrapper
     """
     
-    def __init__(self):
+    def __init__(self, account=None, http=None, scopes=None, token_prefix='gmail'):
         self.service = None
+        self.creds = None
+        # Transport override (mock transport for network-isolated tests)
+        self.http = http
+        self._local = threading.local()
+        # Token storage, shared by every instance for the same account
+        self.account = account or 'default'
+        self.scopes = list(scopes or SCOPES)
+        self.token_manager = get_token_manager(f"{token_prefix}:{self.account}", refresh_gmail_token)
+        self._legacy_token = token_prefix == 'gmail'
         
     def gmail_authenticate(self):
         """
@@ -29,26 +118,78 @@ class GmailAuth:
         Returns:
             Gmail service object or None
         """
+        if self.http is not None:
+            return build_gmail_service(http=self.http)
+        
         creds = None
-        # token.pickle stores the user access and refresh tokens
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                creds = pickle.load(token)
+        # The token cache stores the user access and refresh tokens (refreshed if needed)
+        token = self.token_manager.get_token()
+        if token is not None:
+            creds = self.creds or Credentials.from_authorized_user_info(token['credentials'], self.scopes)
+        elif self._legacy_token and os.path.exists(LEGACY_TOKEN_PATH):
+            with open(LEGACY_TOKEN_PATH, 'rb') as token_file:
+                creds = pickle.load(token_file)
 
         # If no valid credentials, request login
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
             else:
-                flow = InstalledAppFlow.from_client_secrets_file(JSON_PATH, SCOPES)
+                flow = InstalledAppFlow.from_client_secrets_file(JSON_PATH, self.scopes)
                 creds = flow.run_local_server(port=0)
 
-            # Save credentials
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
+        # Save credentials
+        self.creds = creds
+        if token is None or token['credentials'].get('token') != creds.token:
+            self.token_manager.set_token(_creds_to_token(creds))
 
-        return build('gmail', 'v1', credentials=creds)
-        
+        return build_gmail_service(creds)
+    
+    def _thread_http(self):
+        """
+        Authorized transport for the calling thread (httplib2 is not thread-safe)
+        """
+        if self.http is not None or self.creds is None:
+            return None
+        self._sync_creds()
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import google_auth_httplib2
+            from googleapiclient.http import build_http
+            # build_http() keeps 308 (resumable upload "resume incomplete") from being treated as a redirect
+            http = self._local.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=build_http())
+        return http
+    
+    def _sync_creds(self):
+        """
+        Adopt the shared TokenManager's token (refreshing it if needed)
+
+        The token may have been refreshed through another instance for the same
+        account; the credentials are updated in place, so the cached client
+        and every thread's transport use the new token.
+        """
+        token = self.token_manager.get_token()
+        if token is None or token['credentials'].get('token') == self.creds.token:
+            return
+        fresh = Credentials.from_authorized_user_info(token['credentials'], self.scopes)
+        self.creds.token = fresh.token
+        self.creds.expiry = fresh.expiry
+    
+    @property
+    def last_status(self):
+        """
+        HTTP status of the calling thread's last send_email() (None if no response)
+        """
+        return getattr(self._local, 'last_status', None)
+    
+    def is_healthy(self):
+        """
+        True while the service has valid (or refreshable) credentials
+        """
+        if self.service is None or self.creds is None:
+            return False
+        return self.creds.valid or bool(self.creds.refresh_token)
+    
     def authenticate(self):
         """
         Authenticate with Gmail API
@@ -60,43 +201,169 @@ class GmailAuth:
             print(f"Gmail authentication failed: {e}")
             return False
     
+    @staticmethod
+    def build_raw(sender_email, recipient_email, recipient_name, subject, html_body):
+        """
+        Build the base64url-encoded RFC 2822 message expected by messages.send
+        """
+        return get_mime_builder().build_raw(sender_email, recipient_email, recipient_name, subject, html_body)
+    
     def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
         """
         Send email using Gmail API (compatible interface with Outlook service)
         """        
+        self._local.last_status = None
+        metrics = get_metrics()
         try:
-            # Create email message
-            message = EmailMessage()
-            message['To'] = f'{recipient_name} <{recipient_email}>'
-            message['From'] = sender_email
-            message['Subject'] = subject
-            
-            # Set HTML content
-            message.set_content(html_body, subtype='html')
-            
-            # Encode message
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+            raw_message = self.build_raw(sender_email, recipient_email, recipient_name, subject, html_body)
             
             # Send email using Gmail API
-            send_message = self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw_message}
-            ).execute()
+            with metrics.span('http_send', provider='gmail'):
+                send_message = self.service.users().messages().send(
+                    userId='me',
+                    body={'raw': raw_message}
+                ).execute(http=self._thread_http())
             
+            self._local.last_status = 200
+            metrics.inc('messages_sent_total', provider='gmail')
+            metrics.inc('bytes_sent_total', len(raw_message), provider='gmail')
             print(f"Gmail message sent successfully. Message ID: {send_message['id']}")
             return True
             
+        except HttpError as e:
+            self._local.last_status = e.resp.status
+            metrics.inc('messages_failed_total', provider='gmail', error=error_class(e.resp.status))
+            print(f"Failed to send Gmail message: {e}")
+            return False
         except Exception as e:
+            metrics.inc('messages_failed_total', provider='gmail', error=error_class(error=e))
             print(f"Failed to send Gmail message: {e}")
             return False
+    
+    def send_email_stream(self, sender_email, recipient_email, recipient_name, subject, html_chunks):
+        """
+        Send a streamed HTML body (text chunks) without building it in memory
+        
+        The MIME message is encoded into a spooled file (moved to disk when
+        large) and sent as a resumable message/rfc822 media upload, read back
+        UPLOAD_CHUNK_SIZE bytes at a time.
+        """
+        from googleapiclient.http import MediaIoBaseUpload
+        
+        self._local.last_status = None
+        metrics = get_metrics()
+        try:
+            mime = mime_message(sender_email, recipient_email, recipient_name, subject, html_chunks)
+            spooled, size = spool(mime)
+            with spooled:
+                media = MediaIoBaseUpload(spooled, mimetype='message/rfc822',
+                                          chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+                with metrics.span('http_send', provider='gmail'):
+                    send_message = self.service.users().messages().send(
+                        userId='me',
+                        media_body=media
+                    ).execute(http=self._thread_http())
+            
+            self._local.last_status = 200
+            metrics.inc('messages_sent_total', provider='gmail')
+            metrics.inc('bytes_sent_total', size, provider='gmail')
+            print(f"Gmail message sent successfully. Message ID: {send_message['id']}")
+            return True
+        
+        except HttpError as e:
+            self._local.last_status = e.resp.status
+            metrics.inc('messages_failed_total', provider='gmail', error=error_class(e.resp.status))
+            print(f"Failed to send Gmail message: {e}")
+            return False
+        except Exception as e:
+            metrics.inc('messages_failed_total', provider='gmail', error=error_class(error=e))
+            print(f"Failed to send Gmail message: {e}")
+            return False
+    
+    def send_batch(self, messages, batch_size=GMAIL_BATCH_LIMIT):
+        """
+        Send many messages with batched HTTP requests (batch_size calls per request)
+        
+        Items that get a transient HTTP error (429/5xx), either inside the batch
+        or for the whole batch request, are retried once as individual sends.
+        Items without any answer (e.g. the connection dropped mid-batch) may
+        have been delivered and are never resent.
+        
+        Args:
+            messages: list of dicts with the send_email() keyword arguments
+        
+        Returns:
+            (failed, uncertain): the messages that were not sent, for
+            re-queueing, and those whose outcome is unknown
+        """
+        metrics = get_metrics()
+        failed = []
+        uncertain = []
+        
+        for start in range(0, len(messages), batch_size):
+            chunk = messages[start:start + batch_size]
+            results = {}
+            
+            def callback(request_id, response, exception):
+                # Map the result back to the recipient by request_id (index in chunk)
+                results[request_id] = exception
+            
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index, message in enumerate(chunk):
+                raw_message = self.build_raw(**message)
+                batch.add(
+                    self.service.users().messages().send(userId='me', body={'raw': raw_message}),
+                    request_id=str(index)
+                )
+            
+            # Applies to the items the batch did not answer (None: no HTTP answer at all)
+            batch_error = None
+            try:
+                with metrics.span('http_send', provider='gmail_batch'):
+                    batch.execute(http=self._thread_http())
+            except HttpError as e:
+                print(f"Gmail batch request failed: {e}")
+                batch_error = e
+            except Exception as e:
+                # Callbacks that already ran keep their results
+                print(f"Gmail batch request failed: {e}")
+            
+            for index, message in enumerate(chunk):
+                exception = results.get(str(index), batch_error)
+                if str(index) in results and exception is None:
+                    metrics.inc('messages_sent_total', provider='gmail')
+                    continue
+                
+                if exception is None:
+                    metrics.inc('messages_failed_total', provider='gmail', error='uncertain')
+                    print(f"No answer for the Gmail message to {message['recipient_email']}; not resending it")
+                    uncertain.append(message)
+                    continue
+                
+                if _is_transient(exception):
+                    # Fall back to an individual send
+                    metrics.inc('retries_total', stage='batch', error=_error_class(exception))
+                    if self.send_email(**message):
+                        continue
+                    if self.last_status is None:
+                        uncertain.append(message)
+                        continue
+                else:
+                    metrics.inc('messages_failed_total', provider='gmail', error=_error_class(exception))
+                    print(f"Failed to send Gmail message to {message['recipient_email']}: {exception}")
+                failed.append(message)
+        
+        print(f"Batch send finished: {len(messages) - len(failed) - len(uncertain)} sent, "
+              f"{len(failed)} failed, {len(uncertain)} uncertain")
+        return failed, uncertain
 
 
-def gmail_authenticate_service():
+def gmail_authenticate_service(account=None):
     """
     Factory function to create Gmail authentication service
     """
     try:
-        gmail_auth = GmailAuth()
+        gmail_auth = GmailAuth(account=account)
         if gmail_auth.authenticate():
             return gmail_auth
         else:
@@ -105,3 +372,57 @@ def gmail_authenticate_service():
     except Exception as e:
         print(f"Failed to create Gmail authentication service: {e}")
         return None
+
+
+def refresh_gmail_token(token):
+    """
+    Refresh callback for the TokenManager
+
+    Not tied to a GmailAuth instance, so the process-wide TokenManager keeps
+    working after the instance that created it is evicted; live instances
+    pick the new token up in _sync_creds(). Raises TokenRevoked if Google
+    rejects the refresh token.
+    """
+    # Credentials.to_json() stores the scopes the token was issued for
+    creds = Credentials.from_authorized_user_info(token['credentials'], token['credentials'].get('scopes') or SCOPES)
+    if not creds.refresh_token:
+        raise TokenRevoked("no refresh token")
+    try:
+        creds.refresh(Request())
+    except RefreshError as e:
+        if getattr(e, 'retryable', False):
+            print(f"Gmail token refresh failed: {e}")
+            return None
+        raise TokenRevoked(str(e))
+    except Exception as e:
+        print(f"Gmail token refresh failed: {e}")
+        return None
+    return _creds_to_token(creds)
+
+
+def _creds_to_token(creds):
+    """
+    Convert google Credentials to the TokenManager format
+    """
+    # Credentials.expiry is a naive UTC datetime
+    expires_at = calendar.timegm(creds.expiry.timetuple()) if creds.expiry else time.time() + 3600
+    return {
+        'credentials': json.loads(creds.to_json()),
+        'expires_at': expires_at
+    }
+
+
+def _is_transient(exception):
+    """
+    True for HTTP errors worth retrying (rate limiting or server side)
+    """
+    if isinstance(exception, HttpError):
+        return exception.resp.status == 429 or exception.resp.status >= 500
+    return False
+
+
+def _error_class(exception):
+    """Metrics label for a failed call inside a batch"""
+    if isinstance(exception, HttpError):
+        return error_class(exception.resp.status)
+    return error_class(error=exception)
@@ -5,14 +5,55 @@ REAL IMPLEMENTATION - NOT A DEMO
 """
 
 import os
+import sys
 import json
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 import base64
 import webbrowser
 import threading
+import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlencode, parse_qs, urlparse
-from datetime import datetime, timedelta
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'email'))
+
+from token_manager import get_token_manager, TokenRevoked
+from metrics import get_metrics, error_class
+from mime_stream import mime_message, base64_stream
+
+# Microsoft Graph JSON batching accepts at most 20 requests per $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Seconds to wait for a connection or for the next bytes of a response, on every request
+HTTP_TIMEOUT = 30
+
+# Required scopes for sending email
+SCOPES = ["https://graph.microsoft.com/Mail.Send"]
+
+# Scopes of the separate token used for SMTP XOAUTH2 (a Graph token is not accepted there)
+SMTP_SCOPES = ["https://outlook.office.com/SMTP.Send", "offline_access"]
+
+
+def authority_url(tenant_id=None):
+    """Microsoft identity platform authority for tenant_id (default: AZURE_TENANT_ID or 'common')"""
+    return f"https://login.microsoftonline.com/{tenant_id or os.getenv('AZURE_TENANT_ID', 'common')}"
+
+
+def token_endpoint(tenant_id=None):
+    """OAuth2 token endpoint, used for code exchange and refresh alike"""
+    return f"{authority_url(tenant_id)}/oauth2/v2.0/token"
+
+
+def _not_sent(error):
+    """True if requests failed before anything was written (no connection could be opened)"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
 
 class AuthCallbackHandler(BaseHTTPRequestHandler):
@@ -54,29 +95,77 @@ class OutlookGraphAuth:
     Implements full OAuth2 flow with actual Microsoft endpoints
     """
     
-    def __init__(self):
+    def __init__(self, pool_size=None, session=None, account=None, scopes=None, token_prefix='outlook'):
         # Azure App Registration details - MUST be configured
         self.client_id = os.getenv('AZURE_CLIENT_ID', '')
         self.client_secret = os.getenv('AZURE_CLIENT_SECRET', '')
         self.tenant_id = os.getenv('AZURE_TENANT_ID', 'common')
         
         # OAuth2 endpoints
-        self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
+        self.authority = authority_url(self.tenant_id)
         self.authorize_url = f"{self.authority}/oauth2/v2.0/authorize"
-        self.token_url = f"{self.authority}/oauth2/v2.0/token"
+        self.token_url = token_endpoint(self.tenant_id)
         
         # Microsoft Graph API
-        self.graph_api_url = "https://graph.microsoft.com/v1.0"
+        self.graph_api_url = os.getenv('GRAPH_API_URL', "https://graph.microsoft.com/v1.0")
         
         # Required scopes for sending email
-        self.scopes = ["https://graph.microsoft.com/Mail.Send"]
+        self.scopes = list(scopes or SCOPES)
         
-        # Token storage
-        self.access_token = None
-        self.refresh_token = None
-        self.token_expires = None
+        # Token storage, shared by every instance for the same account
+        self.account = account or 'default'
+        self.token_manager = get_token_manager(f"{token_prefix}:{self.account}", refresh_outlook_token)
         self.redirect_uri = "http://localhost:8080/callback"
         
+        # Pooled keep-alive connections to login.microsoftonline.com and graph.microsoft.com
+        if pool_size is None:
+            pool_size = int(os.getenv('OUTLOOK_POOL_SIZE', '10'))
+        self.pool_size = pool_size
+        self.session = session if session is not None else self.create_session(pool_size)
+        self._local = threading.local()
+        
+    @staticmethod
+    def create_session(pool_size):
+        """
+        Create a requests.Session whose connection pool fits `pool_size` concurrent senders
+
+        The pool does not block: a request beyond `pool_size` opens an extra
+        connection (closed after use) instead of waiting, without a time limit,
+        for one to be returned. The scheduler already caps concurrent sends.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    
+    def close(self):
+        """
+        Close pooled connections
+        """
+        self.session.close()
+    
+    def is_healthy(self):
+        """
+        True while a valid (or refreshable) token is available
+        """
+        return self.token_manager.get_token() is not None
+    
+    @property
+    def access_token(self):
+        token = self.token_manager.token
+        return token.get('access_token') if token else None
+    
+    @property
+    def refresh_token(self):
+        token = self.token_manager.token
+        return token.get('refresh_token') if token else None
+    
+    @property
+    def token_expires(self):
+        token = self.token_manager.token
+        return datetime.fromtimestamp(token['expires_at']) if token and token.get('expires_at') else None
+    
     def authenticate(self):
         """
         Microsoft Graph authentication
@@ -85,6 +174,11 @@ class OutlookGraphAuth:
             print("Azure credentials are required. Set environment variables:")
             return False
         
+        # Reuse a cached token (refreshing it if needed) before asking the user to log in
+        if self.token_manager.get_token() is not None:
+            print("Using cached Microsoft Graph token")
+            return True
+        
         try:
             
             # Step 1: Get authorization URL
@@ -154,17 +248,12 @@ class OutlookGraphAuth:
                 'scope': ' '.join(self.scopes)
             }
             
-            response = requests.post(self.token_url, data=data)
+            response = self.session.post(self.token_url, data=data, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             
             token_data = response.json()
             
-            self.access_token = token_data.get('access_token')
-            self.refresh_token = token_data.get('refresh_token')
-            
-            # Calculate expiration time
-            expires_in = token_data.get('expires_in', 3600)
-            self.token_expires = datetime.now() + timedelta(seconds=expires_in)
+            self.token_manager.set_token(self._token_from_response(token_data, scopes=self.scopes))
             
             print("Successfully obtained access tokens")
             return True
@@ -176,60 +265,41 @@ class OutlookGraphAuth:
             print(f"Unexpected error during token exchange: {e}")
             return False
     
+    @staticmethod
+    def _token_from_response(token_data, previous=None, scopes=None):
+        """
+        Convert a token endpoint response to the TokenManager format
+
+        The scopes are kept with the token so a refresh asks for the same ones.
+        """
+        # Calculate expiration time
+        expires_in = token_data.get('expires_in', 3600)
+        refresh_token = token_data.get('refresh_token')
+        if refresh_token is None and previous:
+            refresh_token = previous.get('refresh_token')
+        if scopes is None and previous:
+            scopes = previous.get('scopes')
+        return {
+            'access_token': token_data.get('access_token'),
+            'refresh_token': refresh_token,
+            'expires_at': time.time() + int(expires_in),
+            'scopes': scopes or SCOPES
+        }
+    
     def refresh_access_token(self):
         """
-        Refresh access token using refresh token
+        Refresh access token using refresh token (one refresh for all concurrent callers)
         """
-        if not self.refresh_token:
-            print("No refresh token available")
-            return False
-        
-        try:
-            data = {
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'refresh_token': self.refresh_token,
-                'grant_type': 'refresh_token',
-                'scope': ' '.join(self.scopes)
-            }
-            
-            response = requests.post(self.token_url, data=data)
-            response.raise_for_status()
-            
-            token_data = response.json()
-            
-            self.access_token = token_data.get('access_token')
-            # Update refresh token if provided
-            if 'refresh_token' in token_data:
-                self.refresh_token = token_data['refresh_token']
-            
-            # Calculate expiration time
-            expires_in = token_data.get('expires_in', 3600)
-            self.token_expires = datetime.now() + timedelta(seconds=expires_in)
-            
-            print("Successfully refreshed access token")
-            return True
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Token refresh failed: {e}")
-            return False
-        except Exception as e:
-            print(f"Unexpected error during token refresh: {e}")
-            return False
+        return self.token_manager.refresh() is not None
     
     def is_token_valid(self):
         """
-        Check if current access token is valid
+        Check if current access token is valid (5 minute buffer before expiration)
         
         Returns:
             bool: True if valid, False otherwise
         """
-        if not self.access_token or not self.token_expires:
-            return False
-        
-        # Add 5 minute buffer before expiration
-        buffer_time = timedelta(minutes=5)
-        return datetime.now() < (self.token_expires - buffer_time)
+        return self.token_manager.is_valid()
     
     def get_headers(self):
         """
@@ -238,25 +308,21 @@ class OutlookGraphAuth:
         Returns:
             dict: Headers with Bearer token
         """
-        if not self.is_token_valid():
-            if not self.refresh_access_token():
-                return None
+        token = self.token_manager.get_token()
+        if token is None:
+            return None
         
         return {
-            'Authorization': f'Bearer {self.access_token}',
+            'Authorization': f'Bearer {token["access_token"]}',
             'Content-Type': 'application/json'
         }
     
-    def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
-        # Ensure we're authenticated
-
-        headers = self.get_headers()
-        if not headers:
-            print("Failed to get valid authorization headers")
-            return False
-        
-        # Construct email message according to Microsoft Graph API
-        message = {
+    @staticmethod
+    def build_message(recipient_email, recipient_name, subject, html_body):
+        """
+        Build the /me/sendMail request body
+        """
+        return {
             "message": {
                 "subject": subject,
                 "body": {
@@ -274,31 +340,289 @@ class OutlookGraphAuth:
             },
             "saveToSentItems": True
         }
+    
+    @property
+    def last_status(self):
+        """
+        HTTP status of the calling thread's last send_email() (None if no response)
+        """
+        return getattr(self._local, 'last_status', None)
+    
+    def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        # Ensure we're authenticated
+        self._local.last_status = None
+
+        headers = self.get_headers()
+        if not headers:
+            # Nothing was sent: report it like Graph would, not as a missing response
+            self._local.last_status = 401
+            print("Failed to get valid authorization headers")
+            return False
+        
+        # Construct email message according to Microsoft Graph API
+        message = self.build_message(recipient_email, recipient_name, subject, html_body)
         
+        metrics = get_metrics()
         try:
             # Use Microsoft Graph sendMail endpoint
             send_url = f"{self.graph_api_url}/me/sendMail"
-            response = requests.post(send_url, headers=headers, json=message)
+            with metrics.span('http_send', provider='outlook'):
+                response = self.session.post(send_url, headers=headers, json=message, timeout=HTTP_TIMEOUT)
+            self._local.last_status = response.status_code
             
             if response.status_code == 202:
+                metrics.inc('messages_sent_total', provider='outlook')
+                metrics.inc('bytes_sent_total', len(response.request.body or b''), provider='outlook')
                 print(f"Email sent successfully to {recipient_email}")
                 return True
             else:
+                metrics.inc('messages_failed_total', provider='outlook',
+                            error=error_class(response.status_code))
                 print(f"Failed to send email. Status: {response.status_code}")
                 print(f"Response: {response.text}")
                 return False
                 
         except Exception as e:
+            if _not_sent(e):
+                # No connection was opened; safe to retry like a 503
+                self._local.last_status = 503
+            metrics.inc('messages_failed_total', provider='outlook', error=error_class(error=e))
             print(f"Unexpected error sending email: {e}")
             return False
+    
+    def send_email_stream(self, sender_email, recipient_email, recipient_name, subject, html_chunks):
+        """
+        Send a streamed HTML body (text chunks) without building it in memory
+        
+        The message goes to /me/sendMail in MIME format (base64 text/plain
+        body), uploaded with chunked transfer encoding while it is encoded.
+        A consumed stream cannot be replayed, so failures are not retried here.
+        """
+        self._local.last_status = None
+        
+        headers = self.get_headers()
+        if not headers:
+            # Nothing was sent: report it like Graph would, not as a missing response
+            self._local.last_status = 401
+            print("Failed to get valid authorization headers")
+            return False
+        headers['Content-Type'] = 'text/plain'
+        
+        metrics = get_metrics()
+        sent_bytes = [0]
+        
+        def body():
+            mime = mime_message(sender_email, recipient_email, recipient_name, subject, html_chunks)
+            for chunk in base64_stream(mime):
+                sent_bytes[0] += len(chunk)
+                yield chunk
+        
+        try:
+            with metrics.span('http_send', provider='outlook'):
+                response = self.session.post(f"{self.graph_api_url}/me/sendMail", headers=headers, data=body(),
+                                             timeout=HTTP_TIMEOUT)
+            self._local.last_status = response.status_code
+            
+            if response.status_code == 202:
+                metrics.inc('messages_sent_total', provider='outlook')
+                metrics.inc('bytes_sent_total', sent_bytes[0], provider='outlook')
+                print(f"Email sent successfully to {recipient_email}")
+                return True
+            metrics.inc('messages_failed_total', provider='outlook', error=error_class(response.status_code))
+            print(f"Failed to send email. Status: {response.status_code}")
+            print(f"Response: {response.text}")
+            return False
+        
+        except Exception as e:
+            if _not_sent(e):
+                # No connection was opened; safe to retry like a 503
+                self._local.last_status = 503
+            metrics.inc('messages_failed_total', provider='outlook', error=error_class(error=e))
+            print(f"Unexpected error sending email: {e}")
+            return False
+    
+    def send_batch(self, messages, max_retries=3):
+        """
+        Send many messages through the Graph $batch endpoint (20 per HTTP call)
+        
+        Args:
+            messages: list of dicts with the send_email() keyword arguments
+                (recipient_email, recipient_name, subject, html_body)
+            max_retries: rounds of retries for items throttled (429) or hit by a 5xx
+        
+        Returns:
+            (failed, uncertain): the messages that were not sent, for re-queueing,
+            and those whose outcome is unknown (the request went out but no
+            answer came back; they are not resent, as they may have been delivered)
+        """
+        metrics = get_metrics()
+        pending = list(messages)
+        failed = []
+        uncertain = []
+        
+        for attempt in range(max_retries + 1):
+            retry = []
+            retry_after = 0
+            
+            for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+                chunk = pending[start:start + GRAPH_BATCH_LIMIT]
+                for message, status, wait in self._post_batch(chunk):
+                    if status == 202:
+                        metrics.inc('messages_sent_total', provider='outlook')
+                        continue
+                    if status is None:
+                        metrics.inc('messages_failed_total', provider='outlook', error='uncertain')
+                        print(f"No answer for the email to {message.get('recipient_email')}; not resending it")
+                        uncertain.append(message)
+                        continue
+                    if (status == 429 or status >= 500) and attempt < max_retries:
+                        metrics.inc('retries_total', stage='batch', error=error_class(status))
+                        retry.append(message)
+                        retry_after = max(retry_after, wait)
+                    else:
+                        metrics.inc('messages_failed_total', provider='outlook', error=error_class(status))
+                        print(f"Failed to send email to {message.get('recipient_email')}. Status: {status}")
+                        failed.append(message)
+            
+            if not retry:
+                break
+            # Honour Retry-After, falling back to exponential backoff
+            delay = retry_after or 2 ** attempt
+            print(f"{len(retry)} messages throttled, retrying in {delay} seconds")
+            with metrics.span('retry_wait', provider='outlook'):
+                time.sleep(delay)
+            pending = retry
+        
+        print(f"Batch send finished: {len(messages) - len(failed) - len(uncertain)} sent, "
+              f"{len(failed)} failed, {len(uncertain)} uncertain")
+        return failed, uncertain
+    
+    def _post_batch(self, chunk):
+        """
+        POST one $batch request
+        
+        Returns:
+            list of (message, status_code, retry_after_seconds) per item;
+            status_code is None if the item's outcome is unknown
+        """
+        headers = self.get_headers()
+        if not headers:
+            print("Failed to get valid authorization headers")
+            return [(message, 401, 0) for message in chunk]
+        
+        body = {
+            "requests": [
+                {
+                    "id": str(index),
+                    "method": "POST",
+                    "url": "/me/sendMail",
+                    "headers": {"Content-Type": "application/json"},
+                    "body": self.build_message(
+                        message['recipient_email'],
+                        message.get('recipient_name', ''),
+                        message['subject'],
+                        message['html_body']
+                    )
+                }
+                for index, message in enumerate(chunk)
+            ]
+        }
+        
+        try:
+            with get_metrics().span('http_send', provider='outlook_batch'):
+                response = self.session.post(f"{self.graph_api_url}/$batch", headers=headers, json=body,
+                                             timeout=HTTP_TIMEOUT)
+            get_metrics().inc('bytes_sent_total', len(response.request.body or b''), provider='outlook')
+        except requests.exceptions.RequestException as e:
+            print(f"Batch request failed: {e}")
+            if _not_sent(e):
+                return [(message, 503, 0) for message in chunk]
+            # The batch may have reached Graph (e.g. a read timeout): do not resend it
+            return [(message, None, 0) for message in chunk]
+        
+        if response.status_code != 200:
+            # The whole batch was rejected
+            wait = _retry_after(response.headers)
+            print(f"Batch request failed. Status: {response.status_code}")
+            return [(message, response.status_code, wait) for message in chunk]
+        
+        results = {}
+        for item in response.json().get('responses', []):
+            results[item.get('id')] = (item.get('status', 500), _retry_after(item.get('headers') or {}))
+        
+        # An item missing from the responses may or may not have been sent
+        return [
+            (message, *results.get(str(index), (None, 0)))
+            for index, message in enumerate(chunk)
+        ]
+
+
+# Keep-alive connections to the token endpoint, shared by every account's refreshes
+_token_session = None
+_token_session_lock = threading.Lock()
+
+
+def _get_token_session():
+    global _token_session
+    with _token_session_lock:
+        if _token_session is None:
+            _token_session = OutlookGraphAuth.create_session(2)
+        return _token_session
 
 
-def outlook_authenticate():
+def refresh_outlook_token(token):
+    """
+    Refresh callback for the TokenManager: exchange the refresh token
+
+    Not tied to an OutlookGraphAuth instance, so the process-wide TokenManager
+    keeps working after the instance that created it is evicted. Raises
+    TokenRevoked if Microsoft rejects the refresh token (invalid_grant).
+    """
+    if not token.get('refresh_token'):
+        raise TokenRevoked("no refresh token")
+
+    try:
+        data = {
+            'client_id': os.getenv('AZURE_CLIENT_ID', ''),
+            'client_secret': os.getenv('AZURE_CLIENT_SECRET', ''),
+            'refresh_token': token['refresh_token'],
+            'grant_type': 'refresh_token',
+            'scope': ' '.join(token.get('scopes') or SCOPES)
+        }
+
+        response = _get_token_session().post(token_endpoint(), data=data, timeout=HTTP_TIMEOUT)
+        if response.status_code == 400 and _oauth_error(response) == 'invalid_grant':
+            raise TokenRevoked("refresh token rejected (invalid_grant)")
+        response.raise_for_status()
+
+        print("Successfully refreshed access token")
+        # Update refresh token if provided
+        return OutlookGraphAuth._token_from_response(response.json(), previous=token)
+
+    except requests.exceptions.RequestException as e:
+        print(f"Token refresh failed: {e}")
+        return None
+    except TokenRevoked:
+        raise
+    except Exception as e:
+        print(f"Unexpected error during token refresh: {e}")
+        return None
+
+
+def _oauth_error(response):
+    """The OAuth2 'error' code of a token endpoint error response"""
+    try:
+        return response.json().get('error')
+    except ValueError:
+        return None
+
+
+def outlook_authenticate(pool_size=None, account=None):
     """
     Factory function to create Outlook authentication service
     """
     try:
-        outlook_auth = OutlookGraphAuth()
+        outlook_auth = OutlookGraphAuth(pool_size=pool_size, account=account)
         if outlook_auth.authenticate():
             return outlook_auth
         else:
@@ -306,4 +630,17 @@ def outlook_authenticate():
         
     except Exception as e:
         print(f"Failed to create Outlook authentication service: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def _retry_after(headers):
+    """
+    Seconds to wait from a Retry-After header (0 if absent or not a number)
+    """
+    for key, value in headers.items():
+        if key.lower() == 'retry-after':
+            try:
+                return max(0, int(value))
+            except (TypeError, ValueError):
+                return 0
+    return 0
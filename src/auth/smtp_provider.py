@@ -0,0 +1,402 @@
+"""
+SMTP send service with a pool of persistent, authenticated connections
+
+Used for senders whose domain is neither Outlook nor Gmail when SMTP_HOST is
+set. Connections use STARTTLS (implicit TLS on port 465), log in once with a
+password or XOAUTH2, and are reused across send_email() calls. A connection
+that has been idle for a while is checked with NOOP before it is reused. If a
+reused connection still turns out to be dropped before the server accepted
+MAIL FROM, the message is tried once more on a new one; after that point the
+message may already be delivered, so it is never resent automatically.
+
+    SMTP_HOST, SMTP_PORT (587)
+    SMTP_USERNAME (default: the sender address), SMTP_PASSWORD
+    SMTP_AUTH: password or xoauth2 (default: password if SMTP_PASSWORD is set)
+    SMTP_OAUTH_PROVIDER: outlook or gmail, whose login issues the XOAUTH2 token
+    SMTP_POOL_SIZE (4): connections per sender account
+    SMTP_STARTTLS=0: plain connection (local relays and test servers only)
+"""
+
+import os
+import ssl
+import sys
+import time
+import smtplib
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'email'))
+
+from token_manager import get_token_manager
+from metrics import get_metrics, error_class
+from mime_stream import get_mime_builder
+
+OUTLOOK = 'outlook'
+GMAIL = 'gmail'
+
+PASSWORD = 'password'
+XOAUTH2 = 'xoauth2'
+
+# Seconds an idle connection is kept; servers drop idle sessions after a few minutes
+MAX_IDLE = 60
+
+# Idle seconds after which a pooled connection is checked with NOOP before reuse
+CHECK_IDLE = 5
+
+
+def _token_key(provider, account):
+    """
+    Token cache key of the SMTP token; kept apart from the API client's token
+    (e.g. "outlook:<account>"), whose Graph/Gmail API scopes SMTP rejects
+    """
+    return f"smtp-{provider}:{account}"
+
+
+def _outlook_refresh(token):
+    from outlook_azure import refresh_outlook_token
+
+    return refresh_outlook_token(token)
+
+
+def _gmail_refresh(token):
+    from google_oauth2 import refresh_gmail_token
+
+    return refresh_gmail_token(token)
+
+
+def _outlook_login(account):
+    """Browser login asking for the SMTP.Send scope; True once the token is cached"""
+    from outlook_azure import OutlookGraphAuth, SMTP_SCOPES
+
+    outlook = OutlookGraphAuth(account=account, scopes=SMTP_SCOPES, token_prefix=f"smtp-{OUTLOOK}")
+    try:
+        return outlook.authenticate()
+    finally:
+        outlook.close()
+
+
+def _gmail_login(account):
+    """Browser login asking for the https://mail.google.com/ scope; True once the token is cached"""
+    from google_oauth2 import GmailAuth, SMTP_SCOPES
+
+    return GmailAuth(account=account, scopes=SMTP_SCOPES, token_prefix=f"smtp-{GMAIL}").authenticate()
+
+
+# provider -> (TokenManager refresh callback, interactive login, access token from a token dict)
+OAUTH_PROVIDERS = {
+    OUTLOOK: (_outlook_refresh, _outlook_login, lambda token: token['access_token']),
+    GMAIL: (_gmail_refresh, _gmail_login, lambda token: token['credentials']['token']),
+}
+
+
+def _guess_oauth_provider(host):
+    host = host.lower()
+    if 'gmail' in host or 'google' in host:
+        return GMAIL
+    return OUTLOOK
+
+
+def _status(code):
+    """
+    HTTP-style status for an SMTP error reply, so the send queue and scheduler
+    treat it like the other providers: transient 4xx -> 503, permanent 5xx -> 400
+    """
+    return 503 if code < 500 else 400
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+
+def _alive(smtp):
+    """True if the connection answers NOOP"""
+    try:
+        return smtp.noop()[0] == 250
+    except Exception:
+        return False
+
+
+def _reset(smtp):
+    """End a refused mail transaction (RSET); False if the connection is unusable"""
+    try:
+        return smtp.rset()[0] == 250
+    except Exception:
+        return False
+
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of logged-in smtplib connections
+
+    Args:
+        connect: callable() -> new logged-in smtplib.SMTP
+        max_size: connections open at most (acquire() blocks beyond that)
+        max_idle: seconds an idle connection may be reused
+        check_idle: idle seconds after which a connection must answer NOOP
+            before it is reused (0 checks every time)
+    """
+
+    def __init__(self, connect, max_size=4, max_idle=MAX_IDLE, check_idle=CHECK_IDLE):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # [(smtp, last_used)], most recently used last
+        self._idle = []
+
+    def acquire(self):
+        """
+        Return (smtp, reused): an idle connection, or a new one if none is usable
+        """
+        self._slots.acquire()
+        try:
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    smtp, last_used = self._idle.pop()
+                idle = now - last_used
+                if idle <= self.max_idle and (idle < self.check_idle or _alive(smtp)):
+                    return smtp, True
+                _quit(smtp)
+            return self.connect(), False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, smtp, reuse=True):
+        """Return a connection to the pool, or close it if it cannot be reused"""
+        try:
+            if reuse:
+                with self._lock:
+                    self._idle.append((smtp, time.monotonic()))
+            else:
+                _quit(smtp)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close the idle connections (connections in use are closed on release)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            _quit(smtp)
+
+
+class SMTPService:
+    """
+    send_email() over pooled SMTP connections (same contract as OutlookGraphAuth)
+
+    Args:
+        account: sender address; also the login name unless SMTP_USERNAME is set
+        host, port, username, password, auth_method, oauth_provider, pool_size, starttls:
+            override the SMTP_* environment variables
+    """
+
+    def __init__(self, account=None, host=None, port=None, username=None, password=None,
+                 auth_method=None, oauth_provider=None, pool_size=None, starttls=None, timeout=30):
+        self.account = account or 'default'
+        self.host = host or os.getenv('SMTP_HOST', '')
+        self.port = int(port or os.getenv('SMTP_PORT', '587'))
+        self.username = username or os.getenv('SMTP_USERNAME') or account
+        self.password = password if password is not None else os.getenv('SMTP_PASSWORD', '')
+        self.auth_method = (auth_method or os.getenv('SMTP_AUTH')
+                            or (PASSWORD if self.password else XOAUTH2)).lower()
+        if starttls is None:
+            starttls = os.getenv('SMTP_STARTTLS', '1') != '0'
+        self.starttls = starttls
+        self.timeout = timeout
+
+        self.token_manager = None
+        if self.auth_method == XOAUTH2:
+            self.oauth_provider = (oauth_provider or os.getenv('SMTP_OAUTH_PROVIDER')
+                                   or _guess_oauth_provider(self.host)).lower()
+            refresh, _, _ = OAUTH_PROVIDERS[self.oauth_provider]
+            self.token_manager = get_token_manager(_token_key(self.oauth_provider, self.account), refresh)
+
+        if pool_size is None:
+            pool_size = int(os.getenv('SMTP_POOL_SIZE', '4'))
+        self.pool = SMTPConnectionPool(self.connect, max_size=pool_size)
+        self._local = threading.local()
+
+    def connect(self):
+        """Open, secure and log in one SMTP connection"""
+        context = ssl.create_default_context()
+        if self.port == 465:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=context)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.port != 465 and self.starttls:
+                smtp.starttls(context=context)
+                smtp.ehlo()
+            self._login(smtp)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    def _login(self, smtp):
+        if self.auth_method == XOAUTH2:
+            token = self.token_manager.get_token()
+            if token is None:
+                raise smtplib.SMTPAuthenticationError(
+                    535, f"No {self.oauth_provider} SMTP token for {self.account}; authenticate() logs in")
+            _, _, access_token = OAUTH_PROVIDERS[self.oauth_provider]
+            auth_string = f"user={self.username}\x01auth=Bearer {access_token(token)}\x01\x01"
+            # Sent as the initial response; an error challenge is answered with an empty line
+            smtp.auth('XOAUTH2', lambda challenge=None: auth_string if challenge is None else '')
+        elif self.password:
+            smtp.login(self.username, self.password)
+
+    def close(self):
+        """Close pooled connections"""
+        self.pool.close()
+
+    def is_healthy(self):
+        """True if a pooled (or new) connection answers NOOP"""
+        try:
+            smtp, _ = self.pool.acquire()
+        except Exception as e:
+            print(f"SMTP connection failed: {e}")
+            return False
+        healthy = _alive(smtp)
+        self.pool.release(smtp, reuse=healthy)
+        return healthy
+
+    def authenticate(self):
+        """
+        Open the first pooled connection (checks host and credentials)
+
+        With XOAUTH2 and no cached SMTP token, the provider's browser login
+        runs first, asking for the SMTP scope.
+        """
+        if not self.host:
+            print("SMTP_HOST is not set")
+            return False
+        if self.token_manager is not None and self.token_manager.get_token() is None:
+            _, login, _ = OAUTH_PROVIDERS[self.oauth_provider]
+            print(f"Logging in to {self.oauth_provider} for SMTP as {self.account}")
+            if not login(self.account):
+                print("SMTP OAuth login failed")
+                return False
+        try:
+            smtp, _ = self.pool.acquire()
+        except smtplib.SMTPAuthenticationError as e:
+            print(f"SMTP login failed: {e}")
+            return False
+        except Exception as e:
+            print(f"SMTP connection failed: {e}")
+            return False
+        self.pool.release(smtp)
+        return True
+
+    @property
+    def last_status(self):
+        """
+        HTTP-style status of the calling thread's last send_email() (None if no reply)
+        """
+        return getattr(self._local, 'last_status', None)
+
+    def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        self._local.last_status = None
+        message = get_mime_builder().build(sender_email, recipient_email, recipient_name, subject, html_body)
+        message = message.replace(b'\n', b'\r\n')
+        metrics = get_metrics()
+
+        # A reused connection may have been closed by the server; retry once on a new
+        # one, but only while the server has not accepted MAIL FROM (nothing sent yet)
+        for attempt in range(2):
+            try:
+                smtp, reused = self.pool.acquire()
+            except Exception as e:
+                # Nothing was sent: a refused login (or missing token) keeps its reply
+                # code, anything else (e.g. no connection) is transient
+                code = getattr(e, 'smtp_code', None)
+                self._local.last_status = _status(code) if isinstance(code, int) else 503
+                metrics.inc('messages_failed_total', provider='smtp', error=error_class(error=e))
+                print(f"SMTP connection failed: {e}")
+                return False
+
+            reuse = True
+            mail_accepted = False
+            try:
+                options = ['BODY=8BITMIME'] if not message.isascii() and smtp.has_extn('8bitmime') else []
+                with metrics.span('http_send', provider='smtp'):
+                    # smtplib's sendmail(), split up to know whether MAIL FROM was accepted
+                    smtp.ehlo_or_helo_if_needed()
+                    code, reply = smtp.mail(sender_email, options)
+                    if code != 250:
+                        raise smtplib.SMTPSenderRefused(code, reply, sender_email)
+                    mail_accepted = True
+                    code, reply = smtp.rcpt(recipient_email)
+                    if code not in (250, 251):
+                        raise smtplib.SMTPRecipientsRefused({recipient_email: (code, reply)})
+                    code, reply = smtp.data(message)
+                    if code != 250:
+                        raise smtplib.SMTPDataError(code, reply)
+            except smtplib.SMTPRecipientsRefused as e:
+                code = next(iter(e.recipients.values()))[0]
+                reuse = _reset(smtp)
+                self._local.last_status = _status(code)
+                metrics.inc('messages_failed_total', provider='smtp', error=error_class(_status(code)))
+                print(f"Failed to send email to {recipient_email}. SMTP reply: {code}")
+                return False
+            except smtplib.SMTPResponseException as e:
+                reuse = e.smtp_code != 421 and _reset(smtp)
+                if e.smtp_code == 421 and not mail_accepted and attempt == 0:
+                    metrics.inc('retries_total', stage='smtp', error='smtp_421')
+                    continue
+                self._local.last_status = _status(e.smtp_code)
+                metrics.inc('messages_failed_total', provider='smtp', error=error_class(_status(e.smtp_code)))
+                print(f"Failed to send email to {recipient_email}. SMTP reply: {e.smtp_code} {e.smtp_error!r}")
+                return False
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+                reuse = False
+                if reused and not mail_accepted and attempt == 0:
+                    metrics.inc('retries_total', stage='smtp', error=type(e).__name__)
+                    continue
+                metrics.inc('messages_failed_total', provider='smtp', error=error_class(error=e))
+                if mail_accepted:
+                    # last_status stays None: the message may have been delivered
+                    print(f"SMTP connection lost while sending to {recipient_email} "
+                          f"(the message may have been delivered): {e}")
+                else:
+                    self._local.last_status = 503
+                    print(f"SMTP connection lost while sending to {recipient_email}: {e}")
+                return False
+            except Exception as e:
+                reuse = False
+                metrics.inc('messages_failed_total', provider='smtp', error=error_class(error=e))
+                print(f"Unexpected error sending email: {e}")
+                return False
+            finally:
+                self.pool.release(smtp, reuse)
+
+            self._local.last_status = 200
+            metrics.inc('messages_sent_total', provider='smtp')
+            metrics.inc('bytes_sent_total', len(message), provider='smtp')
+            print(f"Email sent successfully to {recipient_email}")
+            return True
+        return False
+
+
+def smtp_authenticate(account=None):
+    """
+    Factory function to create the SMTP send service
+    """
+    try:
+        smtp_service = SMTPService(account=account)
+        if smtp_service.authenticate():
+            return smtp_service
+        return None
+    except Exception as e:
+        print(f"Failed to create SMTP service: {e}")
+        return None
@@ -0,0 +1,236 @@
+"""
+Shared OAuth2 token handling for the Outlook and Gmail providers
+
+A TokenManager owns the token of one account: concurrent callers share a
+single refresh (single-flight), a background timer refreshes ahead of the
+expiry buffer, and every new token is written to an on-disk cache keyed by
+account so later processes can skip the interactive login.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+TOKEN_CACHE_PATH = os.getenv(
+    'MAIL_TEMPLATE_TOKEN_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'mail_template', 'tokens.json')
+)
+
+# Tokens count as expired this many seconds before their real expiry
+EXPIRY_BUFFER = 5 * 60
+# Background refresh starts this many seconds before the buffer is reached
+REFRESH_LEAD = 60
+
+
+class TokenRevoked(Exception):
+    """
+    Raised by a refresh callback when the refresh token can no longer be used
+    (revoked, expired or missing); the manager then forgets the cached token
+    """
+
+
+class TokenCache:
+    """
+    JSON file mapping account -> token dict, rewritten atomically
+    """
+
+    def __init__(self, path=TOKEN_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            print(f"[DEBUG] JSON Error in file: {self.path}")
+            print(f"[DEBUG] {e}")
+            return {}
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temp file in the same directory, then rename over the cache
+        fd, tmp_path = tempfile.mkstemp(prefix='.tokens-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load(self, account):
+        with self._lock:
+            return self._read().get(account)
+
+    def store(self, account, token):
+        with self._lock:
+            data = self._read()
+            data[account] = token
+            self._write(data)
+
+    def delete(self, account):
+        with self._lock:
+            data = self._read()
+            if data.pop(account, None) is not None:
+                self._write(data)
+
+
+class TokenManager:
+    """
+    Token of one account with single-flight and proactive refresh
+
+    Args:
+        account: cache key, e.g. "outlook:user@example.com"
+        refresh: callable(token) -> new token dict, or None on failure.
+            It raises TokenRevoked if the token can never be refreshed, so the
+            next caller logs in again instead of retrying the same refresh.
+            Token dicts are opaque except for 'expires_at' (epoch seconds).
+            The manager is shared process-wide and outlives any one service,
+            so this must not be a method of a service instance.
+        cache: TokenCache (None disables the on-disk cache)
+    """
+
+    def __init__(self, account, refresh, cache=None, buffer=EXPIRY_BUFFER,
+                 lead=REFRESH_LEAD, background=True):
+        self.account = account
+        self.refresh_func = refresh
+        self.cache = cache
+        self.buffer = buffer
+        self.lead = lead
+        self.background = background
+        self._lock = threading.Lock()
+        self._timer = None
+        self._token = cache.load(account) if cache is not None else None
+        self._schedule()
+
+    @property
+    def token(self):
+        return self._token
+
+    def is_valid(self, token=None):
+        """True if the token is not within `buffer` seconds of expiring"""
+        token = self._token if token is None else token
+        if not token or not token.get('expires_at'):
+            return False
+        return time.time() < token['expires_at'] - self.buffer
+
+    def set_token(self, token):
+        """Adopt a new token (e.g. from an interactive login) and persist it"""
+        with self._lock:
+            self._set(token)
+
+    def _set(self, token):
+        self._token = token
+        if self.cache is not None and token is not None:
+            try:
+                self.cache.store(self.account, token)
+            except OSError as e:
+                print(f"Failed to write token cache: {e}")
+        self._schedule()
+
+    def get_token(self):
+        """
+        Return a valid token, refreshing it if needed
+
+        Only one caller performs the refresh; the others wait for its result.
+        """
+        token = self._token
+        if self.is_valid(token):
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self.is_valid(self._token):
+                return self._token
+            return self._refresh()
+
+    def refresh(self):
+        """Force a refresh (single-flight) and return the new token or None"""
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        if self._token is None:
+            return None
+        try:
+            token = self.refresh_func(self._token)
+        except TokenRevoked as e:
+            print(f"Token for {self.account} can no longer be refreshed ({e}); a new login is needed")
+            self._clear()
+            return None
+        if token is None:
+            return None
+        self._set(token)
+        return token
+
+    def _clear(self):
+        self._token = None
+        if self.cache is not None:
+            try:
+                self.cache.delete(self.account)
+            except OSError as e:
+                print(f"Failed to write token cache: {e}")
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.background or not self._token or not self._token.get('expires_at'):
+            return
+        delay = self._token['expires_at'] - self.buffer - self.lead - time.time()
+        if delay <= 0:
+            return
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            expires_at = self._token.get('expires_at') if self._token else None
+            # Skip if a foreground refresh already replaced the token
+            if expires_at and time.time() >= expires_at - self.buffer - self.lead:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    print(f"Background token refresh failed: {e}")
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+_cache = None
+
+
+def get_token_cache():
+    """Return the shared on-disk token cache"""
+    global _cache
+    if _cache is None:
+        _cache = TokenCache()
+    return _cache
+
+
+def get_token_manager(account, refresh, **kwargs):
+    """
+    Return the process-wide TokenManager for account, creating it on first use
+    """
+    with _managers_lock:
+        manager = _managers.get(account)
+        if manager is None:
+            kwargs.setdefault('cache', get_token_cache())
+            manager = _managers[account] = TokenManager(account, refresh, **kwargs)
+        return manager
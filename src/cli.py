@@ -0,0 +1,104 @@
+"""
+Headless command line entry point, run from the repository
+
+    python src/cli.py render data.json --lang jp -o email.html
+    python src/cli.py send data.json --lang jp
+    python src/cli.py merge recipients.csv --lang jp --workers 4
+
+Nothing here imports PyQt6, and modules are imported inside the command that
+needs them: `render` never loads a provider client, and `send` only loads
+requests or the Google API client for the provider of the sender address.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+# Same module layout as main.py
+sys.path.append(os.path.join(os.path.dirname(__file__), 'script'))
+sys.path.append(os.path.join(os.path.dirname(__file__), 'type'))
+sys.path.append(os.path.join(os.path.dirname(__file__), 'email'))
+
+
+def load_data(path):
+    """Read the filled data JSON from a file, or from stdin for '-'"""
+    if path == '-':
+        return json.load(sys.stdin)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def render(args):
+    from substitute import template_from_dict
+
+    html_output = template_from_dict(args.lang, load_data(args.data))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(html_output)
+    else:
+        sys.stdout.write(html_output)
+    return 0
+
+
+def send(args):
+    from Message import Message
+
+    filled_data = load_data(args.data)
+    message = Message.from_dict(filled_data)
+    if args.stream:
+        from substitute import generate_from_dict
+        from send_email import send_email_stream
+
+        sent = send_email_stream(message, generate_from_dict(args.lang, filled_data), archive_dir=args.archive)
+    else:
+        from substitute import template_from_dict
+        from send_email import send_email
+
+        sent = send_email(message, template_from_dict(args.lang, filled_data), archive_dir=args.archive)
+    return 0 if sent else 1
+
+
+def merge(args):
+    import mail_merge
+
+    return mail_merge.main(args.args)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Render and send template emails")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    render_parser = commands.add_parser('render', help="Render one email to HTML")
+    render_parser.add_argument('data', help="Filled data JSON (same shape as settings/data.json), or - for stdin")
+    render_parser.add_argument('--lang', default='en', help="Language code")
+    render_parser.add_argument('-o', '--output', help="Write the HTML here instead of stdout")
+    render_parser.set_defaults(func=render)
+
+    send_parser = commands.add_parser('send', help="Render one email and send it")
+    send_parser.add_argument('data', help="Filled data JSON (same shape as settings/data.json), or - for stdin")
+    send_parser.add_argument('--lang', default='en', help="Language code")
+    send_parser.add_argument('--archive', help="Also write the HTML to this directory")
+    send_parser.add_argument('--stream', action='store_true',
+                             help="Encode and upload the body while rendering (for very large bodies)")
+    send_parser.set_defaults(func=send)
+
+    merge_parser = commands.add_parser('merge', add_help=False,
+                                       help="Mail merge a recipient file (see `merge --help`)")
+    merge_parser.add_argument('args', nargs=argparse.REMAINDER)
+    merge_parser.set_defaults(func=merge)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['merge']:
+        # Hand everything (including --help) to the mail_merge parser
+        args = argparse.Namespace(args=argv[1:])
+        return merge(args)
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""
+MIME encoding for our single-part text/html messages
+
+Streaming: a rendered body arrives as text chunks (TemplateRenderer.generate)
+and is turned into an RFC 822 message (headers + base64 HTML part) piece by
+piece, optionally copied to an archive file on the way. At no point is the
+whole message, or a second copy of the body, held in memory.
+
+MimeBuilder: builds complete messages (e.g. Gmail's base64url `raw`) for bulk
+sends without going through EmailMessage.
+"""
+
+import os
+import re
+import base64
+import threading
+import tempfile
+from email import policy
+from email.message import EmailMessage
+
+# Input bytes per base64 line: 57 bytes encode to one 76-character line
+LINE_BYTES = 57
+
+# Bytes encoded per step; a multiple of LINE_BYTES (and of 3)
+BLOCK_BYTES = LINE_BYTES * 1024
+
+# Characters of a large text chunk converted to UTF-8 at a time
+TEXT_SLICE = 64 * 1024
+
+# Size above which spooled messages move from memory to a temporary file
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def header_block(sender_email, recipient_email, recipient_name, subject):
+    """RFC 822 header block (ending with the blank line) for a base64 text/html message"""
+    message = EmailMessage(policy=policy.SMTP)
+    message['To'] = f'{recipient_name} <{recipient_email}>'
+    message['From'] = sender_email
+    message['Subject'] = subject
+    message['MIME-Version'] = '1.0'
+    message['Content-Type'] = 'text/html; charset="utf-8"'
+    message['Content-Transfer-Encoding'] = 'base64'
+    return message.as_bytes()
+
+
+def tee(chunks, path):
+    """Yield the text chunks unchanged while writing them to `path`"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+    print(f"HTML saved to: {path}")
+
+
+def utf8_chunks(chunks):
+    """Encode text chunks to UTF-8, slicing very large chunks"""
+    for chunk in chunks:
+        if len(chunk) <= TEXT_SLICE:
+            if chunk:
+                yield chunk.encode('utf-8')
+            continue
+        for start in range(0, len(chunk), TEXT_SLICE):
+            yield chunk[start:start + TEXT_SLICE].encode('utf-8')
+
+
+def _aligned(byte_chunks, size):
+    """Regroup a byte stream into blocks whose length is a multiple of `size` (last one excepted)"""
+    pending = bytearray()
+    for chunk in byte_chunks:
+        pending += chunk
+        if len(pending) >= BLOCK_BYTES:
+            cut = len(pending) - len(pending) % size
+            yield bytes(pending[:cut])
+            del pending[:cut]
+    if pending:
+        yield bytes(pending)
+
+
+def base64_lines(byte_chunks):
+    """MIME base64 body: 76-character CRLF-terminated lines"""
+    for block in _aligned(byte_chunks, LINE_BYTES):
+        encoded = base64.b64encode(block)
+        yield b''.join(encoded[start:start + 76] + b'\r\n' for start in range(0, len(encoded), 76))
+
+
+def base64_stream(byte_chunks):
+    """Plain base64 (no line breaks) of a byte stream"""
+    for block in _aligned(byte_chunks, 3):
+        yield base64.b64encode(block)
+
+
+def mime_message(sender_email, recipient_email, recipient_name, subject, html_chunks):
+    """Yield the complete RFC 822 message for streamed HTML text chunks"""
+    yield header_block(sender_email, recipient_email, recipient_name, subject)
+    yield from base64_lines(utf8_chunks(html_chunks))
+
+
+def spool(byte_chunks, max_memory=SPOOL_MAX_MEMORY):
+    """
+    Collect a byte stream in a file-like object (in memory up to max_memory,
+    then a temporary file); returns it rewound, with its size
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    size = 0
+    for chunk in byte_chunks:
+        spooled.write(chunk)
+        size += len(chunk)
+    spooled.seek(0)
+    return spooled, size
+
+
+# Display names, addresses and subjects that the stdlib writes out unchanged;
+# anything else (quoting, encoded words, folding) goes through EmailMessage
+_PLAIN_NAME = re.compile(r"[A-Za-z0-9!#-'*+\-/=?^-~]+(?: [A-Za-z0-9!#-'*+\-/=?^-~]+)*")
+_PLAIN_ADDRESS = re.compile(r"[A-Za-z0-9!#-'*+\-/=?^-~]+(?:\.[A-Za-z0-9!#-'*+\-/=?^-~]+)*@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*")
+_PLAIN_TEXT = re.compile(r'[!-~]+(?: [!-~]+)*')
+
+# A body line longer than this (the email policy's max_line_length) must be encoded
+_LONG_LINE = re.compile(rb'[^\r\n]{79}')
+
+# Headers longer than this are folded by the stdlib, so they take the slow path
+_MAX_HEADER_LINE = 78
+
+
+_CONTENT_BLOCKS = {
+    encoding: (f'Content-Type: text/html; charset="utf-8"\n'
+               f'Content-Transfer-Encoding: {encoding}\n'
+               'MIME-Version: 1.0\n\n').encode('ascii')
+    for encoding in ('7bit', '8bit', 'base64')
+}
+
+
+def _stdlib_header(name, value):
+    """One header formatted (encoded and folded) the way EmailMessage does it"""
+    message = EmailMessage(policy=policy.default)
+    message[name] = value
+    return message.as_bytes()[:-1]
+
+
+class MimeBuilder:
+    """
+    Fast builder for the fixed message shape sent through the Gmail API
+
+    Output matches EmailMessage.set_content(html, subtype='html') byte for
+    byte when the body has no line over 78 characters (7bit/8bit). Longer
+    lines are always base64-encoded in C, where the stdlib may choose its
+    pure-Python quoted-printable encoder. The From header is built once per
+    sender, and each thread assembles messages in one reusable bytearray
+    that is base64url-encoded in a single pass.
+
+    Args:
+        max_senders: sender header blocks kept before the cache is cleared
+    """
+
+    def __init__(self, max_senders=64):
+        self.max_senders = max_senders
+        self._senders = {}
+        self._local = threading.local()
+
+    def _sender_block(self, sender_email):
+        block = self._senders.get(sender_email)
+        if block is None:
+            block = _stdlib_header('From', sender_email)
+            if len(self._senders) >= self.max_senders:
+                self._senders.clear()
+            self._senders[sender_email] = block
+        return block
+
+    @staticmethod
+    def _to_header(recipient_email, recipient_name):
+        value = f'{recipient_name} <{recipient_email}>'
+        line = f'To: {value}\n'
+        if (len(line) <= _MAX_HEADER_LINE and _PLAIN_NAME.fullmatch(recipient_name)
+                and _PLAIN_ADDRESS.fullmatch(recipient_email)):
+            return line.encode('ascii')
+        return _stdlib_header('To', value)
+
+    @staticmethod
+    def _subject_header(subject):
+        line = f'Subject: {subject}\n'
+        if len(line) <= _MAX_HEADER_LINE and _PLAIN_TEXT.fullmatch(subject) and '=?' not in subject:
+            return line.encode('ascii')
+        return _stdlib_header('Subject', subject)
+
+    @staticmethod
+    def _body(html_body):
+        """(Content-Type/Content-Transfer-Encoding block, encoded body)"""
+        body = html_body.encode('utf-8')
+        # Same line ending normalisation as the stdlib: every line ends with a single \n
+        if b'\r' in body:
+            body = b'\n'.join(body.splitlines()) + b'\n'
+        elif not body.endswith(b'\n'):
+            body += b'\n'
+        if _LONG_LINE.search(body):
+            body, encoding = base64.encodebytes(body), 'base64'
+        else:
+            encoding = '7bit' if body.isascii() else '8bit'
+        return _CONTENT_BLOCKS[encoding], body
+
+    def _buffer(self, size):
+        """The calling thread's reusable buffer, grown to at least `size` bytes"""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = self._local.buffer = bytearray(max(size, 2 * len(buffer or b'')))
+        return buffer
+
+    def build_into(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """
+        Assemble the message in the thread's buffer; returns a memoryview of it,
+        valid until the next call from the same thread (release it when done)
+        """
+        content_block, body = self._body(html_body)
+        parts = (
+            self._to_header(recipient_email, recipient_name),
+            self._sender_block(sender_email),
+            self._subject_header(subject),
+            content_block,
+            body,
+        )
+        size = sum(len(part) for part in parts)
+        buffer = self._buffer(size)
+        position = 0
+        for part in parts:
+            end = position + len(part)
+            buffer[position:end] = part
+            position = end
+        return memoryview(buffer)[:size]
+
+    def build(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """The message as bytes"""
+        with self.build_into(sender_email, recipient_email, recipient_name, subject, html_body) as view:
+            return view.tobytes()
+
+    def build_raw(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        """The message as base64url text (Gmail users.messages.send `raw`)"""
+        with self.build_into(sender_email, recipient_email, recipient_name, subject, html_body) as view:
+            return base64.urlsafe_b64encode(view).decode('ascii')
+
+
+_builder = MimeBuilder()
+
+
+def get_mime_builder():
+    """Return the shared MimeBuilder"""
+    return _builder
@@ -0,0 +1,148 @@
+"""
+Process-wide cache of authenticated provider services, one per sender account
+"""
+
+import time
+import threading
+
+
+class ProviderRegistry:
+    """
+    Cache authenticated services (OutlookGraphAuth, GmailAuth, ...) by sender
+
+    Args:
+        factory: callable(sender_email) -> authenticated service or None
+        max_size: services kept at most; the least recently used is evicted
+        max_idle: seconds a service may stay unused before it is evicted
+        health_interval: seconds between health checks of a cached service
+        failure_ttl: seconds get() returns None for a sender whose authentication
+            failed, instead of running it (and any interactive login) again
+
+    Evicted services are only dropped from the cache, never closed: another
+    thread may still be sending with the instance it got from get(). Their
+    connections are released when the last reference goes away.
+    """
+
+    def __init__(self, factory, max_size=32, max_idle=3600, health_interval=60, failure_ttl=30):
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_interval = health_interval
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        # sender_email -> [lock, threads using it]; dropped when the last one leaves
+        self._account_locks = {}
+        # sender_email -> [service, last_used, last_checked]
+        self._entries = {}
+        # sender_email -> time its authentication failed
+        self._failures = {}
+
+    def get(self, sender_email):
+        """
+        Return the cached service for sender_email, authenticating on first use
+        """
+        key = sender_email.lower()
+        with self._lock:
+            account_lock = self._account_locks.setdefault(key, [threading.Lock(), 0])
+            account_lock[1] += 1
+        try:
+            # Only one thread authenticates per account; the others wait and reuse it
+            with account_lock[0]:
+                return self._get(sender_email, key)
+        finally:
+            with self._lock:
+                account_lock[1] -= 1
+                if not account_lock[1]:
+                    del self._account_locks[key]
+
+    def _get(self, sender_email, key):
+        # Caller holds the account lock for key
+        now = time.monotonic()
+        failed_at = self._failures.get(key)
+        if failed_at is not None:
+            if now - failed_at < self.failure_ttl:
+                print(f"Authentication for {sender_email} failed recently, not retrying yet")
+                return None
+            self._failures.pop(key, None)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[1] > self.max_idle:
+                self.evict(sender_email)
+            elif now - entry[2] > self.health_interval and not self._healthy(entry[0]):
+                print(f"Cached service for {sender_email} is unhealthy, re-authenticating")
+                self.evict(sender_email)
+            else:
+                if now - entry[2] > self.health_interval:
+                    entry[2] = now
+                entry[1] = now
+                return entry[0]
+
+        service = None
+        try:
+            service = self.factory(sender_email)
+        finally:
+            if service is None:
+                with self._lock:
+                    self._failures[key] = time.monotonic()
+                    self._drop_expired_failures()
+        if service is None:
+            return None
+
+        with self._lock:
+            self._entries[key] = [service, now, now]
+            self._evict_overflow()
+        return service
+
+    def mark_failed(self, sender_email):
+        """Force a health check on the next get() (e.g. after a failed send)"""
+        entry = self._entries.get(sender_email.lower())
+        if entry is not None:
+            entry[2] = float('-inf')
+
+    def evict(self, sender_email):
+        """Drop the cached service (without closing it) or failure for sender_email"""
+        with self._lock:
+            self._entries.pop(sender_email.lower(), None)
+            self._failures.pop(sender_email.lower(), None)
+
+    def clear(self):
+        """Close every cached service; only call when no sends are in progress"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries = {}
+            self._failures = {}
+        for entry in entries:
+            _close(entry[0])
+
+    def _evict_overflow(self):
+        # Caller holds self._lock
+        while len(self._entries) > self.max_size:
+            oldest = min(self._entries, key=lambda key: self._entries[key][1])
+            del self._entries[oldest]
+
+    def _drop_expired_failures(self):
+        # Caller holds self._lock
+        now = time.monotonic()
+        for key in [key for key, failed_at in self._failures.items() if now - failed_at >= self.failure_ttl]:
+            self._failures.pop(key, None)
+
+    @staticmethod
+    def _healthy(service):
+        check = getattr(service, 'is_healthy', None)
+        if check is None:
+            return True
+        try:
+            return bool(check())
+        except Exception as e:
+            print(f"Health check failed: {e}")
+            return False
+
+
+def _close(service):
+    close = getattr(service, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            print(f"Failed to close service: {e}")
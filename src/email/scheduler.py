@@ -0,0 +1,248 @@
+"""
+Concurrent send scheduler with per-provider rate limiting
+"""
+
+import os
+import sys
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.append(os.path.dirname(__file__))
+
+from send_email import auth, detect_provider, OUTLOOK, GMAIL, SMTP
+
+# Default quotas per sender mailbox
+#   Graph:  10,000 requests per 10 minutes, 4 concurrent requests per mailbox
+#   Gmail:  250 quota units per second per user, messages.send costs 100 units
+#   SMTP:   one send per pooled connection (SMTP_POOL_SIZE, default 4)
+PROVIDER_LIMITS = {
+    OUTLOOK: {'rate': 10000 / 600, 'burst': 4, 'concurrency': 4},
+    GMAIL: {'rate': 2.5, 'burst': 2, 'concurrency': 4},
+    SMTP: {'rate': 5.0, 'burst': 4, 'concurrency': int(os.getenv('SMTP_POOL_SIZE', '4'))},
+    None: {'rate': 1.0, 'burst': 1, 'concurrency': 1},
+}
+
+
+# Statuses for messages that never left the process: no service could be
+# authenticated for the sender, or its provider is not supported
+UNAUTHORIZED = 401
+UNSUPPORTED = 400
+
+
+class SendError(Exception):
+    """
+    A provider reported a failed send; `status` is its HTTP status if known
+    """
+
+    def __init__(self, sender_email, recipient_email, status=None):
+        self.status = status
+        detail = f" (status {status})" if status is not None else ""
+        super().__init__(f"Failed to send from {sender_email} to {recipient_email}{detail}")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, at most `burst` saved up
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1.0):
+        """Block until `tokens` are available, then take them"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def reserve(self, tokens=1.0):
+        """
+        Take `tokens` now, going into debt if needed; returns the seconds until
+        they are actually available (0 if they are available now)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+
+class SendScheduler:
+    """
+    Send messages on a worker pool while respecting per-provider quotas
+
+    Every sender mailbox gets its own token bucket and concurrency limit taken
+    from PROVIDER_LIMITS. submit() blocks once `max_pending` messages are queued
+    or in flight, which throttles the render stage feeding it (backpressure).
+
+    A message's rate-limit token is reserved when it is submitted; if it is not
+    available yet, the message waits on a timer and only reaches a worker when
+    it may be sent, so a throttled sender never ties up workers that other
+    senders could use.
+    """
+
+    def __init__(self, workers=8, max_pending=None, limits=None, auth_func=auth):
+        self.workers = workers
+        self.limits = {**PROVIDER_LIMITS, **(limits or {})}
+        self.auth_func = auth_func
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send')
+        self.max_pending = max_pending or workers * 2
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._services = {}
+        self._auth_locks = {}
+        self._buckets = {}
+        self._slots = {}
+        self._timers = set()
+
+    def _service(self, sender_email):
+        """Authenticate once per sender; concurrent callers wait for the first one"""
+        with self._lock:
+            auth_lock = self._auth_locks.setdefault(sender_email, threading.Lock())
+        with auth_lock:
+            if sender_email not in self._services:
+                self._services[sender_email] = self.auth_func(sender_email)
+            return self._services[sender_email]
+
+    def _limiters(self, sender_email):
+        with self._lock:
+            if sender_email not in self._buckets:
+                limit = self.limits[detect_provider(sender_email)]
+                self._buckets[sender_email] = TokenBucket(limit['rate'], limit['burst'])
+                self._slots[sender_email] = threading.BoundedSemaphore(limit['concurrency'])
+            return self._buckets[sender_email], self._slots[sender_email]
+
+    def _send(self, message, html_output):
+        try:
+            # Nothing reaches the provider without a service, so these failures get a
+            # status (final) instead of None, which would park the message as uncertain
+            try:
+                service = self._service(message.sender_email)
+            except Exception as e:
+                raise SendError(message.sender_email, message.receiver_email, UNAUTHORIZED) from e
+            if service is None:
+                status = UNAUTHORIZED if detect_provider(message.sender_email) else UNSUPPORTED
+                raise SendError(message.sender_email, message.receiver_email, status)
+
+            _, slots = self._limiters(message.sender_email)
+            with slots:
+                success = service.send_email(
+                    sender_email=message.sender_email,
+                    recipient_email=message.receiver_email,
+                    recipient_name=message.receiver_name,
+                    subject=message.subject,
+                    html_body=html_output
+                )
+                if not success:
+                    raise SendError(message.sender_email, message.receiver_email,
+                                    getattr(service, 'last_status', None))
+                return True
+        finally:
+            self._pending.release()
+
+    def submit(self, message, html_output):
+        """
+        Queue one message; blocks while too many messages are pending
+
+        Returns:
+            Future resolving to True, or raising SendError if the provider failed
+        """
+        self._pending.acquire()
+        try:
+            bucket, _ = self._limiters(message.sender_email)
+            delay = bucket.reserve()
+            if delay <= 0:
+                return self._executor.submit(self._send, message, html_output)
+
+            future = Future()
+            timer = threading.Timer(delay, self._submit_due, (future, message, html_output))
+            timer.daemon = True
+            with self._lock:
+                self._timers.add(timer)
+            timer.start()
+            return future
+        except Exception:
+            self._pending.release()
+            raise
+
+    def _submit_due(self, future, message, html_output):
+        """Timer callback: hand a rate-limited message to the workers once its token is due"""
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+        try:
+            inner = self._executor.submit(self._send, message, html_output)
+        except Exception as e:
+            self._pending.release()
+            future.set_exception(e)
+            return
+
+        def copy_result(inner):
+            error = inner.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(inner.result())
+        inner.add_done_callback(copy_result)
+
+    def imap(self, items):
+        """
+        Send (tag, message, html_output) items and yield (tag, result, error)
+        as they complete
+
+        Items are pulled from the iterable only as capacity frees up, so a
+        generator input is never read far ahead of the senders. An item whose
+        message is None is not sent; (tag, None, None) is yielded for it at
+        once, so callers can pass other results through in stream order.
+        """
+        in_flight = {}
+        for tag, message, html_output in items:
+            if message is None:
+                yield tag, None, None
+                continue
+            while in_flight and len(in_flight) >= self.max_pending:
+                yield from self._drain(in_flight, FIRST_COMPLETED)
+            in_flight[self.submit(message, html_output)] = tag
+        while in_flight:
+            yield from self._drain(in_flight, FIRST_COMPLETED)
+
+    def _drain(self, in_flight, return_when):
+        done, _ = wait(list(in_flight), return_when=return_when)
+        for future in done:
+            tag = in_flight.pop(future)
+            error = future.exception()
+            yield tag, (None if error else future.result()), error
+
+    def close(self, wait=True):
+        if wait:
+            # Rate-limited messages still waiting for their token
+            while True:
+                with self._lock:
+                    timers = list(self._timers)
+                if not timers:
+                    break
+                for timer in timers:
+                    timer.join()
+        else:
+            with self._lock:
+                timers, self._timers = list(self._timers), set()
+            for timer in timers:
+                timer.cancel()
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -2,31 +2,82 @@
 import os
 import json
 import sys
+import threading
 
-# Add auth directory to path
+# Add auth and type directories to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'auth'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'type'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+sys.path.append(os.path.dirname(__file__))
 
-def auth(sender_email):
+from Message import Message
+from provider_registry import ProviderRegistry
+from metrics import get_metrics
+from mime_stream import tee
+
+OUTLOOK = 'outlook'
+GMAIL = 'gmail'
+SMTP = 'smtp'
+
+# Outlook, Gmail and SMTP with XOAUTH2 may open a browser login (Outlook's
+# callback always binds localhost:8080), so only one sender authenticates at a time
+_interactive_auth_lock = threading.Lock()
+
+
+def detect_provider(sender_email):
+    """
+    Return the provider name for sender_email (OUTLOOK, GMAIL, SMTP) or None
+
+    Other domains are sent through SMTP when SMTP_HOST is set.
     """
-    Determine authentication method based on sender email
+    # Basic email validation
+    if not sender_email or '@' not in sender_email or sender_email.count('@') != 1:
+        return None
+
+    # Extract domain part
+    domain = sender_email.split('@')[1].lower()
+
+    if any(provider in domain for provider in ['outlook', 'hotmail', 'live']):
+        return OUTLOOK
+    elif 'gmail' in domain:
+        return GMAIL
+    elif os.getenv('SMTP_HOST'):
+        return SMTP
+    return None
+
+
+def authenticate(sender_email):
+    """
+    Determine authentication method based on sender email and authenticate (uncached)
     """
+    with get_metrics().span('auth', provider=detect_provider(sender_email) or 'unknown'):
+        return _authenticate(sender_email)
+
+
+def _authenticate(sender_email):
     try:
         # Basic email validation
         if not sender_email or '@' not in sender_email or sender_email.count('@') != 1:
             print(f"Invalid email format: {sender_email}")
             return None
         
-        # Extract domain part
-        domain = sender_email.split('@')[1].lower()
+        provider = detect_provider(sender_email)
         
-        if any(provider in domain for provider in ['outlook', 'hotmail', 'live']):
+        if provider == OUTLOOK:
             # Use Outlook/Azure authentication
             from outlook_azure import outlook_authenticate
-            return outlook_authenticate()
-        elif 'gmail' in domain:
+            with _interactive_auth_lock:
+                return outlook_authenticate(account=sender_email)
+        elif provider == GMAIL:
             # Use Gmail authentication
             from google_oauth2 import gmail_authenticate_service
-            return gmail_authenticate_service()
+            with _interactive_auth_lock:
+                return gmail_authenticate_service(account=sender_email)
+        elif provider == SMTP:
+            # Any other domain, through the server in SMTP_HOST
+            from smtp_provider import smtp_authenticate
+            with _interactive_auth_lock:
+                return smtp_authenticate(account=sender_email)
         else:
             # Unknown email provider
             print(f"Unknown email provider for: {sender_email}")
@@ -39,21 +90,60 @@ def auth(sender_email):
         return None
 
 
+# Authenticated services are kept for the lifetime of the process
+_registry = ProviderRegistry(authenticate)
 
 
-def send_email(data_file_path, html_output):
+def get_registry():
     """
-    Send an email using the data file and HTML output
+    Return the process-wide provider registry
+    """
+    return _registry
+
+
+def auth(sender_email):
+    """
+    Return the cached authenticated service for sender_email (authenticating on first use)
+    """
+    if not sender_email:
+        print(f"Invalid email format: {sender_email}")
+        return None
+    return _registry.get(sender_email)
+
+
+def archive_email(html_output, archive_dir, file_name='latest_email.html'):
+    """
+    Write the rendered HTML to archive_dir for preview/debugging
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    html_file_path = os.path.join(archive_dir, file_name)
+    with open(html_file_path, 'w', encoding='utf-8') as f:
+        f.write(html_output)
+    print(f"HTML saved to: {html_file_path}")
+    return html_file_path
+
+
+def send_email(message, html_output, archive_dir=None):
+    """
+    Send an email
+
+    Args:
+        message: Message, a filled-data dict, or (legacy) a path to a data.json file
+        html_output: rendered HTML body
+        archive_dir: if set, also write the HTML to archive_dir/latest_email.html
     """
     try:
-        # Read the data.json to get email details
-        with open(data_file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        sender_email = data.get('senderemail', 'unknown@example.com')
-        receiver_email = data.get('receiveremail', 'unknown@example.com')
-        subject = data.get('subject', 'No Subject')
-        receiver_name = data.get('receiver', {}).get('name', 'Recipient')
+        if isinstance(message, str):
+            # Legacy: read the data.json to get email details
+            with open(message, 'r', encoding='utf-8') as f:
+                message = json.load(f)
+        if isinstance(message, dict):
+            message = Message.from_dict(message)
+
+        sender_email = message.sender_email
+        receiver_email = message.receiver_email
+        subject = message.subject
+        receiver_name = message.receiver_name
         
         print(f"=== EMAIL SENDING PROCESS ===")
         print(f"From: {sender_email}")
@@ -61,15 +151,9 @@ def send_email(data_file_path, html_output):
         print(f"Subject: {subject}")
         print(f"HTML content length: {len(html_output)} characters")
         
-        # Save HTML output to file for preview
-        output_dir = os.path.join(os.path.dirname(data_file_path), '..', 'output')
-        os.makedirs(output_dir, exist_ok=True)
-        
-        html_file_path = os.path.join(output_dir, 'latest_email.html')
-        with open(html_file_path, 'w', encoding='utf-8') as f:
-            f.write(html_output)
-        
-        print(f"HTML saved to: {html_file_path}")
+        # Save HTML output to file for preview (opt-in)
+        if archive_dir:
+            archive_email(html_output, archive_dir)
         
         # Authenticate and send email
         print("Authenticating with email service...")
@@ -77,7 +161,7 @@ def send_email(data_file_path, html_output):
         
         if auth_service is None:
             print("Authentication failed or email provider not supported")
-            print("Email saved locally but not sent")
+            print("Email not sent")
             return False
         
         # Attempt to send email using the authenticated service
@@ -98,13 +182,63 @@ def send_email(data_file_path, html_output):
                 return True
             else:
                 print("Failed to send email through service")
+                _registry.mark_failed(sender_email)
                 return False
         
         else:
             print("Authentication service doesn't support email sending")
-            print("Email saved locally but not sent")
+            print("Email not sent")
             return False
         
     except Exception as e:
         print(f'Failed to send email: {e}')
-        return False
\ No newline at end of file
+        return False
+
+def send_email_stream(message, html_chunks, archive_dir=None):
+    """
+    Send an email whose HTML body arrives as text chunks (e.g. generate_from_dict())
+
+    The chunks are encoded and uploaded as they are produced (and copied to
+    archive_dir/latest_email.html if set), so a large body is never held
+    in memory as a whole. Services without a streaming send get the joined text.
+    """
+    try:
+        if isinstance(message, dict):
+            message = Message.from_dict(message)
+
+        print(f"=== EMAIL SENDING PROCESS (streamed) ===")
+        print(f"From: {message.sender_email}")
+        print(f"To: {message.receiver_email} ({message.receiver_name})")
+        print(f"Subject: {message.subject}")
+
+        auth_service = auth(message.sender_email)
+        if auth_service is None:
+            print("Authentication failed or email provider not supported")
+            print("Email not sent")
+            return False
+
+        if archive_dir:
+            html_chunks = tee(html_chunks, os.path.join(archive_dir, 'latest_email.html'))
+
+        if hasattr(auth_service, 'send_email_stream'):
+            send = auth_service.send_email_stream
+        elif hasattr(auth_service, 'send_email'):
+            send = auth_service.send_email
+            html_chunks = ''.join(html_chunks)
+        else:
+            print("Authentication service doesn't support email sending")
+            print("Email not sent")
+            return False
+
+        success = send(message.sender_email, message.receiver_email, message.receiver_name,
+                       message.subject, html_chunks)
+        if success:
+            print("Email sent successfully!")
+            return True
+        print("Failed to send email through service")
+        _registry.mark_failed(message.sender_email)
+        return False
+
+    except Exception as e:
+        print(f'Failed to send email: {e}')
+        return False
@@ -0,0 +1,286 @@
+"""
+Durable send queue between rendering and the providers (SQLite, WAL mode)
+
+Every rendered message is stored with an idempotency key before it is sent.
+A message is marked `sending` (and committed) before the provider is called,
+so after a crash it shows up as `uncertain` instead of being sent twice.
+Failures with HTTP 429/5xx are retried with exponential backoff. A failure
+without a status (the request went out but no response came back) may still
+have been delivered, so it is parked as `uncertain` like a crash would be;
+retry_uncertain() sends those again on request. Other failures are final;
+providers and the scheduler give failures that never reached the provider
+(no connection, no credentials) a status so they are not parked.
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+
+sys.path.append(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'type'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+
+from Message import Message
+from metrics import get_metrics, error_class
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+UNCERTAIN = 'uncertain'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    tag TEXT,
+    sender_email TEXT NOT NULL,
+    receiver_email TEXT NOT NULL,
+    receiver_name TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    html TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_status INTEGER,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, next_attempt_at);
+'''
+
+Job = namedtuple('Job', ['id', 'idempotency_key', 'tag', 'message', 'html', 'attempts'])
+
+
+def idempotency_key(message, html_output):
+    """Default key: the same envelope and body are only ever queued once"""
+    digest = hashlib.sha256()
+    for part in (message.sender_email, message.receiver_email, message.subject, html_output):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def is_retryable(status):
+    """429 and 5xx are transient; None (no response) is not, the send may have gone through"""
+    return status is not None and (status == 429 or status >= 500)
+
+
+class SendQueue:
+    """
+    Persistent job queue backed by one SQLite file
+
+    Args:
+        path: database file (created if missing)
+        max_attempts: attempts before a retryable failure becomes final
+        base_delay / max_delay: exponential backoff bounds in seconds
+        resend_uncertain: re-queue messages that were in flight during a crash
+            (may send them twice); by default they are left as `uncertain`
+    """
+
+    def __init__(self, path, max_attempts=5, base_delay=2.0, max_delay=300.0,
+                 resend_uncertain=False):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.started_at = time.time()
+
+        db = self._db()
+        db.executescript(SCHEMA)
+        self._recover(resend_uncertain)
+
+    def _db(self):
+        """One connection per thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _recover(self, resend_uncertain):
+        """Handle messages left in flight by a previous process"""
+        now = time.time()
+        state = PENDING if resend_uncertain else UNCERTAIN
+        with self._write_lock:
+            cursor = self._db().execute(
+                'UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?',
+                (state, now, SENDING)
+            )
+        if cursor.rowcount:
+            print(f"Recovered {cursor.rowcount} in-flight messages as '{state}'")
+
+    def retry_uncertain(self):
+        """
+        Queue every `uncertain` message for another attempt (may send some twice)
+
+        Returns:
+            int: number of messages moved back to `pending`
+        """
+        now = time.time()
+        with self._write_lock:
+            cursor = self._db().execute(
+                'UPDATE jobs SET state = ?, next_attempt_at = ?, updated_at = ? WHERE state = ?',
+                (PENDING, now, now, UNCERTAIN)
+            )
+        return cursor.rowcount
+
+    def enqueue(self, message, html_output, key=None, tag=None):
+        """
+        Store one message; returns False if its idempotency key is already queued
+        """
+        now = time.time()
+        key = key or idempotency_key(message, html_output)
+        with self._write_lock:
+            cursor = self._db().execute(
+                '''INSERT OR IGNORE INTO jobs
+                   (idempotency_key, tag, sender_email, receiver_email, receiver_name, subject,
+                    html, state, next_attempt_at, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (key, None if tag is None else str(tag), message.sender_email,
+                 message.receiver_email, message.receiver_name, message.subject,
+                 html_output, PENDING, now, now, now)
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, limit=1):
+        """
+        Atomically move up to `limit` due messages to `sending` and return them
+        """
+        now = time.time()
+        db = self._db()
+        with self._write_lock:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = db.execute(
+                    '''SELECT id, idempotency_key, tag, sender_email, receiver_email, receiver_name,
+                              subject, html, attempts
+                       FROM jobs WHERE state = ? AND next_attempt_at <= ?
+                       ORDER BY next_attempt_at, id LIMIT ?''',
+                    (PENDING, now, limit)
+                ).fetchall()
+                db.executemany(
+                    'UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                    [(SENDING, now, row[0]) for row in rows]
+                )
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+        return [
+            Job(row[0], row[1], row[2], Message(row[3], row[4], row[5], row[6]), row[7], row[8] + 1)
+            for row in rows
+        ]
+
+    def mark_sent(self, job, status=None):
+        now = time.time()
+        with self._write_lock:
+            self._db().execute(
+                '''UPDATE jobs SET state = ?, last_status = ?, last_error = NULL,
+                   updated_at = ?, sent_at = ? WHERE id = ?''',
+                (SENT, status, now, now, job.id)
+            )
+
+    def mark_failed(self, job, error, status=None):
+        """
+        Schedule a retry (429/5xx) with exponential backoff, park the message as
+        `uncertain` (no status), or give up
+        """
+        now = time.time()
+        if status is None:
+            state, next_attempt_at = UNCERTAIN, now
+        elif is_retryable(status) and job.attempts < self.max_attempts:
+            delay = min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1))
+            delay *= 1 + random.random() * 0.1
+            state, next_attempt_at = PENDING, now + delay
+            get_metrics().inc('retries_total', stage='queue', error=error_class(status, error))
+        else:
+            state, next_attempt_at = DEAD, now
+        with self._write_lock:
+            self._db().execute(
+                '''UPDATE jobs SET state = ?, next_attempt_at = ?, last_status = ?, last_error = ?,
+                   updated_at = ? WHERE id = ?''',
+                (state, next_attempt_at, status, str(error), now, job.id)
+            )
+        return state
+
+    def next_attempt_at(self):
+        """Time of the earliest pending message, or None if nothing is pending"""
+        row = self._db().execute(
+            'SELECT MIN(next_attempt_at) FROM jobs WHERE state = ?', (PENDING,)
+        ).fetchone()
+        return row[0]
+
+    def stats(self):
+        """
+        Counts per state plus throughput counters
+
+        `sent_per_sec` covers messages sent since this queue object was opened.
+        """
+        counts = dict(self._db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        sent_here = self._db().execute(
+            'SELECT COUNT(*) FROM jobs WHERE state = ? AND sent_at >= ?', (SENT, self.started_at)
+        ).fetchone()[0]
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        retries = self._db().execute(
+            'SELECT COALESCE(SUM(attempts - 1), 0) FROM jobs WHERE attempts > 1'
+        ).fetchone()[0]
+        return {
+            **{state: counts.get(state, 0) for state in (PENDING, SENDING, SENT, DEAD, UNCERTAIN)},
+            'retries': retries,
+            'sent_this_run': sent_here,
+            'sent_per_sec': sent_here / elapsed,
+        }
+
+    def process(self, workers=1, scheduler=None, max_wait=5.0):
+        """
+        Send queued messages until none are pending
+
+        Yields (job, state, error) for every attempt; state is SENT, PENDING
+        (retry scheduled), UNCERTAIN (no status, not retried) or DEAD.
+        """
+        from scheduler import SendScheduler, SendError
+
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            scheduler = SendScheduler(workers=workers)
+        try:
+            while True:
+                jobs = self.claim(limit=scheduler.max_pending)
+                if not jobs:
+                    next_at = self.next_attempt_at()
+                    if next_at is None:
+                        break
+                    # Wait for the next retry to become due
+                    time.sleep(min(max(next_at - time.time(), 0.01), max_wait))
+                    continue
+
+                items = ((job, job.message, job.html) for job in jobs)
+                for job, _, error in scheduler.imap(items):
+                    if error is None:
+                        self.mark_sent(job)
+                        yield job, SENT, None
+                    else:
+                        status = error.status if isinstance(error, SendError) else None
+                        yield job, self.mark_failed(job, error, status), error
+        finally:
+            if own_scheduler:
+                scheduler.close()
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
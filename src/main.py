@@ -1,9 +1,10 @@
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QLabel, QLineEdit, QTextEdit, QVBoxLayout,
-    QPushButton, QMessageBox, QHBoxLayout, QComboBox
+    QPushButton, QMessageBox, QHBoxLayout, QComboBox, QListWidget, QListWidgetItem,
+    QTextBrowser
 )
 from PyQt6.QtGui import QIcon
-from PyQt6.QtCore import QSize
+from PyQt6.QtCore import QSize, Qt, QTimer
 import sys
 import os
 import json
@@ -15,22 +16,29 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'script'))
 sys.path.append(os.path.join(os.path.dirname(__file__), 'type'))
 sys.path.append(os.path.join(os.path.dirname(__file__), 'email'))
 
-from substitute import template
 from Lang import Lang, Langs
 from Mode import Mode, Modes, Gender, Formal
-from send_email import send_email
+from send_worker import SendJobQueue, QUEUED
+from preview import PreviewRenderer, DEBOUNCE_MS
 
 class MailTemplateGUI(QWidget):
     """Main email template GUI application"""
     
     def __init__(self):
         super().__init__()
+        self.send_queue = SendJobQueue(parent=self)
+        self.send_queue.changed.connect(self.update_queue_item)
+        self.queue_items = {}
+        self.preview = PreviewRenderer(parent=self)
+        self.preview.rendered.connect(self.show_preview)
+        self.preview.failed.connect(self.show_preview_error)
         self.init_ui()
         self.setup_paths()
+        self.update_preview()
     
     def init_ui(self):
         self.setWindowTitle("Mail Template Generator")
-        self.setGeometry(100, 100, 500, 400)
+        self.setGeometry(100, 100, 1000, 600)
         
         # Set window icon (try PNG first for better Linux compatibility, then ICO)
         icon_dir = os.path.join(os.path.dirname(__file__), '..', 'ico')
@@ -113,60 +121,120 @@ class MailTemplateGUI(QWidget):
         self.send_btn.clicked.connect(self.send_email)
         layout.addWidget(self.send_btn)
         
-        self.setLayout(layout)
+        # Send queue: one line per message, updated as it is rendered and sent
+        layout.addWidget(QLabel("Queue:"))
+        self.queue_list = QListWidget()
+        layout.addWidget(self.queue_list)
+        self.cancel_btn = QPushButton("Cancel Selected")
+        self.cancel_btn.clicked.connect(self.cancel_selected)
+        layout.addWidget(self.cancel_btn)
+        
+        # Live preview, re-rendered once typing pauses for DEBOUNCE_MS
+        preview_layout = QVBoxLayout()
+        preview_layout.addWidget(QLabel("Preview:"))
+        self.preview_browser = QTextBrowser()
+        preview_layout.addWidget(self.preview_browser)
+        
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(DEBOUNCE_MS)
+        self.preview_timer.timeout.connect(self.update_preview)
+        for line_edit in (self.sender_input, self.receiver_input, self.subject_input, self.receiver_name_input):
+            line_edit.textChanged.connect(self.preview_timer.start)
+        self.body_input.textChanged.connect(self.preview_timer.start)
+        self.lang_combo.currentIndexChanged.connect(self.preview_timer.start)
+        self.mode_combo.currentIndexChanged.connect(self.preview_timer.start)
+        
+        main_layout = QHBoxLayout()
+        main_layout.addLayout(layout, 1)
+        main_layout.addLayout(preview_layout, 1)
+        self.setLayout(main_layout)
 
     def setup_paths(self):
         """Setup file paths"""
         self.settings_dir = os.path.join(os.path.dirname(__file__), '..', 'settings')
         self.data_file = os.path.join(self.settings_dir, 'data.json')
-        os.makedirs(self.settings_dir, exist_ok=True)
+        self.output_dir = os.path.join(os.path.dirname(__file__), '..', 'output')
+        # Writing data.json / output/latest_email.html is opt-in (debug/archival)
+        self.archive = os.getenv('MAIL_TEMPLATE_ARCHIVE', '') not in ('', '0')
     
-    def save_and_generate(self):
-        """Save data to settings/data.json and generate template"""
-        try:
-            # Get selected mode
-            mode_data = self.mode_combo.currentData()
-            gender, formal = mode_data if mode_data else (Gender.NEUTRAL, Formal.FORMAL)
-            
-            # Create filled_data from form inputs
-            filled_data = {
-                "senderemail": self.sender_input.text() or "sender@example.com",
-                "receiveremail": self.receiver_input.text() or "recipient@example.com",
-                "receiver": {
-                    "name": self.receiver_name_input.text() or "Recipient"
-                },
-                "subject": self.subject_input.text() or "subject",
-                "body": self.body_input.toPlainText() or "This is a test email message.",
-                "mode": {
-                    "gender": gender,
-                    "formal": formal
-                }
+    def collect_data(self):
+        """Build filled_data from the form inputs"""
+        # Get selected mode
+        mode_data = self.mode_combo.currentData()
+        gender, formal = mode_data if mode_data else (Gender.NEUTRAL, Formal.FORMAL)
+        
+        return {
+            "senderemail": self.sender_input.text() or "sender@example.com",
+            "receiveremail": self.receiver_input.text() or "recipient@example.com",
+            "receiver": {
+                "name": self.receiver_name_input.text() or "Recipient"
+            },
+            "subject": self.subject_input.text() or "subject",
+            "body": self.body_input.toPlainText() or "This is a test email message.",
+            "mode": {
+                "gender": gender,
+                "formal": formal
             }
-            
-            # Save filled_data to data.json
+        }
+    
+    def archive_data(self, filled_data):
+        """Write settings/data.json when archiving is enabled"""
+        if self.archive:
+            os.makedirs(self.settings_dir, exist_ok=True)
             with open(self.data_file, 'w', encoding='utf-8') as f:
                 json.dump(filled_data, f, indent=2, ensure_ascii=False)
-            
-            output = template(self.lang_combo.currentText(), 'data.json')
-            return output
-            
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed: {str(e)}")
-            print(f"[DEBUG] {str(e)}")
-            return None
+    
+    def update_preview(self):
+        """Render the current form in the background"""
+        self.preview.request(self.lang_combo.currentText(), self.collect_data())
+    
+    def show_preview(self, html_output):
+        # Keep the scroll position while typing
+        scrollbar = self.preview_browser.verticalScrollBar()
+        position = scrollbar.value()
+        self.preview_browser.setHtml(html_output)
+        scrollbar.setValue(position)
+    
+    def show_preview_error(self, error):
+        self.preview_browser.setPlainText(f"Preview failed: {error}")
     
     def send_email(self):
-        """Send email using the generated template"""
+        """Queue the email; rendering and sending run in the background"""
         try:
-            # Generate template first
-            output = self.save_and_generate()
-            if output:
-                # currently not implemented
-                send_email(self.data_file, output)
-                QMessageBox.information(self, "Success", "Email sent successfully!")
+            filled_data = self.collect_data()
+            self.archive_data(filled_data)
+            archive_dir = self.output_dir if self.archive else None
+            job = self.send_queue.submit(self.lang_combo.currentText(), filled_data, archive_dir)
+            
+            item = QListWidgetItem()
+            item.setData(Qt.ItemDataRole.UserRole, job.job_id)
+            self.queue_list.addItem(item)
+            self.queue_items[job.job_id] = (item, job.message)
+            self.update_queue_item(job.job_id, QUEUED, '')
                 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed: {str(e)}")
+    
+    def update_queue_item(self, job_id, state, error):
+        """Show the current state of a queued message"""
+        if job_id not in self.queue_items:
+            return
+        item, message = self.queue_items[job_id]
+        text = f"#{job_id} {message.receiver_email} - {message.subject}: {state}"
+        if error:
+            text += f" ({error})"
+        item.setText(text)
+    
+    def cancel_selected(self):
+        """Cancel the selected messages that have not been sent yet"""
+        for item in self.queue_list.selectedItems():
+            self.send_queue.cancel(item.data(Qt.ItemDataRole.UserRole))
+    
+    def closeEvent(self, event):
+        """Drop queued messages; messages already sending are finished first"""
+        self.send_queue.cancel_all()
+        super().closeEvent(event)
 
 def main():
     app = QApplication(sys.argv)
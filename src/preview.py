@@ -0,0 +1,73 @@
+"""
+Live preview rendering for the GUI
+
+Form edits are debounced by the window; each resulting request is rendered
+on a single background thread with the shared renderer (cached template and
+language/mode layers). Requests are numbered, and only the result of the
+newest one is delivered, so a slow render can never overwrite a newer preview.
+"""
+
+import os
+import sys
+import itertools
+
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'script'))
+
+from substitute import template_from_dict
+
+# Quiet period after the last keystroke before the preview is re-rendered
+DEBOUNCE_MS = 150
+
+
+class PreviewSignals(QObject):
+    done = pyqtSignal(int, str, str)    # sequence number, html, error message
+
+
+class PreviewJob(QRunnable):
+    """Render one preview"""
+
+    def __init__(self, sequence, lang_code, filled_data, signals):
+        super().__init__()
+        self.sequence = sequence
+        self.lang_code = lang_code
+        self.filled_data = filled_data
+        self.signals = signals
+
+    def run(self):
+        try:
+            html_output = template_from_dict(self.lang_code, self.filled_data)
+            self.signals.done.emit(self.sequence, html_output, '')
+        except Exception as e:
+            self.signals.done.emit(self.sequence, '', str(e))
+
+
+class PreviewRenderer(QObject):
+    """Renders previews off the UI thread and drops stale results"""
+    rendered = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        # One render at a time; newer requests replace queued ones
+        self.pool.setMaxThreadCount(1)
+        self.signals = PreviewSignals()
+        self.signals.done.connect(self._on_done)
+        self._sequence = itertools.count(1)
+        self.latest = 0
+
+    def request(self, lang_code, filled_data):
+        """Render filled_data; superseded requests that have not started are dropped"""
+        self.latest = next(self._sequence)
+        self.pool.clear()
+        self.pool.start(PreviewJob(self.latest, lang_code, filled_data, self.signals))
+
+    def _on_done(self, sequence, html_output, error):
+        if sequence != self.latest:
+            return
+        if error:
+            self.failed.emit(error)
+        else:
+            self.rendered.emit(html_output)
@@ -0,0 +1,384 @@
+"""
+Bulk mail merge: stream a CSV or JSONL recipient file through
+parse -> render -> send and report one status line per row.
+
+Every stage is a generator, so only one row is held in memory at a time
+regardless of the size of the recipient file.
+
+CSV columns may use dotted names for nested fields (e.g. `receiver.name`,
+`mode.gender`). Each row may carry a `lang` field to override the default.
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import itertools
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'email'))
+
+from substitute import get_renderer
+from metrics import get_metrics
+from Message import Message
+
+
+class RowError(ValueError):
+    """A recipient row that could not be parsed"""
+
+
+def _unflatten(row: dict) -> dict:
+    """
+    Turn {'receiver.name': 'A'} into {'receiver': {'name': 'A'}}
+
+    Raises RowError if a row fills both a column and one nested under it
+    (e.g. `receiver` and `receiver.name`).
+    """
+    data = {}
+    for key, value in row.items():
+        if key is None or value is None or value == '':
+            continue
+        parts = key.split('.')
+        target = data
+        for depth, part in enumerate(parts[:-1], start=1):
+            target = target.setdefault(part, {})
+            if not isinstance(target, dict):
+                raise RowError(f"Column {key!r} conflicts with column {'.'.join(parts[:depth])!r}")
+        if isinstance(target.get(parts[-1]), dict):
+            raise RowError(f"Column {key!r} conflicts with the nested {key + '.*'!r} columns")
+        target[parts[-1]] = value
+    return data
+
+
+def read_recipients(path: str):
+    """
+    Yield (row_number, data) for each recipient in a .csv or .jsonl file
+
+    Rows that cannot be parsed are yielded as (row_number, RowError).
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row_number, row in enumerate(csv.DictReader(f), start=1):
+                try:
+                    yield row_number, _unflatten(row)
+                except RowError as e:
+                    yield row_number, e
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            for row_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield row_number, RowError(f"Invalid JSON: {e}")
+                    continue
+                if isinstance(data, dict):
+                    yield row_number, data
+                else:
+                    yield row_number, RowError(f"Expected a JSON object, got {type(data).__name__}")
+
+
+def _merge_defaults(defaults: dict, data: dict) -> dict:
+    """Row values win over defaults; nested dicts are merged one level deep"""
+    merged = dict(defaults)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+
+def row_message(data: dict) -> Message:
+    """The Message of a row; raises RowError if its envelope fields have the wrong shape"""
+    if not isinstance(data.get('receiver', {}), dict):
+        raise RowError("'receiver' must be an object with a 'name' field (CSV: use a receiver.name column)")
+    for key in ('senderemail', 'receiveremail', 'subject'):
+        if not isinstance(data.get(key, ''), str):
+            raise RowError(f"{key!r} must be a string")
+    return Message.from_dict(data)
+
+
+def render_row(renderer, row_number, data, lang_code: str, defaults: dict):
+    """Render one parsed row; returns (row_number, data, html, error)"""
+    if isinstance(data, Exception):
+        return row_number, {}, None, data
+    if not isinstance(data, dict):
+        return row_number, {}, None, RowError(f"Expected an object, got {type(data).__name__}")
+    try:
+        data = _merge_defaults(defaults, data)
+        row_message(data)
+        html = renderer.render(data.get('lang', lang_code), data)
+    except Exception as e:
+        return row_number, data, None, e
+    return row_number, data, html, None
+
+
+def render_rows(rows, lang_code: str = 'en', defaults: dict = None):
+    """
+    Render each parsed row
+
+    Yields (row_number, data, html, error); html is None when error is set.
+    """
+    renderer = get_renderer()
+    defaults = defaults or {}
+    for row_number, data in rows:
+        yield render_row(renderer, row_number, data, lang_code, defaults)
+
+
+def _early_status(row_number, data, html, error, dry_run):
+    """Status for rows that never reach a provider, or None if the row should be sent"""
+    status = {
+        'row': row_number,
+        'receiveremail': data.get('receiveremail'),
+    }
+    if error is not None:
+        kind = 'parse_error' if isinstance(error, RowError) else 'render_error'
+        status.update(status=kind, error=str(error))
+        return status
+    if dry_run:
+        status.update(status='rendered', length=len(html))
+        return status
+    return None
+
+
+def send_rows(rendered, dry_run: bool = False, workers: int = 1):
+    """
+    Send each rendered row through the provider of its sender address
+
+    Yields one status dict per row. Providers are authenticated once per
+    sender address for the whole run. With workers > 1 rows are sent
+    concurrently by a SendScheduler and statuses arrive in completion order.
+    """
+    if workers > 1 and not dry_run:
+        yield from _send_rows_concurrently(rendered, workers)
+        return
+
+    from send_email import auth
+
+    services = {}
+    for row_number, data, html, error in rendered:
+        status = _early_status(row_number, data, html, error, dry_run)
+        if status is not None:
+            yield status
+            continue
+        status = {'row': row_number, 'receiveremail': data.get('receiveremail')}
+
+        try:
+            message = row_message(data)
+        except RowError as e:
+            status.update(status='parse_error', error=str(e))
+            yield status
+            continue
+        if message.sender_email not in services:
+            services[message.sender_email] = auth(message.sender_email)
+        service = services[message.sender_email]
+        if service is None:
+            status.update(status='failed', error=f"Authentication failed for {message.sender_email}")
+            yield status
+            continue
+
+        try:
+            success = service.send_email(
+                sender_email=message.sender_email,
+                recipient_email=message.receiver_email,
+                recipient_name=message.receiver_name,
+                subject=message.subject,
+                html_body=html
+            )
+        except Exception as e:
+            status.update(status='failed', error=str(e))
+            yield status
+            continue
+
+        status['status'] = 'sent' if success else 'failed'
+        yield status
+
+
+def _send_rows_concurrently(rendered, workers: int):
+    from scheduler import SendScheduler
+
+    def sendable():
+        for row_number, data, html, error in rendered:
+            status = _early_status(row_number, data, html, error, False)
+            if status is not None:
+                # No message: imap hands the finished status straight back
+                yield status, None, None
+                continue
+            status = {'row': row_number, 'receiveremail': data.get('receiveremail')}
+            try:
+                message = row_message(data)
+            except RowError as e:
+                status.update(status='parse_error', error=str(e))
+                yield status, None, None
+                continue
+            yield status, message, html
+
+    with SendScheduler(workers=workers) as scheduler:
+        for status, success, error in scheduler.imap(sendable()):
+            if 'status' not in status:
+                if error is not None:
+                    status.update(status='failed', error=str(error))
+                else:
+                    status['status'] = 'sent'
+            yield status
+
+
+def queue_rows(rendered, queue):
+    """
+    Store rendered rows in a durable SendQueue
+
+    Yields statuses only for rows that are not queued (errors and duplicates).
+    """
+    for row_number, data, html, error in rendered:
+        status = _early_status(row_number, data, html, error, False)
+        if status is not None:
+            yield status
+            continue
+        try:
+            message = row_message(data)
+        except RowError as e:
+            yield {'row': row_number, 'receiveremail': data.get('receiveremail'),
+                   'status': 'parse_error', 'error': str(e)}
+            continue
+        if not queue.enqueue(message, html, tag=row_number):
+            yield {'row': row_number, 'receiveremail': data.get('receiveremail'), 'status': 'duplicate'}
+
+
+def drain_queue(queue, workers: int = 1):
+    """
+    Send everything pending in the queue; yields one final status per message
+    """
+    from send_queue import SENT, PENDING, UNCERTAIN
+
+    for job, state, error in queue.process(workers=workers):
+        if state == PENDING:
+            # Retry scheduled; the final outcome is reported later
+            continue
+        status = {
+            'row': int(job.tag) if job.tag and job.tag.isdigit() else job.tag,
+            'receiveremail': job.message.receiver_email,
+            'status': 'sent' if state == SENT else 'uncertain' if state == UNCERTAIN else 'failed',
+        }
+        if error is not None:
+            status['error'] = str(error)
+        yield status
+
+
+def _render(recipients_path: str, lang_code: str, defaults: dict,
+            render_processes: int, chunk_size: int):
+    rows = read_recipients(recipients_path)
+    if render_processes and render_processes > 1:
+        from render_farm import render_rows_parallel
+        return render_rows_parallel(rows, lang_code, defaults, render_processes, chunk_size)
+    return render_rows(rows, lang_code, defaults)
+
+
+def merge(recipients_path: str, status_path: str, lang_code: str = 'en',
+          defaults: dict = None, dry_run: bool = False, workers: int = 1,
+          queue_path: str = None, resume: bool = False,
+          render_processes: int = 1, chunk_size: int = 256,
+          retry_uncertain: bool = False) -> dict:
+    """
+    Run the whole pipeline and write one JSON status line per row
+
+    With queue_path, rendered messages are first stored in a durable SQLite
+    queue and then sent from it; resume=True skips parsing and rendering and
+    only sends what the queue still holds (e.g. after a crash), and
+    retry_uncertain=True also resends its `uncertain` messages.
+    render_processes > 1 renders in a process pool, chunk_size rows per task.
+
+    Returns:
+        dict: number of rows per status
+    """
+    counts = {}
+
+    if queue_path and not dry_run:
+        from send_queue import SendQueue
+
+        queue = SendQueue(queue_path)
+        if retry_uncertain:
+            print(f"Re-queued {queue.retry_uncertain()} uncertain messages")
+        statuses = drain_queue(queue, workers)
+        if not resume:
+            rendered = _render(recipients_path, lang_code, defaults, render_processes, chunk_size)
+            statuses = itertools.chain(queue_rows(rendered, queue), statuses)
+    else:
+        queue = None
+        rendered = _render(recipients_path, lang_code, defaults, render_processes, chunk_size)
+        statuses = send_rows(rendered, dry_run=dry_run, workers=workers)
+
+    with open(status_path, 'a' if resume else 'w', encoding='utf-8') as out:
+        for status in statuses:
+            out.write(json.dumps(status, ensure_ascii=False) + '\n')
+            out.flush()
+            counts[status['status']] = counts.get(status['status'], 0) + 1
+
+    if queue is not None:
+        print(f"Queue: {queue.stats()}")
+        queue.close()
+    return counts
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Render and send one email per recipient row")
+    parser.add_argument('recipients', help="CSV or JSONL recipient file")
+    parser.add_argument('-o', '--output', default='merge_status.jsonl', help="Per-row status JSONL")
+    parser.add_argument('--lang', default='en', help="Default language code")
+    parser.add_argument('--sender', help="Default sender email")
+    parser.add_argument('--subject', help="Default subject")
+    parser.add_argument('--body', help="Default body")
+    parser.add_argument('--gender', help="Default mode gender")
+    parser.add_argument('--formal', help="Default mode formality")
+    parser.add_argument('--workers', type=int, default=1, help="Concurrent senders (rate limited per provider)")
+    parser.add_argument('--render-processes', type=int, default=1, help="Render in N processes")
+    parser.add_argument('--chunk-size', type=int, default=256, help="Rows per render task")
+    parser.add_argument('--queue', help="SQLite file for a durable, resumable send queue")
+    parser.add_argument('--resume', action='store_true', help="Only send what is left in --queue")
+    parser.add_argument('--retry-uncertain', action='store_true',
+                        help="Resend --queue messages whose earlier send may or may not have gone through")
+    parser.add_argument('--dry-run', action='store_true', help="Render only, do not send")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this local port")
+    parser.add_argument('--metrics-json', help="Write a metrics snapshot JSON here when done")
+    return parser
+
+
+def defaults_from_args(args) -> dict:
+    defaults = {}
+    if args.sender:
+        defaults['senderemail'] = args.sender
+    if args.subject:
+        defaults['subject'] = args.subject
+    if args.body:
+        defaults['body'] = args.body
+    mode = {}
+    if args.gender:
+        mode['gender'] = args.gender
+    if args.formal:
+        mode['formal'] = args.formal
+    if mode:
+        defaults['mode'] = mode
+    return defaults
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.metrics_port is not None:
+        get_metrics().serve(args.metrics_port)
+    try:
+        counts = merge(args.recipients, args.output, args.lang, defaults_from_args(args),
+                       args.dry_run, args.workers, args.queue, args.resume,
+                       args.render_processes, args.chunk_size, args.retry_uncertain)
+    finally:
+        if args.metrics_json:
+            get_metrics().write_json(args.metrics_json)
+    print(f"Mail merge finished: {counts}")
+    return 0 if set(counts) <= {'sent', 'rendered', 'duplicate'} else 1
+
+
+if __name__ == "__main__":
+    # Run the importable module rather than __main__, so a RowError coming back
+    # from a render worker process (which imports mail_merge) is the same class
+    import mail_merge
+    sys.exit(mail_merge.main())
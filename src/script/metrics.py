@@ -0,0 +1,251 @@
+"""
+Lightweight instrumentation for the render/send pipeline
+
+Timing spans (settings load, render, auth, HTTP send, retry) are recorded as
+histograms, alongside counters for messages, bytes and error classes. The
+collected data can be exported as Prometheus/OpenMetrics text (optionally
+served on a local HTTP endpoint) or written to a JSON file.
+"""
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+PREFIX = 'mail_template_'
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# '# HELP' text per metric name (the name without PREFIX, '_total' or '_seconds')
+HELP = {
+    'messages_sent': 'Messages accepted by the provider',
+    'messages_failed': 'Messages that could not be sent, by provider and error class',
+    'bytes_sent': 'Bytes of message payload sent',
+    'retries': 'Send attempts repeated after a retryable error',
+    'errors': 'Exceptions raised inside a timed stage',
+    'auth': 'Time spent authenticating',
+    'http_send': 'Time spent in provider HTTP requests',
+    'render': 'Time spent rendering templates',
+    'retry_wait': 'Time spent waiting before a retry',
+    'settings_load': 'Time spent reading settings files',
+    'messages_per_second': 'Messages sent per second since start',
+}
+
+
+def _help_line(family, name, suffix=''):
+    """'# HELP' line for a metric family, or None if HELP has no text for it"""
+    if suffix and name.endswith(suffix):
+        name = name[:-len(suffix)]
+    text = HELP.get(name)
+    if text is None:
+        return None
+    return f"# HELP {family} {_escape_help(text)}"
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _escape_help(text):
+    return str(text).replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def error_class(status=None, error=None):
+    """Short label for a failure: http_429, http_5xx, http_4xx or the exception class"""
+    if status is not None:
+        if status == 429:
+            return 'http_429'
+        if status >= 500:
+            return 'http_5xx'
+        if status >= 400:
+            return 'http_4xx'
+    if error is not None:
+        return type(error).__name__
+    return 'unknown'
+
+
+class Metrics:
+    """Thread-safe registry of counters and timing histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """Add `value` to a counter"""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in a histogram"""
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time the enclosed block as `<name>_seconds`; exceptions are counted
+        in errors_total{stage=name, error=<class>} and re-raised
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc('errors_total', stage=name, error=error_class(error=e))
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """Plain-dict view of all metrics (used for the JSON export)"""
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(labels), 'count': data['count'], 'sum': data['sum'],
+                 'buckets': dict(zip([str(bound) for bound in BUCKETS], _cumulative(data['buckets'])))}
+                for (name, labels), data in sorted(self._histograms.items())
+            ]
+            uptime = max(time.time() - self.started_at, 1e-9)
+            sent = sum(value for (name, _), value in self._counters.items() if name == 'messages_sent_total')
+        return {
+            'timestamp': time.time(),
+            'uptime_seconds': uptime,
+            'messages_per_second': sent / uptime,
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def to_prometheus(self, openmetrics=False):
+        """Render all metrics in the Prometheus text format (or OpenMetrics)"""
+        snapshot = self.snapshot()
+        lines = []
+        seen = set()
+
+        for counter in snapshot['counters']:
+            name = PREFIX + counter['name']
+            family = name[:-len('_total')] if openmetrics and name.endswith('_total') else name
+            if family not in seen:
+                help_line = _help_line(family, counter['name'], '_total')
+                if help_line:
+                    lines.append(help_line)
+                lines.append(f'# TYPE {family} counter')
+                seen.add(family)
+            lines.append(f"{name}{_format_labels(counter['labels'].items())} {counter['value']}")
+
+        for histogram in snapshot['histograms']:
+            name = PREFIX + histogram['name']
+            if name not in seen:
+                help_line = _help_line(name, histogram['name'], '_seconds')
+                if help_line:
+                    lines.append(help_line)
+                lines.append(f'# TYPE {name} histogram')
+                seen.add(name)
+            labels = histogram['labels'].items()
+            for bound, count in histogram['buckets'].items():
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        lines.append(_help_line(f'{PREFIX}messages_per_second', 'messages_per_second'))
+        lines.append(f'# TYPE {PREFIX}messages_per_second gauge')
+        lines.append(f"{PREFIX}messages_per_second {snapshot['messages_per_second']}")
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        """Write a snapshot to `path`"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        """
+        Serve /metrics (Prometheus text, or OpenMetrics if requested via Accept)
+        and /metrics.json from a background thread; returns the server
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+                    body = metrics.to_prometheus(openmetrics=openmetrics).encode('utf-8')
+                    content_type = ('application/openmetrics-text; version=1.0.0; charset=utf-8' if openmetrics
+                                    else 'text/plain; version=0.0.4; charset=utf-8')
+                elif path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                """Suppress HTTP server logs"""
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Metrics served at http://{host}:{server.server_port}/metrics")
+        return server
+
+
+def _cumulative(counts):
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Return the process-wide metrics registry"""
+    return _metrics
@@ -0,0 +1,56 @@
+"""
+Build step: compile every template under templates/ to Python modules
+
+    python src/script/precompile.py              # build/precompiled_templates/
+    python src/script/precompile.py --zip        # build/precompiled_templates.zip
+
+The renderer loads the result through jinja2.ModuleLoader when
+MAIL_TEMPLATE_PRECOMPILED points at it, or automatically in a frozen build
+that bundles it next to the executable, e.g. for PyInstaller:
+
+    --add-data "build/precompiled_templates.zip:."
+
+The output is tied to the installed Jinja2 version; rebuild after upgrading.
+"""
+
+import os
+import sys
+import argparse
+
+from substitute import TemplateRenderer, TEMPLATE_DIR, PRECOMPILED_NAME
+
+BUILD_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..', 'build'))
+
+
+def precompile(target: str = None, use_zip: bool = False, template_dir: str = TEMPLATE_DIR) -> str:
+    """Compile all templates into `target` (a directory, or a zip file); returns the path"""
+    if target is None:
+        target = os.path.join(BUILD_DIR, PRECOMPILED_NAME + ('.zip' if use_zip else ''))
+    parent = os.path.dirname(os.path.abspath(target))
+    os.makedirs(parent, exist_ok=True)
+
+    # Same Environment settings as at runtime, so the compiled code matches
+    renderer = TemplateRenderer(template_dir, use_bytecode_cache=False, precompiled='')
+    renderer.env.compile_templates(
+        target,
+        zip='deflated' if use_zip else None,
+        ignore_errors=False,
+        log_function=print
+    )
+    return target
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompile the mail templates to Python modules")
+    parser.add_argument('-o', '--output', help="Target directory (or zip file with --zip)")
+    parser.add_argument('--zip', action='store_true', help="Write a zip archive instead of a directory")
+    parser.add_argument('--templates', default=TEMPLATE_DIR, help="Template directory")
+    args = parser.parse_args(argv)
+
+    target = precompile(args.output, args.zip, args.templates)
+    print(f"Precompiled templates written to {target}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import os
+import json
+import threading
+import time
+from types import MappingProxyType
+
+from metrics import get_metrics
+
+SETTINGS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'settings')
+
+# Files read from settings/<lang_code>/
+LANG_FILES = ['header', 'footer', 'sender']
+
+
+def _freeze(value):
+    """Wrap dicts (recursively) in read-only proxies"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    return value
+
+
+def _load_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class _LangEntry:
+    """Everything loaded from one settings/<lang_code>/ directory"""
+
+    def __init__(self, signature, files, modes, error=None):
+        self.signature = signature
+        self.files = files      # {'header': {...}, 'footer': {...}, 'sender': {...}}
+        self.modes = modes      # {'male': {...}, 'formal': {...}, ...}
+        self.error = error      # JSONDecodeError raised on access, if any
+        self.merged = {}        # (gender, formal) -> pre-merged settings
+
+
+class SettingsStore:
+    """
+    In-memory copy of the settings/ tree.
+
+    Every settings/<lang_code>/*.json and settings/<lang_code>/mode/*.json file
+    is read once and kept as read-only dicts. get() returns one pre-merged
+    mapping per (lang, gender, formal) so rendering does no file I/O.
+    Entries are invalidated by file mtime; the stat() check runs at most once
+    every `check_interval` seconds per language.
+    """
+
+    def __init__(self, settings_dir: str = SETTINGS_DIR, check_interval: float = 2.0):
+        self.settings_dir = settings_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._langs = {}
+        self._checked = {}
+        self._loaded = False
+
+    def _signature(self, lang_code: str):
+        """mtimes of the language directory, its mode directory and all JSON files"""
+        lang_dir = os.path.join(self.settings_dir, lang_code)
+        mode_dir = os.path.join(lang_dir, 'mode')
+        signature = []
+        for directory in (lang_dir, mode_dir):
+            try:
+                signature.append((directory, os.stat(directory).st_mtime_ns))
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.json') and entry.is_file():
+                            signature.append((entry.path, entry.stat().st_mtime_ns))
+            except FileNotFoundError:
+                signature.append((directory, None))
+        return tuple(sorted(signature, key=lambda item: item[0]))
+
+    def _load_lang(self, lang_code: str) -> _LangEntry:
+        with get_metrics().span('settings_load', lang=lang_code):
+            return self._read_lang(lang_code)
+
+    def _read_lang(self, lang_code: str) -> _LangEntry:
+        lang_dir = os.path.join(self.settings_dir, lang_code)
+        mode_dir = os.path.join(lang_dir, 'mode')
+        signature = self._signature(lang_code)
+        files = {}
+        modes = {}
+        path = None
+        try:
+            for base_name in LANG_FILES:
+                path = os.path.join(lang_dir, f"{base_name}.json")
+                if os.path.exists(path):
+                    files[base_name] = _freeze(_load_json(path))
+
+            if os.path.isdir(mode_dir):
+                for file_name in sorted(os.listdir(mode_dir)):
+                    if file_name.endswith('.json'):
+                        path = os.path.join(mode_dir, file_name)
+                        modes[file_name[:-len('.json')]] = _freeze(_load_json(path))
+        except json.JSONDecodeError as e:
+            print(f"[DEBUG] JSON Error in file: {path}")
+            print(f"[DEBUG] {e}")
+            return _LangEntry(signature, {}, {}, error=e)
+
+        return _LangEntry(signature, files, modes)
+
+    def _load_all(self):
+        """Read the whole settings/ tree (one directory per language)"""
+        if os.path.isdir(self.settings_dir):
+            for name in sorted(os.listdir(self.settings_dir)):
+                if os.path.isdir(os.path.join(self.settings_dir, name)):
+                    self._langs[name] = self._load_lang(name)
+                    self._checked[name] = time.monotonic()
+        self._loaded = True
+
+    def _entry(self, lang_code: str) -> _LangEntry:
+        now = time.monotonic()
+        entry = self._langs.get(lang_code)
+        if self._loaded and entry is not None and now - self._checked.get(lang_code, 0) < self.check_interval:
+            return entry
+
+        with self._lock:
+            if not self._loaded:
+                self._load_all()
+                entry = self._langs.get(lang_code)
+                if entry is not None:
+                    return entry
+
+            entry = self._langs.get(lang_code)
+            if entry is None or entry.signature != self._signature(lang_code):
+                entry = self._load_lang(lang_code)
+                self._langs[lang_code] = entry
+            self._checked[lang_code] = now
+            return entry
+
+    def reload(self):
+        """Drop everything and re-read the settings/ tree"""
+        with self._lock:
+            self._langs = {}
+            self._checked = {}
+            self._load_all()
+
+    def languages(self) -> list:
+        """Language codes that have a settings directory"""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load_all()
+        return list(self._langs.keys())
+
+    def file(self, lang_code: str, base_name: str):
+        """Return settings/<lang_code>/<base_name>.json as a read-only dict, or None"""
+        entry = self._entry(lang_code)
+        if entry.error is not None:
+            raise entry.error
+        return entry.files.get(base_name)
+
+    def get(self, lang_code: str, gender: str = None, formal: str = None):
+        """
+        Return the pre-merged settings for one (lang, gender, formal) combination
+
+        The result maps 'header'/'footer'/'sender' to their files (only those
+        that exist) and 'mode' to the gender file overridden by the formality file.
+        """
+        entry = self._entry(lang_code)
+        if entry.error is not None:
+            raise entry.error
+
+        key = (gender, formal)
+        merged = entry.merged.get(key)
+        if merged is None:
+            mode = {}
+            for mode_name in key:
+                if mode_name is not None and mode_name in entry.modes:
+                    mode.update(entry.modes[mode_name])
+            merged = MappingProxyType({**entry.files, 'mode': MappingProxyType(mode)})
+            entry.merged[key] = merged
+        return merged
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SettingsStore:
+    """Return the shared module-level settings store"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SettingsStore()
+    return _store
+
+
+def set_store(store: SettingsStore) -> None:
+    """Inject a custom settings store (e.g. a different settings directory)"""
+    global _store
+    _store = store
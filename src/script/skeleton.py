@@ -0,0 +1,204 @@
+"""
+Skeleton render mode: pre-rendered template text with per-recipient slots
+
+Apart from a few recipient fields (SLOTS), everything in mail_template.html is
+fixed by the language/mode settings. The template is rendered once per
+distinct set of non-slot values with sentinel strings in the slots, split
+into static pieces, and each recipient is then produced by a single string
+join instead of a Jinja2 render.
+
+Output is identical to TemplateRenderer.render(). Anything the skeleton cannot
+reproduce exactly (non-str slot values, a slot used outside a plain
+{{ ... }} output, a custom finalize/undefined) falls back to the full render.
+
+Enable it for get_renderer() with MAIL_TEMPLATE_RENDER_MODE=skeleton.
+tests/test_skeleton.py compares both render paths byte for byte.
+"""
+
+import re
+import threading
+from collections import ChainMap
+
+from jinja2 import nodes, meta, Undefined
+from markupsafe import escape
+
+from substitute import TemplateRenderer, TEMPLATE_NAME
+from metrics import get_metrics
+
+# Recipient-specific template variables ('a.b' is attribute/item b of variable a)
+SLOTS = ('receiver.name', 'body', 'closing', 'name', 'year')
+
+_SENTINEL = '\x00slot{}\x00'
+_SENTINEL_RE = re.compile('\x00slot([0-9]+)\x00')
+
+# Marker for a variable that is not defined at all
+_MISSING = object()
+
+
+def _lookup(maps, name):
+    """ChainMap lookup without the ChainMap overhead"""
+    for mapping in maps:
+        if name in mapping:
+            return mapping[name]
+    return _MISSING
+
+
+class _TemplateInfo:
+    """What the skeleton mode needs to know about one compiled template"""
+
+    def __init__(self, usable, free_names=(), autoescape=False):
+        self.usable = usable
+        self.free_names = free_names    # referenced variables that are not slots
+        self.autoescape = autoescape
+
+
+class _Skeleton:
+    def __init__(self, pieces, positions):
+        self.pieces = pieces            # static text with None where a slot goes
+        self.positions = positions      # (index in pieces, slot number)
+
+
+def _slot_outputs_only(ast, slots):
+    """
+    True if every use of a slot variable is a bare {{ name }} / {{ a.b }}
+    output, so it can be filled with its string value
+    """
+    roots = {slot.split('.')[0]: slot for slot in slots}
+
+    def allowed(node, parent, grandparent):
+        slot = roots[node.name]
+        if '.' not in slot:
+            return isinstance(parent, nodes.Output)
+        return (isinstance(parent, nodes.Getattr) and parent.node is node
+                and parent.attr == slot.split('.', 1)[1] and isinstance(grandparent, nodes.Output))
+
+    def walk(node, parent, grandparent):
+        if isinstance(node, nodes.Name) and node.name in roots:
+            if node.ctx != 'load' or not allowed(node, parent, grandparent):
+                return False
+        return all(walk(child, node, parent) for child in node.iter_child_nodes())
+
+    return walk(ast, None, None)
+
+
+class SkeletonRenderer(TemplateRenderer):
+    """
+    TemplateRenderer that fills pre-rendered skeletons instead of rendering
+
+    Args:
+        max_skeletons: cached skeletons before the cache is cleared
+        (other arguments as TemplateRenderer)
+    """
+
+    def __init__(self, *args, max_skeletons: int = 256, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_skeletons = max_skeletons
+        self._info = {}
+        self._skeletons = {}
+        self._lock = threading.Lock()
+
+    def _template_info(self, jinja_template, template_name):
+        info = self._info.get(jinja_template)
+        if info is not None:
+            return info
+
+        info = _TemplateInfo(False)
+        if self.env.finalize is None and self.env.undefined is Undefined:
+            try:
+                source = self.env.loader.get_source(self.env, template_name)[0]
+                ast = self.env.parse(source)
+            except Exception:
+                # e.g. precompiled templates, which have no source
+                ast = None
+            if ast is not None and _slot_outputs_only(ast, SLOTS):
+                roots = {slot.split('.')[0] for slot in SLOTS}
+                free_names = tuple(sorted(meta.find_undeclared_variables(ast) - roots))
+                autoescape = self.env.autoescape
+                if callable(autoescape):
+                    autoescape = autoescape(template_name)
+                info = _TemplateInfo(True, free_names, bool(autoescape))
+
+        with self._lock:
+            # Keyed by the template object, so an edited (reloaded) template is analysed again
+            self._info = {key: value for key, value in self._info.items() if key.name != template_name}
+            self._info[jinja_template] = info
+        return info
+
+    def _slot_values(self, maps):
+        """The str value of every slot, or None if one cannot be filled as text"""
+        values = []
+        for slot in SLOTS:
+            root, _, attr = slot.partition('.')
+            value = _lookup(maps, root)
+            if attr:
+                if value is _MISSING:
+                    return None
+                value = self.env.getattr(value, attr)
+            if value is _MISSING:
+                value = ''      # An undefined name renders as an empty string
+            if type(value) is not str:
+                return None
+            values.append(value)
+        return values
+
+    def _build(self, jinja_template, maps):
+        """Render once with sentinels in the slots and split the result"""
+        sentinels = {}
+        for number, slot in enumerate(SLOTS):
+            root, _, attr = slot.partition('.')
+            if attr:
+                sentinels[root] = {attr: _SENTINEL.format(number)}
+            else:
+                sentinels[root] = _SENTINEL.format(number)
+
+        context = jinja_template.new_context(ChainMap(sentinels, *maps), shared=True)
+        text = self.env.concat(jinja_template.root_render_func(context))
+
+        parts = _SENTINEL_RE.split(text)
+        pieces = []
+        positions = []
+        for index, part in enumerate(parts):
+            if index % 2:
+                positions.append((len(pieces), int(part)))
+                pieces.append(None)
+            elif part:
+                pieces.append(part)
+        return _Skeleton(pieces, positions)
+
+    def render(self, lang_code: str, filled_data: dict, template_name: str = TEMPLATE_NAME) -> str:
+        """Render one message; same result as TemplateRenderer.render()"""
+        jinja_template = self.get_template(template_name)
+        info = self._template_info(jinja_template, template_name)
+        if not info.usable:
+            return super().render(lang_code, filled_data, template_name)
+
+        maps = self.build_vars(lang_code, filled_data).maps + [jinja_template.globals]
+        values = self._slot_values(maps)
+        if values is None:
+            return super().render(lang_code, filled_data, template_name)
+
+        free_values = tuple(_lookup(maps, name) for name in info.free_names)
+        if any(isinstance(value, str) and '\x00' in value for value in free_values):
+            # Could be mistaken for a slot sentinel
+            return super().render(lang_code, filled_data, template_name)
+        key = (jinja_template, free_values)
+        try:
+            skeleton = self._skeletons.get(key)
+        except TypeError:
+            # Unhashable (e.g. dict) non-slot value: no skeleton for this combination
+            return super().render(lang_code, filled_data, template_name)
+        if skeleton is None:
+            skeleton = self._build(jinja_template, maps)
+            with self._lock:
+                if len(self._skeletons) >= self.max_skeletons:
+                    self._skeletons.clear()
+                self._skeletons[key] = skeleton
+
+        with get_metrics().span('render'):
+            if info.autoescape:
+                values = [str(escape(value)) for value in values]
+            pieces = skeleton.pieces.copy()
+            for index, number in skeleton.positions:
+                pieces[index] = values[number]
+            return ''.join(pieces)
+
@@ -2,12 +2,13 @@
 # https://jinja.palletsprojects.com/en/stable/
 # https://omomuki-tech.com/archives/1370
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, ModuleLoader, ChoiceLoader
 import os
 import json
 from pathlib import Path
 import sys
 from datetime import datetime
+from collections import ChainMap
 
 # Add the type directory to the Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'type'))
@@ -17,106 +18,196 @@ from Header import Header
 from Footer import Footer
 from EMailComponent import EMailComponent
 from Lang import Lang
+from settings_store import SettingsStore, get_store, SETTINGS_DIR, LANG_FILES
+from metrics import get_metrics
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'templates')
+TEMPLATE_NAME = 'mail_template.html'
+
+# Output of src/script/precompile.py; bundled next to the executable in frozen builds
+PRECOMPILED_NAME = 'precompiled_templates'
+
+# Fields copied to the top level from each language file
+LAYER_FIELDS = {
+    'header': ['imageURL', 'greeting_for_name_prefix', 'greeting_for_name_postfix', 'greeting'],
+    'footer': ['closing', 'button_text', 'button_link'],
+    'sender': ['name']
+}
+
+
+def precompiled_path():
+    """
+    Location of precompiled templates to load, or None
+
+    MAIL_TEMPLATE_PRECOMPILED selects a directory or zip written by precompile.py
+    ('0' disables it). Frozen (PyInstaller) builds use the bundled copy if present.
+    """
+    configured = os.getenv('MAIL_TEMPLATE_PRECOMPILED', '')
+    if configured:
+        return None if configured == '0' else configured
+    if getattr(sys, 'frozen', False):
+        bundle_dir = getattr(sys, '_MEIPASS', os.path.dirname(sys.executable))
+        for name in (PRECOMPILED_NAME, PRECOMPILED_NAME + '.zip'):
+            path = os.path.join(bundle_dir, name)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+class TemplateRenderer:
+    """
+    Keeps one Jinja2 Environment alive across renders.
+
+    Compiled templates are cached in memory and re-checked against the
+    template file's mtime (auto_reload), and the compiled bytecode is also
+    cached on disk so a fresh process skips the parse/compile step.
+    Templates precompiled to Python modules (see precompile.py) are loaded
+    first when available, so nothing is compiled at runtime.
+    Settings come from the in-memory SettingsStore.
+    """
+
+    def __init__(self, template_dir: str = TEMPLATE_DIR, bytecode_cache_dir: str = None,
+                 use_bytecode_cache: bool = True, cache_size: int = 50, store: SettingsStore = None,
+                 precompiled: str = None):
+        self.template_dir = template_dir
+        self.store = store if store is not None else get_store()
+        self._layers = {}
+        bytecode_cache = None
+        if use_bytecode_cache:
+            # None lets Jinja2 pick a per-user directory under the temp dir
+            if bytecode_cache_dir:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        loader = FileSystemLoader(template_dir)
+        self.precompiled = precompiled if precompiled is not None else precompiled_path()
+        if self.precompiled:
+            # Templates missing from the precompiled set still come from the files
+            loader = ChoiceLoader([ModuleLoader(self.precompiled), loader])
+        self.env = Environment(
+            loader=loader,
+            bytecode_cache=bytecode_cache,
+            auto_reload=True,
+            cache_size=cache_size
+        )
+
+    def get_template(self, name: str = TEMPLATE_NAME):
+        """Return the compiled template, recompiling only if the file changed"""
+        return self.env.get_template(name)
+
+    def layers(self, lang_code: str, gender: str = None, formal: str = None):
+        """
+        Return the precomputed (top, base) variable layers for one settings combination
+
+        `top` holds everything that overrides recipient data (the language files,
+        the header/footer/sender fields they define and the mode overrides);
+        `base` holds the '' defaults for fields a file exists for but doesn't set.
+        """
+        settings = self.store.get(lang_code, gender, formal)
+        key = (lang_code, gender, formal)
+        cached = self._layers.get(key)
+        if cached is not None and cached[0] is settings:
+            return cached[1], cached[2]
+
+        top = {name: settings[name] for name in LANG_FILES if name in settings}
+        base = {}
+        for name, fields in LAYER_FIELDS.items():
+            if name not in settings:
+                continue
+            for field in fields:
+                if field in settings[name]:
+                    top[field] = settings[name][field]
+                else:
+                    base[field] = ''
+
+        # Mode-specific overrides (settings/lang_code/mode/<gender>.json, then <formal>.json)
+        top.update(settings['mode'])
+
+        self._layers[key] = (settings, top, base)
+        return top, base
+
+    def build_vars(self, lang_code: str, filled_data: dict) -> ChainMap:
+        """Overlay recipient data on the precomputed layers for lang_code and mode"""
+        mode_data = filled_data.get('mode')
+        gender = formal = None
+        if mode_data is not None:
+            if 'gender' in mode_data:
+                gender = str(mode_data['gender'])
+            if 'formal' in mode_data:
+                formal = str(mode_data['formal'])
+        top, base = self.layers(lang_code, gender, formal)
+
+        return ChainMap(top, {'year': str(datetime.now().year)}, filled_data, base)
+
+    def render(self, lang_code: str, filled_data: dict, template_name: str = TEMPLATE_NAME) -> str:
+        """Render one message for the given language and recipient data"""
+        with get_metrics().span('render'):
+            jinja_template = self.get_template(template_name)
+            # shared=True renders straight from the ChainMap instead of copying it into a dict
+            context = jinja_template.new_context(
+                ChainMap(*self.build_vars(lang_code, filled_data).maps, jinja_template.globals),
+                shared=True
+            )
+            try:
+                return self.env.concat(jinja_template.root_render_func(context))
+            except Exception:
+                self.env.handle_exception()
+
+    def generate(self, lang_code: str, filled_data: dict, template_name: str = TEMPLATE_NAME):
+        """Render one message as a stream of text chunks instead of one string"""
+        jinja_template = self.get_template(template_name)
+        context = jinja_template.new_context(
+            ChainMap(*self.build_vars(lang_code, filled_data).maps, jinja_template.globals),
+            shared=True
+        )
+        try:
+            yield from jinja_template.root_render_func(context)
+        except Exception:
+            yield self.env.handle_exception()
+
+
+_renderer = None
+
+
+def get_renderer() -> TemplateRenderer:
+    """
+    Return the shared module-level renderer, creating it on first use
+
+    MAIL_TEMPLATE_RENDER_MODE=skeleton selects the SkeletonRenderer (skeleton.py).
+    """
+    global _renderer
+    if _renderer is None:
+        if os.getenv('MAIL_TEMPLATE_RENDER_MODE', '') == 'skeleton':
+            from skeleton import SkeletonRenderer
+            _renderer = SkeletonRenderer()
+        else:
+            _renderer = TemplateRenderer()
+    return _renderer
+
+
+def set_renderer(renderer: TemplateRenderer) -> None:
+    """Inject a custom renderer (e.g. a different template or cache directory)"""
+    global _renderer
+    _renderer = renderer
+
+
+def template_from_dict(lang_code: str, filled_data: dict) -> str:
+    """Render filled data held in memory (no file I/O)"""
+    return get_renderer().render(lang_code, filled_data)
+
+
+def generate_from_dict(lang_code: str, filled_data: dict):
+    """Stream the rendered text in chunks (for large bodies)"""
+    return get_renderer().generate(lang_code, filled_data)
+
 
 def template(lang_code: str, filled_data_file_path: str) -> str:
-    # Get the absolute path to templates directory
-    template_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'templates')
-    
-    # 1. Environment creation and setup
-    env = Environment(loader=FileSystemLoader(template_dir))
-    
-    # 2. Load template (specify filename)
-    jinja_template = env.get_template('mail_template.html')
-    
-    # 3. Load filled_data_file
-    settings_path = os.path.join(os.path.dirname(__file__), '..', '..', 'settings', filled_data_file_path)
+    # 1. Load filled_data_file
+    settings_path = os.path.join(SETTINGS_DIR, filled_data_file_path)
     with open(settings_path, "r", encoding="utf-8") as f:
         filled_data = json.load(f)
-    
-    # 4. Load language-specific files from settings/lang_code/*.json
-    lang_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'settings', lang_code)
-    lang_data = {}
-    
-    # Load header.json, footer.json, sender.json from lang_code directory
-    for file_name in ['header.json', 'footer.json', 'sender.json']:
-        lang_file_path = os.path.join(lang_dir, file_name)
-        if os.path.exists(lang_file_path):
-            try:
-                with open(lang_file_path, "r", encoding="utf-8") as f:
-                    file_data = json.load(f)
-                    # Merge into lang_data with file prefix
-                    base_name = file_name.replace('.json', '')
-                    lang_data[base_name] = file_data
-            except json.JSONDecodeError as e:
-                print(f"[DEBUG] JSON Error in file: {lang_file_path}")
-                print(f"[DEBUG] {e}")
-                raise
-    
-    # 5. Combine filled_data + lang_data
-    template_vars = {
-        **filled_data,  # Base data from filled_data_file
-        **lang_data,    # Language-specific data
-        'year': str(datetime.now().year)
-    }
-    
-    # Update specific fields with language data if available
-    if 'header' in lang_data:
-        template_vars.update({
-            'imageURL': lang_data['header'].get('imageURL', template_vars.get('imageURL', '')),
-            'greeting_for_name_prefix': lang_data['header'].get('greeting_for_name_prefix', template_vars.get('greeting_for_name_prefix', '')),
-            'greeting_for_name_postfix': lang_data['header'].get('greeting_for_name_postfix', template_vars.get('greeting_for_name_postfix', '')),
-            'greeting': lang_data['header'].get('greeting', template_vars.get('greeting', ''))
-        })
-    
-    if 'footer' in lang_data:
-        template_vars.update({
-            'closing': lang_data['footer'].get('closing', template_vars.get('closing', '')),
-            'button_text': lang_data['footer'].get('button_text', template_vars.get('button_text', '')),
-            'button_link': lang_data['footer'].get('button_link', template_vars.get('button_link', ''))
-        })
-    
-    if 'sender' in lang_data:
-        template_vars.update({
-            'name': lang_data['sender'].get('name', template_vars.get('name', ''))
-        })
-    
-    # 5.5. Load mode-specific files from settings/lang_code/mode/*.json
-    if 'mode' in filled_data:
-        mode_dir = os.path.join(lang_dir, 'mode')
-        mode_data = filled_data['mode']
-        
-        # Load gender-specific file (e.g., male.json, female.json, neutral.json)
-        if 'gender' in mode_data:
-            gender_file = os.path.join(mode_dir, f"{mode_data['gender']}.json")
-            if os.path.exists(gender_file):
-                try:
-                    with open(gender_file, "r", encoding="utf-8") as f:
-                        gender_data = json.load(f)
-                        # Override template_vars with gender-specific data
-                        template_vars.update(gender_data)
-                except json.JSONDecodeError as e:
-                    print(f"[DEBUG] JSON Error in file: {gender_file}")
-                    print(f"[DEBUG] {e}")
-                    raise
-
-        # Load formality-specific file (e.g., formal.json, informal.json)
-        if 'formal' in mode_data:
-            formal_file = os.path.join(mode_dir, f"{mode_data['formal']}.json")
-            if os.path.exists(formal_file):
-                try:
-                    with open(formal_file, "r", encoding="utf-8") as f:
-                        formal_data = json.load(f)
-                        # Override template_vars with formality-specific data
-                        template_vars.update(formal_data)
-                except json.JSONDecodeError as e:
-                    print(f"[DEBUG] JSON Error in file: {formal_file}")
-                    print(f"[DEBUG] {e}")
-                    raise
-    
-    # 6. Render template
-    output = jinja_template.render(template_vars)
-    
-    return output
+
+    # 2. Render with the shared (cached) environment
+    return template_from_dict(lang_code, filled_data)
 
 if __name__ == "__main__":
     # Example usage: render the mail template
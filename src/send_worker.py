@@ -0,0 +1,127 @@
+"""
+Background rendering and sending for the GUI
+
+Each send is a SendJob run on a QThreadPool, so authentication (including the
+Outlook browser login) and the network call never block the Qt event loop.
+Jobs report back through Qt signals, which are delivered on the GUI thread.
+"""
+
+import os
+import sys
+import itertools
+
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'script'))
+sys.path.append(os.path.join(os.path.dirname(__file__), 'type'))
+sys.path.append(os.path.join(os.path.dirname(__file__), 'email'))
+
+from substitute import template_from_dict
+from send_email import send_email
+from Message import Message
+
+# Job states shown in the queue view
+QUEUED = 'queued'
+RENDERING = 'rendering'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class SendSignals(QObject):
+    """Signals of one job (QRunnable is not a QObject, so it cannot emit itself)"""
+    progress = pyqtSignal(int, str)         # job id, state
+    finished = pyqtSignal(int, str, str)    # job id, final state, error message
+
+
+class SendJob(QRunnable):
+    """Render one message and send it"""
+
+    def __init__(self, job_id, lang_code, filled_data, archive_dir=None):
+        super().__init__()
+        self.job_id = job_id
+        self.lang_code = lang_code
+        self.filled_data = filled_data
+        self.archive_dir = archive_dir
+        self.message = Message.from_dict(filled_data)
+        self.signals = SendSignals()
+        self.cancelled = False
+        # The queue keeps its own reference; Qt must not delete the job after run()
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        """Stop the job if it has not started sending yet"""
+        self.cancelled = True
+
+    def run(self):
+        if self.cancelled:
+            self.signals.finished.emit(self.job_id, CANCELLED, '')
+            return
+        try:
+            self.signals.progress.emit(self.job_id, RENDERING)
+            html_output = template_from_dict(self.lang_code, self.filled_data)
+            if self.cancelled:
+                self.signals.finished.emit(self.job_id, CANCELLED, '')
+                return
+
+            self.signals.progress.emit(self.job_id, SENDING)
+            if send_email(self.message, html_output, archive_dir=self.archive_dir):
+                self.signals.finished.emit(self.job_id, SENT, '')
+            else:
+                self.signals.finished.emit(self.job_id, FAILED, "Sending failed (see log)")
+        except Exception as e:
+            print(f"[DEBUG] {str(e)}")
+            self.signals.finished.emit(self.job_id, FAILED, str(e))
+
+
+class SendJobQueue(QObject):
+    """
+    Runs SendJobs on a thread pool and relays their state changes
+
+    Args:
+        max_workers: messages rendered/sent at the same time
+    """
+    changed = pyqtSignal(int, str, str)     # job id, state, error message
+
+    def __init__(self, max_workers=4, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+        self.jobs = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, lang_code, filled_data, archive_dir=None):
+        """Queue one message; returns the job"""
+        job = SendJob(next(self._ids), lang_code, filled_data, archive_dir)
+        job.signals.progress.connect(self._on_progress)
+        job.signals.finished.connect(self._on_finished)
+        self.jobs[job.job_id] = job
+        self.pool.start(job)
+        self.changed.emit(job.job_id, QUEUED, '')
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a job; jobs that are already sending run to completion"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.cancel()
+        if self.pool.tryTake(job):
+            # Never started: report it here, run() will not be called
+            self._on_finished(job_id, CANCELLED, '')
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def pending(self):
+        """Number of jobs not finished yet"""
+        return len(self.jobs)
+
+    def _on_progress(self, job_id, state):
+        self.changed.emit(job_id, state, '')
+
+    def _on_finished(self, job_id, state, error):
+        if self.jobs.pop(job_id, None) is not None:
+            self.changed.emit(job_id, state, error)
@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+
+@dataclass(frozen=True)  # Makes it immutable
+class Message:
+    """Envelope of one outgoing email (everything except the rendered HTML)"""
+    sender_email: str
+    receiver_email: str
+    receiver_name: str
+    subject: str
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Message':
+        """Create Message from filled data (the shape of settings/data.json)"""
+        return cls(
+            sender_email=data.get('senderemail', 'unknown@example.com'),
+            receiver_email=data.get('receiveremail', 'unknown@example.com'),
+            receiver_name=data.get('receiver', {}).get('name', 'Recipient'),
+            subject=data.get('subject', 'No Subject')
+        )
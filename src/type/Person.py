@@ -1,31 +1,29 @@
 from dataclasses import dataclass
 import os
+import sys
 import json
 
+# Settings are served from the shared in-memory store
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'script'))
+
+from settings_store import get_store
+
 @dataclass(frozen=True)  # Makes it immutable
 class Person:
     name: str
 
     def load_language(self, lang_code: str) -> 'Person':
         """Load person data for the specified language and return new immutable instance"""
-        # Get the path to the language-specific sender file
-        settings_path = os.path.join(
-            os.path.dirname(__file__), '..', '..', 'settings', lang_code, 'sender.json'
-        )
-        
         try:
-            with open(settings_path, 'r', encoding='utf-8') as f:
-                lang_data = json.load(f)
-            
-            return Person(
-                name=lang_data.get('name', self.name)
-            )
-        except FileNotFoundError:
-            # Return current instance if language file doesn't exist
+            lang_data = get_store().file(lang_code, 'sender')
+        except json.JSONDecodeError:
+            # Error already reported by the store; keep current instance
             return self
-        except json.JSONDecodeError as e:
-            print(f"[DEBUG] JSON Error in file: {settings_path}")
-            print(f"[DEBUG] {e}")
-            # Return current instance but print error
+
+        if lang_data is None:
+            # Return current instance if language file doesn't exist
             return self
 
+        return Person(
+            name=lang_data.get('name', self.name)
+        )
@@ -0,0 +1,16 @@
+"""
+Shared test setup: the src/ module layout and local stub servers
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for sub in ('script', 'type', 'email', 'auth'):
+    sys.path.append(os.path.join(ROOT, 'src', sub))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+# Keep tests away from the real token cache (read when token_manager is imported)
+os.environ.setdefault('MAIL_TEMPLATE_TOKEN_CACHE',
+                      os.path.join(tempfile.mkdtemp(prefix='mail_template_tests-'), 'tokens.json'))
@@ -0,0 +1,108 @@
+"""
+Async providers: abstract base, and per-event-loop semaphores and clients
+"""
+
+import json
+import time
+import asyncio
+
+import httpx
+import pytest
+
+from stubs import StubServer
+from token_manager import get_token_manager
+from async_providers import _AsyncProvider, AsyncOutlookClient, aclose_clients
+
+ACCOUNT = 'async@outlook.com'
+
+
+@pytest.fixture(autouse=True)
+def token():
+    manager = get_token_manager(f"outlook:{ACCOUNT}", lambda token: None, cache=None, background=False)
+    manager.set_token({'access_token': 'test', 'refresh_token': None, 'expires_at': time.time() + 3600})
+
+
+def _messages(count):
+    return [
+        {'sender_email': ACCOUNT, 'recipient_email': f"r{index}@example.com",
+         'recipient_name': 'Recipient', 'subject': 'Subject', 'html_body': '<p>Hello</p>'}
+        for index in range(count)
+    ]
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        _AsyncProvider(ACCOUNT)
+
+    class Incomplete(_AsyncProvider):
+        provider = 'outlook'
+
+        def _access_token(self, token):
+            return token['access_token']
+
+    with pytest.raises(TypeError):
+        Incomplete(ACCOUNT)
+
+
+def test_one_client_across_event_loops():
+    outlook = AsyncOutlookClient(account=ACCOUNT, concurrency=2)
+
+    async def send(count):
+        try:
+            return await outlook.send_many(_messages(count))
+        finally:
+            await aclose_clients()
+
+    with StubServer() as stub:
+        outlook.graph_api_url = stub.url
+        assert asyncio.run(send(3)) == ([], [])
+        # A new loop gets its own semaphore instead of reusing the first loop's
+        assert asyncio.run(send(3)) == ([], [])
+        assert stub.requests == 6
+
+
+def test_passed_client_is_bound_to_one_loop():
+    transport = httpx.MockTransport(lambda request: httpx.Response(202))
+    client = httpx.AsyncClient(transport=transport)
+    outlook = AsyncOutlookClient(account=ACCOUNT, client=client)
+    message = _messages(1)[0]
+
+    assert asyncio.run(outlook.send_email(**message))
+    with pytest.raises(RuntimeError):
+        asyncio.run(outlook.send_email(**message))
+
+
+def test_send_many_does_not_resend_without_response(monkeypatch):
+    attempts = {}
+
+    def handle(request):
+        message = json.loads(request.content)['message']
+        recipient = message['toRecipients'][0]['emailAddress']['address'].split('@')[0]
+        attempts[recipient] = attempts.get(recipient, 0) + 1
+        if recipient == 'r1':
+            raise httpx.ReadTimeout('no response', request=request)
+        if recipient == 'r2' and attempts[recipient] == 1:
+            raise httpx.ConnectError('refused', request=request)
+        if recipient == 'r3':
+            return httpx.Response(400)
+        return httpx.Response(202)
+
+    async def no_wait(delay):
+        pass
+
+    async def send(messages):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        outlook = AsyncOutlookClient(account=ACCOUNT, client=client)
+        monkeypatch.setattr(asyncio, 'sleep', no_wait)
+        try:
+            return await outlook.send_many(messages)
+        finally:
+            await client.aclose()
+
+    messages = _messages(4)
+    failed, uncertain = asyncio.run(send(messages))
+
+    # The timed-out request may have been delivered; the refused connect sent nothing
+    assert uncertain == [messages[1]]
+    assert failed == [messages[3]]
+    assert attempts == {'r0': 1, 'r1': 1, 'r2': 2, 'r3': 1}
@@ -0,0 +1,135 @@
+"""
+GmailAuth.send_batch over googleapiclient's HttpMockSequence (no network)
+"""
+
+import json
+import base64
+
+import pytest
+from googleapiclient.http import BatchHttpRequest, HttpMockSequence
+
+from google_oauth2 import GmailAuth, build_gmail_service
+
+BOUNDARY = 'batch_boundary'
+
+
+def _batch_response(statuses):
+    """multipart/mixed batch reply with one part per request_id ('0', '1', ...)"""
+    parts = []
+    for index, status in enumerate(statuses):
+        body = json.dumps({'id': f"m{index}"} if status == 200 else {'error': {'code': status}})
+        parts.append(
+            f"--{BOUNDARY}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-batch + {index}>\r\n\r\n"
+            f"HTTP/1.1 {status} Status\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            f"{body}\r\n"
+        )
+    headers = {'status': '200', 'content-type': f'multipart/mixed; boundary="{BOUNDARY}"'}
+    return headers, ''.join(parts) + f"--{BOUNDARY}--\r\n"
+
+
+def _sent(message_id):
+    return {'status': '200'}, json.dumps({'id': message_id})
+
+
+class DroppingHttp(HttpMockSequence):
+    """HttpMockSequence that raises instead of answering the request numbers in `drop`"""
+
+    def __init__(self, iterable, drop):
+        super().__init__(iterable)
+        self.drop = set(drop)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if len(self.request_sequence) in self.drop:
+            self.request_sequence.append((uri, method, body, headers))
+            raise TimeoutError('connection dropped')
+        return super().request(uri, method, body, headers, **kwargs)
+
+
+def _gmail(responses, drop=()):
+    http = DroppingHttp(responses, drop)
+    gmail = GmailAuth(account='batch@gmail.com', http=http)
+    gmail.service = build_gmail_service(http=http)
+    return gmail, http
+
+
+def _messages(count):
+    return [
+        {'sender_email': 'batch@gmail.com', 'recipient_email': f"r{index}@example.com",
+         'recipient_name': 'Recipient', 'subject': 'Subject', 'html_body': '<p>Hello</p>'}
+        for index in range(count)
+    ]
+
+
+def test_send_batch_one_request_per_chunk():
+    gmail, http = _gmail([_batch_response([200] * 3), _batch_response([200] * 2)])
+
+    assert gmail.send_batch(_messages(5), batch_size=3) == ([], [])
+    assert len(http.request_sequence) == 2
+
+
+def test_send_batch_maps_results_to_recipients():
+    gmail, http = _gmail([
+        _batch_response([200, 429, 400]),
+        _sent('retried'),               # individual fallback for the throttled item
+    ])
+    messages = _messages(3)
+
+    # 400 is permanent and returned for re-queueing; 429 is resent on its own
+    assert gmail.send_batch(messages) == ([messages[2]], [])
+    assert len(http.request_sequence) == 2
+
+
+def test_send_batch_falls_back_when_the_batch_fails():
+    gmail, http = _gmail([
+        ({'status': '500'}, ''),
+        _sent('a'),
+        ({'status': '503'}, ''),
+        _sent('c'),
+    ])
+    messages = _messages(3)
+
+    assert gmail.send_batch(messages) == ([messages[1]], [])
+    assert len(http.request_sequence) == 4
+
+
+def test_send_batch_without_answer_is_not_resent():
+    gmail, http = _gmail([_batch_response([200, 200])], drop={0})
+    messages = _messages(4)
+
+    # The first batch may have been delivered; the second one is answered
+    assert gmail.send_batch(messages, batch_size=2) == ([], messages[:2])
+    assert len(http.request_sequence) == 2
+
+
+def test_send_batch_keeps_results_received_before_an_error(monkeypatch):
+    execute = BatchHttpRequest.execute
+
+    def execute_then_fail(self, http=None):
+        execute(self, http=http)
+        raise TimeoutError('connection dropped')
+
+    monkeypatch.setattr(BatchHttpRequest, 'execute', execute_then_fail)
+    gmail, http = _gmail([_batch_response([200, 503, 400]), _sent('retried')])
+    messages = _messages(3)
+
+    # Only the item with a definite 503 is sent again; the accepted one is not
+    assert gmail.send_batch(messages) == ([messages[2]], [])
+    assert len(http.request_sequence) == 2
+
+
+def test_send_batch_sends_raw_messages():
+    gmail, http = _gmail([_batch_response([200])])
+    assert gmail.send_batch(_messages(1)) == ([], [])
+
+    uri, method, body, headers = http.request_sequence[0]
+    assert method == 'POST' and uri.endswith('/batch')
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    raw = json.loads(body[body.index('{"raw"'):body.rindex('}') + 1])['raw']
+    decoded = base64.urlsafe_b64decode(raw)
+    assert b'To: Recipient <r0@example.com>' in decoded
+    assert b'From: batch@gmail.com' in decoded
+    assert decoded.endswith(b'<p>Hello</p>\n')
@@ -0,0 +1,64 @@
+"""
+mail_merge: bad rows become per-row statuses instead of stopping the merge
+"""
+
+import json
+
+import pytest
+
+from mail_merge import merge, _unflatten, RowError
+
+
+def _statuses(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_jsonl_rows_that_are_not_objects(tmp_path):
+    recipients = tmp_path / 'recipients.jsonl'
+    recipients.write_text('\n'.join([
+        '[1, 2]',
+        '"x"',
+        '{"receiveremail": "a@example.com", "receiver": {"name": "A"}}',
+        '{"receiveremail": "b@example.com", "receiver": "B"}',
+        '{not json',
+    ]) + '\n', encoding='utf-8')
+    status_path = tmp_path / 'status.jsonl'
+
+    counts = merge(str(recipients), str(status_path), dry_run=True)
+
+    statuses = _statuses(status_path)
+    assert [status['status'] for status in statuses] == [
+        'parse_error', 'parse_error', 'rendered', 'parse_error', 'parse_error']
+    assert counts == {'parse_error': 4, 'rendered': 1}
+    assert 'receiver' in statuses[3]['error']
+
+
+def test_csv_conflicting_columns(tmp_path):
+    recipients = tmp_path / 'recipients.csv'
+    recipients.write_text(
+        'receiveremail,receiver,receiver.name\n'
+        'a@example.com,,A\n'
+        'b@example.com,B,B\n'
+        'c@example.com,C,\n',
+        encoding='utf-8')
+    status_path = tmp_path / 'status.jsonl'
+
+    merge(str(recipients), str(status_path), dry_run=True)
+
+    assert [status['status'] for status in _statuses(status_path)] == [
+        'rendered', 'parse_error', 'parse_error']
+
+
+@pytest.mark.parametrize('row', [
+    {'receiver': 'A', 'receiver.name': 'A'},
+    {'receiver.name': 'A', 'receiver': 'A'},
+])
+def test_unflatten_rejects_conflicts(row):
+    with pytest.raises(RowError):
+        _unflatten(row)
+
+
+def test_unflatten_nested_columns():
+    assert _unflatten({'receiver.name': 'A', 'mode.gender': 'male', 'empty': ''}) == {
+        'receiver': {'name': 'A'}, 'mode': {'gender': 'male'}}
@@ -0,0 +1,65 @@
+"""
+Metrics.to_prometheus: text exposition format
+"""
+
+from metrics import Metrics, BUCKETS, PREFIX
+
+
+def _metrics():
+    metrics = Metrics()
+    metrics.inc('messages_sent_total', provider='gmail')
+    metrics.inc('messages_sent_total', 2, provider='outlook')
+    metrics.inc('messages_failed_total', provider='smtp', error='say "hi"\\\n')
+    metrics.observe('http_send_seconds', 0.003, provider='gmail')
+    metrics.observe('http_send_seconds', 0.2, provider='gmail')
+    metrics.observe('http_send_seconds', 120.0, provider='gmail')
+    return metrics
+
+
+def test_help_and_type_once_per_family():
+    lines = _metrics().to_prometheus().splitlines()
+
+    for family, kind in (('messages_sent_total', 'counter'), ('messages_failed_total', 'counter'),
+                         ('http_send_seconds', 'histogram'), ('messages_per_second', 'gauge')):
+        name = PREFIX + family
+        help_index = lines.index(next(line for line in lines if line.startswith(f'# HELP {name} ')))
+        assert lines[help_index + 1] == f'# TYPE {name} {kind}'
+        assert sum(line.startswith(f'# TYPE {name} ') for line in lines) == 1
+        # Samples follow their TYPE line
+        assert lines[help_index + 2].startswith(name)
+
+    assert f'{PREFIX}messages_sent_total{{provider="gmail"}} 1' in lines
+    assert f'{PREFIX}messages_sent_total{{provider="outlook"}} 2' in lines
+
+
+def test_label_values_are_escaped():
+    text = _metrics().to_prometheus()
+    assert f'{PREFIX}messages_failed_total{{error="say \\"hi\\"\\\\\\n",provider="smtp"}} 1\n' in text
+    assert text.endswith('\n')
+    assert '# EOF' not in text
+
+
+def test_histogram_buckets_sum_and_count():
+    lines = _metrics().to_prometheus().splitlines()
+    name = PREFIX + 'http_send_seconds'
+    buckets = [line for line in lines if line.startswith(f'{name}_bucket')]
+
+    assert [line.split('le="')[1].split('"')[0] for line in buckets] == [str(bound) for bound in BUCKETS] + ['+Inf']
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert f'{name}_bucket{{provider="gmail",le="0.0025"}} 0' in lines
+    assert f'{name}_bucket{{provider="gmail",le="0.005"}} 1' in lines
+    assert f'{name}_bucket{{provider="gmail",le="0.25"}} 2' in lines
+    assert f'{name}_bucket{{provider="gmail",le="60.0"}} 2' in lines
+    assert f'{name}_bucket{{provider="gmail",le="+Inf"}} 3' in lines
+    assert f'{name}_count{{provider="gmail"}} 3' in lines
+    sum_line = next(line for line in lines if line.startswith(f'{name}_sum'))
+    assert abs(float(sum_line.rsplit(' ', 1)[1]) - 120.203) < 1e-9
+
+
+def test_openmetrics_counter_families():
+    lines = _metrics().to_prometheus(openmetrics=True).splitlines()
+    assert f'# TYPE {PREFIX}messages_sent counter' in lines
+    assert any(line.startswith(f'# HELP {PREFIX}messages_sent ') for line in lines)
+    assert f'{PREFIX}messages_sent_total{{provider="gmail"}} 1' in lines
+    assert lines[-1] == '# EOF'
@@ -0,0 +1,90 @@
+"""
+MimeBuilder output against email.message.EmailMessage (what build_raw used before)
+"""
+
+import base64
+import email
+import itertools
+from email import policy
+from email.message import EmailMessage
+
+import pytest
+
+from mime_stream import MimeBuilder
+
+SENDERS = ['sender@example.com', 'very.long.sender.address.for.folding.checks@sub.domain.example.co.jp']
+RECIPIENTS = [
+    ('bob@example.com', 'Bob'),
+    ('taro@example.jp', '山田 太郎'),
+    ('doe@example.com', 'Doe, John "JD"'),
+    ('long@example.com', 'A Recipient Name That Is Long Enough To Need Folding Somewhere In The Header'),
+]
+SUBJECTS = [
+    'Hello',
+    'ご連絡',
+    'Mixed ASCII and 日本語 in a subject line that is long enough to be folded by the policy',
+    'A plain ASCII subject that is definitely longer than seventy-eight characters in total',
+    'Looks like =?utf-8?q?encoded?= but is not',
+]
+SHORT_LINE_BODIES = [
+    '<p>Hello</p>',
+    '<p>こんにちは</p>\n<p>Ünïcödé</p>\n',
+    'Line one\r\nLine two\r\n',
+    '\n'.join(f'<tr><td>{index}</td><td>行 {index}</td></tr>' for index in range(20000)),
+]
+LONG_LINE_BODIES = [
+    '<p>' + 'x' * 200 + '</p>',
+    '<div>' + '長い行' * 100 + '</div>\n<p>short</p>',
+    ('<p>' + 'word ' * 40 + '</p>\n') * 5000,
+]
+
+builder = MimeBuilder()
+
+
+def _stdlib_raw(sender_email, recipient_email, recipient_name, subject, html_body):
+    message = EmailMessage()
+    message['To'] = f'{recipient_name} <{recipient_email}>'
+    message['From'] = sender_email
+    message['Subject'] = subject
+    message.set_content(html_body, subtype='html')
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+
+
+def _parse(raw):
+    return email.message_from_bytes(base64.urlsafe_b64decode(raw), policy=policy.default)
+
+
+@pytest.mark.parametrize('sender, recipient, subject',
+                         list(itertools.product(SENDERS, RECIPIENTS, SUBJECTS)))
+def test_headers_match_stdlib(sender, recipient, subject):
+    recipient_email, recipient_name = recipient
+    args = (sender, recipient_email, recipient_name, subject, '<p>Hello</p>')
+    assert builder.build_raw(*args) == _stdlib_raw(*args)
+
+
+@pytest.mark.parametrize('body', SHORT_LINE_BODIES)
+@pytest.mark.parametrize('subject', SUBJECTS[:3])
+def test_short_line_bodies_are_byte_identical(subject, body):
+    args = ('sender@example.com', 'taro@example.jp', '山田 太郎', subject, body)
+    assert builder.build_raw(*args) == _stdlib_raw(*args)
+
+
+@pytest.mark.parametrize('body', LONG_LINE_BODIES)
+def test_long_line_bodies_decode_to_the_same_message(body):
+    args = ('sender@example.com', 'taro@example.jp', '山田 太郎', 'ご連絡', body)
+    fast, reference = _parse(builder.build_raw(*args)), _parse(_stdlib_raw(*args))
+
+    for name in ('To', 'From', 'Subject', 'Content-Type', 'MIME-Version'):
+        assert fast[name] == reference[name]
+    assert fast.get_content() == reference.get_content()
+    # Always base64 here, in lines the policy accepts
+    assert fast['Content-Transfer-Encoding'] == 'base64'
+    assert max(len(line) for line in fast.get_payload().splitlines()) <= 76
+
+
+def test_reused_buffer_does_not_leak_between_messages():
+    large = ('sender@example.com', 'bob@example.com', 'Bob', 'Hello', SHORT_LINE_BODIES[3])
+    small = ('sender@example.com', 'bob@example.com', 'Bob', 'Hello', '<p>Hi</p>')
+    builder.build_raw(*large)
+    assert builder.build_raw(*small) == _stdlib_raw(*small)
+    assert builder.build(*small) == base64.urlsafe_b64decode(_stdlib_raw(*small))
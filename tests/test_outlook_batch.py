@@ -0,0 +1,187 @@
+"""
+OutlookGraphAuth.send_batch against the local Graph stub (benchmarks/stubs.py)
+"""
+
+import time
+
+import pytest
+import requests
+
+from stubs import StubServer
+from token_manager import get_token_manager
+from outlook_azure import OutlookGraphAuth, GRAPH_BATCH_LIMIT, HTTP_TIMEOUT, _retry_after
+
+
+def _messages(count):
+    return [
+        {'recipient_email': f"r{index}@example.com", 'recipient_name': 'Recipient',
+         'subject': 'Subject', 'html_body': '<p>Hello</p>'}
+        for index in range(count)
+    ]
+
+
+def _recipient(item):
+    return item['body']['message']['toRecipients'][0]['emailAddress']['address']
+
+
+@pytest.fixture
+def outlook():
+    """Graph client with a pre-seeded in-memory token, pointed at a stub server by the test"""
+    account = 'batch@outlook.com'
+    manager = get_token_manager(f"outlook:{account}", lambda token: None, cache=None, background=False)
+    manager.set_token({'access_token': 'test', 'refresh_token': None, 'expires_at': time.time() + 3600})
+    service = OutlookGraphAuth(account=account)
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record retry waits instead of sleeping"""
+    delays = []
+    monkeypatch.setattr(time, 'sleep', delays.append)
+    return delays
+
+
+def test_send_batch_packs_requests(outlook):
+    with StubServer() as stub:
+        outlook.graph_api_url = stub.url
+        failed, uncertain = outlook.send_batch(_messages(45))
+
+        assert failed == uncertain == []
+        assert stub.requests == -(-45 // GRAPH_BATCH_LIMIT)
+
+
+def test_send_batch_retries_throttled_items(outlook, sleeps):
+    attempts = {}
+
+    def item_status(item):
+        recipient = _recipient(item)
+        attempts[recipient] = attempts.get(recipient, 0) + 1
+        if recipient == 'r3@example.com' and attempts[recipient] == 1:
+            return 429, {'Retry-After': '7'}
+        return 202, {}
+
+    with StubServer(item_status) as stub:
+        outlook.graph_api_url = stub.url
+        failed, uncertain = outlook.send_batch(_messages(5))
+
+    assert failed == uncertain == []
+    assert attempts['r3@example.com'] == 2
+    assert attempts['r0@example.com'] == 1
+    assert sleeps == [7]
+
+
+def test_send_batch_returns_failed_items(outlook, sleeps):
+    def item_status(item):
+        recipient = _recipient(item)
+        if recipient == 'r1@example.com':
+            return 400, {}
+        if recipient == 'r2@example.com':
+            return 503, {}
+        return 202, {}
+
+    with StubServer(item_status) as stub:
+        outlook.graph_api_url = stub.url
+        messages = _messages(4)
+        failed, uncertain = outlook.send_batch(messages, max_retries=2)
+
+    # 400 fails at once; 503 is retried until max_retries runs out
+    assert failed == [messages[1], messages[2]]
+    assert uncertain == []
+    assert sleeps == [1, 2]
+
+
+def test_send_batch_without_token_fails_every_item():
+    service = OutlookGraphAuth(account='nobody@outlook.com')
+    get_token_manager('outlook:nobody@outlook.com', lambda token: None).set_token(None)
+    try:
+        messages = _messages(3)
+        assert service.send_batch(messages, max_retries=0) == (messages, [])
+    finally:
+        service.close()
+
+
+def test_send_batch_does_not_resend_without_response(outlook, sleeps, monkeypatch):
+    calls = []
+
+    def post(url, **kwargs):
+        calls.append(url)
+        raise requests.exceptions.ReadTimeout('no response')
+
+    monkeypatch.setattr(outlook.session, 'post', post)
+    messages = _messages(25)
+
+    # The batches may have been delivered: nothing is resent or offered for re-queueing
+    assert outlook.send_batch(messages) == ([], messages)
+    assert len(calls) == 2
+    assert sleeps == []
+
+
+def test_send_batch_retries_when_nothing_was_sent(outlook, sleeps, monkeypatch):
+    calls = []
+
+    def post(url, **kwargs):
+        calls.append(url)
+        raise requests.exceptions.ConnectTimeout('no connection')
+
+    monkeypatch.setattr(outlook.session, 'post', post)
+    messages = _messages(3)
+
+    assert outlook.send_batch(messages, max_retries=2) == (messages, [])
+    assert len(calls) == 3
+
+
+def test_send_email_status_says_whether_anything_was_sent(outlook, monkeypatch):
+    def send(error):
+        def post(url, **kwargs):
+            raise error
+        monkeypatch.setattr(outlook.session, 'post', post)
+        assert outlook.send_email('batch@outlook.com', 'to@example.com', 'To', 'Subject', '<p>Hi</p>') is False
+        return outlook.last_status
+
+    assert send(requests.exceptions.ConnectTimeout('no connection')) == 503
+    assert send(requests.exceptions.ReadTimeout('no response')) is None
+
+    get_token_manager('outlook:batch@outlook.com', None).set_token(None)
+    assert send(AssertionError('must not post without a token')) == 401
+
+
+def test_every_request_has_a_timeout(outlook, monkeypatch):
+    timeouts = []
+
+    def post(url, **kwargs):
+        timeouts.append(kwargs.get('timeout'))
+        raise requests.exceptions.ReadTimeout('no response')
+
+    monkeypatch.setattr(outlook.session, 'post', post)
+    outlook.send_email('batch@outlook.com', 'to@example.com', 'To', 'Subject', '<p>Hi</p>')
+    outlook.send_email_stream('batch@outlook.com', 'to@example.com', 'To', 'Subject', iter(['<p>Hi</p>']))
+    outlook.send_batch(_messages(1))
+    outlook.exchange_code_for_tokens('code', 'http://localhost:8080/callback')
+
+    assert timeouts == [HTTP_TIMEOUT] * 4
+    # A full pool opens another connection instead of waiting for one
+    assert not outlook.session.get_adapter('https://graph.microsoft.com').poolmanager.connection_pool_kw['block']
+
+
+def test_send_batch_missing_item_is_uncertain(outlook, sleeps):
+    def item_status(item):
+        return (None, {}) if _recipient(item) == 'r1@example.com' else (202, {})
+
+    with StubServer(item_status) as stub:
+        outlook.graph_api_url = stub.url
+        messages = _messages(3)
+        assert outlook.send_batch(messages) == ([], [messages[1]])
+    assert sleeps == []
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'Retry-After': '12'}, 12),
+    ({'retry-after': '3'}, 3),
+    ({'Retry-After': '-5'}, 0),
+    ({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 0),
+    ({}, 0),
+])
+def test_retry_after(headers, expected):
+    assert _retry_after(headers) == expected
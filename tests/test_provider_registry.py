@@ -0,0 +1,96 @@
+"""
+ProviderRegistry: caching, failed logins, and eviction that never closes a service still in use
+"""
+
+import time
+
+import pytest
+
+from provider_registry import ProviderRegistry
+
+
+class FakeService:
+    def __init__(self, sender_email):
+        self.sender_email = sender_email
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_get_reuses_service():
+    registry = ProviderRegistry(FakeService)
+    assert registry.get('a@example.com') is registry.get('A@example.com')
+
+
+def test_evict_does_not_close_services_in_use():
+    registry = ProviderRegistry(FakeService)
+    in_use = registry.get('a@example.com')
+
+    registry.evict('a@example.com')
+
+    assert not in_use.closed
+    assert registry.get('a@example.com') is not in_use
+
+
+def test_overflow_drops_least_recently_used_without_closing():
+    registry = ProviderRegistry(FakeService, max_size=2)
+    first = registry.get('a@example.com')
+    registry.get('b@example.com')
+    registry.get('c@example.com')
+
+    assert not first.closed
+    assert registry.get('a@example.com') is not first
+
+
+def test_clear_closes_services():
+    registry = ProviderRegistry(FakeService)
+    service = registry.get('a@example.com')
+    registry.clear()
+    assert service.closed
+
+
+def test_account_locks_are_dropped_after_use():
+    registry = ProviderRegistry(FakeService)
+    for index in range(100):
+        registry.get(f"user{index}@example.com")
+    registry.get('user0@example.com')
+    assert registry._account_locks == {}
+
+
+def test_failed_authentication_is_not_repeated_within_ttl(monkeypatch):
+    calls = []
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+
+    def factory(sender_email):
+        calls.append(sender_email)
+        return None if len(calls) < 3 else FakeService(sender_email)
+
+    registry = ProviderRegistry(factory, failure_ttl=30)
+    assert registry.get('a@example.com') is None
+    assert registry.get('a@example.com') is None
+    assert len(calls) == 1
+
+    now[0] += 31
+    assert registry.get('a@example.com') is None
+    assert len(calls) == 2
+
+    # evict() forgets the failure, so the next get() authenticates again
+    registry.evict('a@example.com')
+    assert registry.get('a@example.com') is not None
+    assert len(calls) == 3
+
+
+def test_authentication_error_is_remembered_too():
+    calls = []
+
+    def factory(sender_email):
+        calls.append(sender_email)
+        raise RuntimeError('login window closed')
+
+    registry = ProviderRegistry(factory)
+    with pytest.raises(RuntimeError):
+        registry.get('a@example.com')
+    assert registry.get('a@example.com') is None
+    assert len(calls) == 1
@@ -0,0 +1,76 @@
+"""
+SendScheduler: rate limiting, worker sharing and imap ordering with a fake service
+"""
+
+import time
+import threading
+from types import SimpleNamespace
+
+from scheduler import SendScheduler, SendError, TokenBucket
+from send_email import GMAIL, OUTLOOK
+
+
+class FakeService:
+    """Records send times; fails for recipients listed in `failing`"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+        self.last_status = 400
+        self._lock = threading.Lock()
+
+    def send_email(self, sender_email, recipient_email, recipient_name, subject, html_body):
+        with self._lock:
+            self.sent.append((sender_email, recipient_email, time.monotonic()))
+        return recipient_email not in self.failing
+
+
+def _message(sender, recipient):
+    return SimpleNamespace(sender_email=sender, receiver_email=recipient,
+                           receiver_name='Recipient', subject='Subject')
+
+
+def test_reserve_goes_into_debt():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+    assert 0.15 < bucket.reserve() <= 0.2
+
+
+def test_throttled_sender_does_not_block_other_senders():
+    service = FakeService()
+    limits = {GMAIL: {'rate': 2, 'burst': 1, 'concurrency': 1},
+              OUTLOOK: {'rate': 1000, 'burst': 100, 'concurrency': 4}}
+    slow = [_message('slow@gmail.com', f"s{index}@example.com") for index in range(3)]
+    fast = [_message('fast@outlook.com', f"f{index}@example.com") for index in range(10)]
+
+    start = time.monotonic()
+    with SendScheduler(workers=1, max_pending=20, limits=limits,
+                       auth_func=lambda sender: service) as scheduler:
+        futures = [scheduler.submit(message, '<p>Hi</p>') for message in slow + fast]
+        fast_done = [future.result() for future in futures[3:]]
+        fast_elapsed = time.monotonic() - start
+        assert all(future.result() for future in futures[:3])
+
+    # The single worker is never parked waiting on the slow sender's bucket
+    assert fast_done == [True] * 10
+    assert fast_elapsed < 0.4
+    slow_times = [sent_at for sender, _, sent_at in service.sent if sender == 'slow@gmail.com']
+    assert slow_times[-1] - slow_times[0] >= 0.9
+
+
+def test_imap_passes_unsent_items_through():
+    service = FakeService(failing={'bad@example.com'})
+    items = [
+        ('a', _message('me@gmail.com', 'a@example.com'), ''),
+        ('skipped', None, None),
+        ('bad', _message('me@gmail.com', 'bad@example.com'), ''),
+    ]
+    with SendScheduler(workers=2, auth_func=lambda sender: service) as scheduler:
+        results = {tag: (result, error) for tag, result, error in scheduler.imap(items)}
+
+    assert results['a'] == (True, None)
+    assert results['skipped'] == (None, None)
+    assert isinstance(results['bad'][1], SendError)
+    assert results['bad'][1].status == 400
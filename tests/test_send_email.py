@@ -0,0 +1,41 @@
+"""
+send_email.authenticate: interactive logins never run at the same time
+"""
+
+import time
+import threading
+
+import outlook_azure
+import google_oauth2
+from send_email import authenticate
+
+
+def test_interactive_logins_are_serialised(monkeypatch):
+    active = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def login(account=None):
+        with lock:
+            active.append(account)
+            if len(active) > 1:
+                overlaps.append(list(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(account)
+        return account
+
+    monkeypatch.setattr(outlook_azure, 'outlook_authenticate', login)
+    monkeypatch.setattr(google_oauth2, 'gmail_authenticate_service', login)
+
+    senders = ['a@outlook.com', 'b@outlook.com', 'c@gmail.com', 'd@hotmail.com']
+    results = {}
+    threads = [threading.Thread(target=lambda s=s: results.update({s: authenticate(s)}))
+               for s in senders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == []
+    assert results == {sender: sender for sender in senders}
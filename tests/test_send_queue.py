@@ -0,0 +1,71 @@
+"""
+SendQueue: which failures are retried, parked as uncertain, or final
+"""
+
+import pytest
+
+from Message import Message
+from send_queue import SendQueue, is_retryable, PENDING, DEAD, UNCERTAIN
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SendQueue(str(tmp_path / 'queue.db'), base_delay=0.0)
+    queue.enqueue(Message('me@example.com', 'you@example.com', 'You', 'Subject'), '<p>Hi</p>')
+    yield queue
+    queue.close()
+
+
+@pytest.mark.parametrize('status, expected', [
+    (429, True), (500, True), (503, True), (400, False), (404, False), (None, False),
+])
+def test_is_retryable(status, expected):
+    assert is_retryable(status) is expected
+
+
+def test_server_error_is_retried(queue):
+    job, = queue.claim()
+    assert queue.mark_failed(job, 'unavailable', 503) == PENDING
+    assert queue.claim()
+
+
+def test_client_error_is_final(queue):
+    job, = queue.claim()
+    assert queue.mark_failed(job, 'bad request', 400) == DEAD
+    assert queue.stats()[DEAD] == 1
+
+
+def test_missing_status_is_parked_until_explicit_retry(queue):
+    job, = queue.claim()
+    assert queue.mark_failed(job, 'connection reset', None) == UNCERTAIN
+    assert queue.claim() == []
+    assert queue.next_attempt_at() is None
+
+    assert queue.retry_uncertain() == 1
+    job, = queue.claim()
+    assert job.attempts == 2
+
+
+class _FailingService:
+    def __init__(self, status):
+        self.last_status = status
+
+    def send_email(self, **kwargs):
+        return False
+
+
+@pytest.mark.parametrize('auth_func, expected', [
+    (lambda sender: None, DEAD),                        # authentication failed
+    (lambda sender: 1 / 0, DEAD),                       # authentication raised
+    (lambda sender: _FailingService(401), DEAD),        # no credentials, nothing sent
+    (lambda sender: _FailingService(503), PENDING),     # could not connect
+    (lambda sender: _FailingService(None), UNCERTAIN),  # sent, no response
+])
+def test_process_parks_only_sends_without_a_response(queue, auth_func, expected):
+    from scheduler import SendScheduler
+
+    with SendScheduler(workers=1, auth_func=auth_func) as scheduler:
+        attempts = queue.process(scheduler=scheduler)
+        _, state, error = next(attempts)
+        attempts.close()
+    assert state == expected, error
@@ -0,0 +1,91 @@
+"""
+SettingsStore: mtime-based invalidation and read-only results
+"""
+
+import json
+import os
+import time
+
+import pytest
+
+from settings_store import SettingsStore
+
+
+def _write(path, data, bump_ns=0):
+    """Write a JSON file; bump_ns moves its mtime forward so the change is always visible"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    if bump_ns:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + bump_ns))
+
+
+@pytest.fixture
+def settings_dir(tmp_path):
+    _write(str(tmp_path / 'en' / 'header.json'), {'greeting': 'Hello', 'nested': {'a': 1}})
+    _write(str(tmp_path / 'en' / 'mode' / 'male.json'), {'greeting': 'Dear Mr.'})
+    return tmp_path
+
+
+def test_edited_file_invalidates_after_check_interval(settings_dir):
+    store = SettingsStore(str(settings_dir), check_interval=0.2)
+    first = store.get('en')
+    assert first['header']['greeting'] == 'Hello'
+    assert store.get('en') is first
+
+    _write(str(settings_dir / 'en' / 'header.json'), {'greeting': 'Hi'}, bump_ns=10**9)
+    # Not re-checked within check_interval
+    assert store.get('en') is first
+
+    time.sleep(0.25)
+    second = store.get('en')
+    assert second is not first
+    assert second['header']['greeting'] == 'Hi'
+    assert store.file('en', 'header')['greeting'] == 'Hi'
+
+
+def test_new_mode_file_invalidates(settings_dir):
+    store = SettingsStore(str(settings_dir), check_interval=0)
+    assert dict(store.get('en', 'male', 'formal')['mode']) == {'greeting': 'Dear Mr.'}
+
+    _write(str(settings_dir / 'en' / 'mode' / 'formal.json'), {'closing': 'Sincerely'})
+    mode = store.get('en', 'male', 'formal')['mode']
+    assert dict(mode) == {'greeting': 'Dear Mr.', 'closing': 'Sincerely'}
+
+
+def test_unchanged_files_are_not_reloaded(settings_dir, monkeypatch):
+    store = SettingsStore(str(settings_dir), check_interval=0)
+    store.get('en')
+    monkeypatch.setattr(store, '_read_lang', lambda lang_code: pytest.fail('reloaded'))
+    assert store.get('en')['header']['greeting'] == 'Hello'
+
+
+def test_results_are_read_only(settings_dir):
+    store = SettingsStore(str(settings_dir))
+    settings = store.get('en', 'male')
+
+    with pytest.raises(TypeError):
+        settings['header'] = {}
+    with pytest.raises(TypeError):
+        settings['header']['greeting'] = 'changed'
+    with pytest.raises(TypeError):
+        settings['header']['nested']['a'] = 2
+    with pytest.raises(TypeError):
+        settings['mode']['greeting'] = 'changed'
+    with pytest.raises(TypeError):
+        store.file('en', 'header')['greeting'] = 'changed'
+    assert store.get('en', 'male')['header']['greeting'] == 'Hello'
+
+
+def test_invalid_json_raises_until_fixed(settings_dir):
+    store = SettingsStore(str(settings_dir), check_interval=0)
+    path = settings_dir / 'en' / 'header.json'
+    path.write_text('{broken', encoding='utf-8')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(json.JSONDecodeError):
+        store.get('en')
+
+    _write(str(path), {'greeting': 'Fixed'}, bump_ns=2 * 10**9)
+    assert store.get('en')['header']['greeting'] == 'Fixed'
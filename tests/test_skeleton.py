@@ -0,0 +1,46 @@
+"""
+Differential test: SkeletonRenderer output is byte-identical to TemplateRenderer
+"""
+
+import itertools
+
+import pytest
+
+from substitute import TemplateRenderer
+from skeleton import SkeletonRenderer
+from settings_store import SettingsStore
+
+RECEIVERS = [{'name': 'Recipient'}, {'name': '<b>Tom & "Jerry"</b>'}, {'name': ''}, {'name': 42}]
+BODIES = ['Hello', 'Line 1\nLine 2 {{ not a tag }}', 'ユニコード本文 \x00slot1\x00', '']
+EXTRAS = [
+    {},
+    {'closing': 'Best,', 'name': 'Sender'},
+    {'button_link': 'https://example.com', 'button_text': 'Open'},
+    {'greeting': 'Hi \x00slot0\x00'},           # looks like a sentinel: must fall back
+    {'closing': None},                          # non-str slot value: must fall back
+    {'button_link': ['unhashable']},            # unhashable non-slot value: must fall back
+]
+MODES = [{}, {'mode': {'gender': 'male', 'formal': 'formal'}}]
+
+
+@pytest.fixture(scope='module')
+def renderers():
+    full = TemplateRenderer(use_bytecode_cache=False)
+    return full, SkeletonRenderer(use_bytecode_cache=False, store=full.store)
+
+
+@pytest.mark.parametrize('lang_code', SettingsStore().languages() + ['en'])
+def test_skeleton_matches_full_render(renderers, lang_code):
+    full, fast = renderers
+    for receiver, body, extra, mode in itertools.product(RECEIVERS, BODIES, EXTRAS, MODES):
+        filled_data = {'receiver': receiver, 'body': body, **extra, **mode}
+        assert fast.render(lang_code, filled_data) == full.render(lang_code, filled_data), filled_data
+
+
+def test_skeleton_is_reused(renderers):
+    _, fast = renderers
+    fast.render('en', {'receiver': {'name': 'A'}, 'body': 'one'})
+    cached = len(fast._skeletons)
+    assert cached
+    fast.render('en', {'receiver': {'name': 'B'}, 'body': 'two'})
+    assert len(fast._skeletons) == cached
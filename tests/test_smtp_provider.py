@@ -0,0 +1,143 @@
+"""
+SMTPService against the local aiosmtpd stub (benchmarks/stubs.py)
+"""
+
+import time
+import socket
+
+import pytest
+
+pytest.importorskip('aiosmtpd')
+
+import smtp_provider
+from stubs import SMTPStubServer
+from token_manager import get_token_manager
+from smtp_provider import SMTPService, OUTLOOK
+
+
+def _service(stub, **kwargs):
+    options = {'password': 'secret', 'starttls': False}
+    options.update(kwargs)
+    return SMTPService(account='sender@example.org', host='127.0.0.1', port=stub.port, **options)
+
+
+def _send(smtp, recipient='to@example.org'):
+    return smtp.send_email('sender@example.org', recipient, 'Recipient', 'Subject', '<p>Hello</p>')
+
+
+def _drop_idle_connections(smtp):
+    """Make the pooled connections unusable, as if the server had closed them"""
+    for connection, _ in smtp.pool._idle:
+        connection.sock.shutdown(socket.SHUT_RDWR)
+
+
+def test_connection_is_reused():
+    with SMTPStubServer() as stub:
+        smtp = _service(stub)
+        assert all(_send(smtp) for _ in range(10))
+        smtp.close()
+
+    assert stub.messages == 10
+    assert stub.connections == 1
+
+
+@pytest.mark.parametrize('check_idle', [0, 60])
+def test_dropped_connection_is_replaced(check_idle):
+    # check_idle=0: NOOP finds the dead connection; 60: sending on it fails before MAIL FROM
+    with SMTPStubServer() as stub:
+        smtp = _service(stub)
+        smtp.pool.check_idle = check_idle
+        assert _send(smtp)
+        _drop_idle_connections(smtp)
+
+        assert _send(smtp)
+        assert smtp.last_status == 200
+        smtp.close()
+
+    assert stub.messages == 2
+    assert stub.connections == 2
+
+
+def test_no_resend_once_data_was_sent():
+    def on_data(envelope):
+        # Drop the connection after the message was received, before replying
+        return None if envelope.rcpt_tos == ['lost@example.org'] else '250 OK'
+
+    with SMTPStubServer(on_data=on_data) as stub:
+        smtp = _service(stub)
+        assert _send(smtp)
+        # Sent on the reused connection: the message may have been delivered, so
+        # no retry, and no status the send queue would retry on
+        assert _send(smtp, 'lost@example.org') is False
+        assert smtp.last_status is None
+        smtp.close()
+
+    assert stub.messages == 2
+
+
+def test_refused_recipient_keeps_the_connection():
+    def on_data(envelope):
+        return '550 No such user' if envelope.rcpt_tos == ['bad@example.org'] else '250 OK'
+
+    with SMTPStubServer(on_data=on_data) as stub:
+        smtp = _service(stub)
+        assert _send(smtp, 'bad@example.org') is False
+        assert smtp.last_status == 400
+        assert _send(smtp)
+        smtp.close()
+
+    assert stub.connections == 1
+
+
+def test_connection_refused_is_retryable():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    smtp = SMTPService(account='sender@example.org', host='127.0.0.1', port=port,
+                       password='secret', starttls=False)
+
+    # Nothing was sent, so the send queue may retry it
+    assert _send(smtp) is False
+    assert smtp.last_status == 503
+    smtp.close()
+
+
+def test_xoauth2_login():
+    account = 'sender@example.org'
+    manager = get_token_manager(f"smtp-outlook:{account}", lambda token: None, cache=None, background=False)
+    manager.set_token({'access_token': 'oauth-token', 'refresh_token': None, 'expires_at': time.time() + 3600})
+
+    with SMTPStubServer() as stub:
+        smtp = _service(stub, password='', auth_method='xoauth2', oauth_provider='outlook')
+        assert _send(smtp)
+        smtp.close()
+
+    assert stub.xoauth2 == [f"user={account}\x01auth=Bearer oauth-token\x01\x01"]
+
+
+def test_xoauth2_logs_in_for_the_smtp_scope(monkeypatch):
+    account = 'login@example.org'
+    # The Graph API token of the same account must not be used for SMTP
+    api_token = get_token_manager(f"outlook:{account}", lambda token: None, cache=None, background=False)
+    api_token.set_token({'access_token': 'graph-token', 'refresh_token': None, 'expires_at': time.time() + 3600})
+    get_token_manager(f"smtp-outlook:{account}", lambda token: None, cache=None, background=False)
+    logins = []
+
+    def login(login_account):
+        logins.append(login_account)
+        get_token_manager(f"smtp-outlook:{login_account}", None).set_token(
+            {'access_token': 'smtp-token', 'refresh_token': None, 'expires_at': time.time() + 3600})
+        return True
+
+    refresh, _, access_token = smtp_provider.OAUTH_PROVIDERS[OUTLOOK]
+    monkeypatch.setitem(smtp_provider.OAUTH_PROVIDERS, OUTLOOK, (refresh, login, access_token))
+
+    with SMTPStubServer() as stub:
+        smtp = SMTPService(account=account, host='127.0.0.1', port=stub.port, password='',
+                           auth_method='xoauth2', oauth_provider='outlook', starttls=False)
+        assert smtp.authenticate()
+        assert _send(smtp, 'to@example.org')
+        smtp.close()
+
+    assert logins == [account]
+    assert stub.xoauth2 == [f"user={account}\x01auth=Bearer smtp-token\x01\x01"]
@@ -0,0 +1,87 @@
+"""
+TemplateRenderer.build_vars: the ChainMap layers resolve like the old merged dict
+"""
+
+import itertools
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from settings_store import SettingsStore, LANG_FILES
+from substitute import TemplateRenderer
+
+HEADER = {'imageURL': 'https://example.com/logo.png', 'greeting': 'Dear '}
+FOOTER = {'closing': 'Regards,', 'year': '1999'}
+SENDER = {'email': 'me@example.com'}
+MODES = {
+    'male': {'greeting': 'Dear Mr. ', 'closing': 'Yours,'},
+    'formal': {'closing': 'Sincerely,', 'button_text': 'Open', 'year': '2000'},
+}
+FILLED = [
+    {},
+    {'body': 'Hi'},
+    {'greeting': 'Yo ', 'name': 'Recipient', 'button_link': 'https://example.com'},
+    {'header': {'greeting': 'ignored'}, 'footer': 'ignored', 'year': '1900'},
+    {'greeting_for_name_prefix': 'Mx. ', 'closing': 'ignored', 'imageURL': 'ignored'},
+]
+MODE_DATA = [None, {'gender': 'male'}, {'formal': 'formal'},
+             {'gender': 'male', 'formal': 'formal'}, {'gender': 'unknown'}]
+
+
+def _deep_merge(store, lang_code, filled_data):
+    """build_vars as it was before the layers were precomputed"""
+    mode_data = filled_data.get('mode')
+    gender = formal = None
+    if mode_data is not None:
+        if 'gender' in mode_data:
+            gender = str(mode_data['gender'])
+        if 'formal' in mode_data:
+            formal = str(mode_data['formal'])
+    settings = store.get(lang_code, gender, formal)
+    lang_data = {name: settings[name] for name in LANG_FILES if name in settings}
+
+    template_vars = {**filled_data, **lang_data, 'year': str(datetime.now().year)}
+    if 'header' in lang_data:
+        template_vars.update({
+            field: lang_data['header'].get(field, template_vars.get(field, ''))
+            for field in ('imageURL', 'greeting_for_name_prefix', 'greeting_for_name_postfix', 'greeting')
+        })
+    if 'footer' in lang_data:
+        template_vars.update({
+            field: lang_data['footer'].get(field, template_vars.get(field, ''))
+            for field in ('closing', 'button_text', 'button_link')
+        })
+    if 'sender' in lang_data:
+        template_vars.update({'name': lang_data['sender'].get('name', template_vars.get('name', ''))})
+    template_vars.update(settings['mode'])
+    return template_vars
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    root = tmp_path_factory.mktemp('settings')
+    files = {'full/header.json': HEADER, 'full/footer.json': FOOTER, 'full/sender.json': SENDER,
+             'full/mode/male.json': MODES['male'], 'full/mode/formal.json': MODES['formal'],
+             'header_only/header.json': HEADER}
+    for name, data in files.items():
+        path = root / name
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_text(json.dumps(data), encoding='utf-8')
+    os.makedirs(root / 'empty')
+    return SettingsStore(str(root))
+
+
+@pytest.mark.parametrize('lang_code', ['full', 'header_only', 'empty', 'missing'])
+def test_build_vars_matches_deep_merge(store, lang_code):
+    renderer = TemplateRenderer(use_bytecode_cache=False, store=store)
+    for filled_data, mode_data in itertools.product(FILLED, MODE_DATA):
+        if mode_data is not None:
+            filled_data = {**filled_data, 'mode': mode_data}
+        expected = _deep_merge(store, lang_code, filled_data)
+        chained = renderer.build_vars(lang_code, filled_data)
+        assert dict(chained) == expected, filled_data
+        # Per-key lookups go through the ChainMap itself, not a flattened copy
+        for key, value in expected.items():
+            assert chained[key] == value, key
@@ -0,0 +1,109 @@
+"""
+TokenManager refresh and revocation, and the Outlook refresh callback
+"""
+
+import time
+
+import pytest
+import requests
+
+import outlook_azure
+from token_manager import TokenCache, TokenManager, TokenRevoked
+from outlook_azure import OutlookGraphAuth, refresh_outlook_token, token_endpoint
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}")
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def post(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.response
+
+
+def _expired():
+    return {'access_token': 'old', 'refresh_token': 'refresh', 'expires_at': time.time() - 10}
+
+
+def test_refresh_replaces_and_caches_token(tmp_path):
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+    fresh = {'access_token': 'new', 'expires_at': time.time() + 3600}
+    manager = TokenManager('outlook:a@example.com', lambda token: fresh, cache=cache, background=False)
+    manager.set_token(_expired())
+
+    assert manager.get_token() == fresh
+    assert cache.load('outlook:a@example.com') == fresh
+
+
+def test_failed_refresh_keeps_cached_token(tmp_path):
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+    manager = TokenManager('outlook:a@example.com', lambda token: None, cache=cache, background=False)
+    manager.set_token(_expired())
+
+    # A transient failure: the refresh token may work next time
+    assert manager.get_token() is None
+    assert cache.load('outlook:a@example.com') is not None
+
+
+def test_revoked_token_is_forgotten(tmp_path):
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+
+    def revoked(token):
+        raise TokenRevoked('invalid_grant')
+
+    manager = TokenManager('outlook:a@example.com', revoked, cache=cache, background=False)
+    manager.set_token(_expired())
+
+    assert manager.get_token() is None
+    assert manager.token is None
+    assert cache.load('outlook:a@example.com') is None
+    # A later process starts without the stale entry and logs in again
+    assert TokenManager('outlook:a@example.com', revoked, cache=cache, background=False).token is None
+
+
+def test_outlook_refresh_uses_shared_session_and_endpoint(monkeypatch):
+    monkeypatch.setenv('AZURE_TENANT_ID', 'tenant')
+    session = FakeSession(FakeResponse(200, {'access_token': 'new', 'expires_in': 3600}))
+    monkeypatch.setattr(outlook_azure, '_get_token_session', lambda: session)
+
+    token = refresh_outlook_token(_expired())
+
+    assert token['access_token'] == 'new'
+    assert token['refresh_token'] == 'refresh'
+    url, kwargs = session.calls[0]
+    assert url == token_endpoint() == 'https://login.microsoftonline.com/tenant/oauth2/v2.0/token'
+    assert kwargs['timeout']
+    service = OutlookGraphAuth(account='endpoint@outlook.com')
+    try:
+        assert service.token_url == url
+    finally:
+        service.close()
+
+
+def test_outlook_refresh_rejected_grant_raises(monkeypatch):
+    session = FakeSession(FakeResponse(400, {'error': 'invalid_grant'}))
+    monkeypatch.setattr(outlook_azure, '_get_token_session', lambda: session)
+
+    with pytest.raises(TokenRevoked):
+        refresh_outlook_token(_expired())
+
+
+def test_outlook_refresh_server_error_is_transient(monkeypatch):
+    session = FakeSession(FakeResponse(503, {}))
+    monkeypatch.setattr(outlook_azure, '_get_token_session', lambda: session)
+
+    assert refresh_outlook_token(_expired()) is None